@@ -4,14 +4,9 @@ import smtplib
 import py_pears.utils as utils
 
 
-fq_df = utils.previous_fq(columns=['fq', 'survey_fq'])
-fq = fq_df['fq'].item()
-survey_fq = fq_df['survey_fq'].item()
-
-
 # report: 'corrections' or 'former staff'
 def report_filename(report='corrections'):
-    prev_month_str = utils.previous_month(return_type='%Y-%m')
+    fq = utils.fiscal_calendar().fq
     if report == 'corrections':
         return 'Quarterly Coalition Survey Entry ' + fq + '.xlsx'
     elif report == 'former staff':
@@ -44,21 +39,31 @@ def main(creds,
          report_recipients='',
          former_staff_report_recipients=''):
 
+    # Import Update Notifications, used for the Corrections Report
+    update_notes = utils.load_update_notes(update_notifications,
+                                           'Quarterly Data Cleaning',
+                                           required=[('Coalitions', 'UPDATES', 'Notification'),
+                                                     ('Program Activities', 'EVALUATION TAB UPDATES', 'Notification')])
+
+    # Fiscal quarter of the surveys, resolved for the day the report is run
+    calendar = utils.fiscal_calendar()
+    fq = calendar.fq
+    survey_fq = calendar.survey_fq
+
     # Custom fields that require reformatting
     # Only needed for multi-select dropdowns
     custom_field_labels = ['fcs_program_team', 'snap_ed_grant_goals', 'fcs_grant_goals', 'fcs_special_projects',
                            'snap_ed_special_projects']
 
-    coa_export = pd.ExcelFile(coalitions_export)
-    coa_data = pd.read_excel(coa_export, 'Coalition Data')
+    coa_data = utils.read_export(coalitions_export, 'Coalition Data')
     # create a utils function for removing _custom_data from column labels
     coa_data = utils.reformat(coa_data, custom_field_labels)  # this is only necessary for the on_hiatus field
     coa_data = coa_data.loc[coa_data['program_area'].isin(['SNAP-Ed', 'Family Consumer Science'])]
     coa_data['coalition_id'] = coa_data['coalition_id'].astype(str)
 
     # Using manual filename convention
-    coa_surveys = pd.read_excel(coalition_surveys_dir + "Coalition_Survey_" + fq + "_Export.xlsx",
-                                sheet_name='Response Data')
+    coa_surveys = utils.read_export(coalition_surveys_dir + "Coalition_Survey_" + fq + "_Export.xlsx",
+                                      'Response Data')
 
     # filter Responses By Survey by Completed == ---- to export all responses
     coa_surveys = utils.select_pears_data(coa_surveys,
@@ -89,41 +94,10 @@ def main(creds,
     # Responses by Survey filters: Name == Coalition Survey & Survey Status == Active
     # Export filters: Reporting Period == Extension 2021 & Type of Export == Individual Responses
 
-    # Import Update Notifications, used for the Corrections Report
-    update_notes = pd.read_excel(update_notifications,
-                                 sheet_name='Quarterly Data Cleaning').drop(columns='Tab')
-
     # Import and consolidate staff lists
     # Data cleaning is only conducted on records related to SNAP-Ed and Family Consumer Science programming
 
-    fy22_inep_staff = pd.ExcelFile(staff_list)
-    snap_ed_staff = pd.read_excel(fy22_inep_staff, sheet_name='SNAP-Ed Staff List', header=0)
-    heat_staff = pd.read_excel(fy22_inep_staff, sheet_name='HEAT Project Staff', header=0)
-    state_staff = pd.read_excel(fy22_inep_staff, sheet_name='FCS State Office', header=0)
-    staff_cols = ['NAME', 'E-MAIL']
-    staff_dfs = [snap_ed_staff[staff_cols], heat_staff[staff_cols], state_staff[staff_cols]]
-    inep_staff = pd.concat(staff_dfs, ignore_index=True).rename(columns={'E-MAIL': 'email'})
-    inep_staff = inep_staff.loc[~inep_staff.isnull().any(1)]
-    inep_staff['NAME'] = inep_staff['NAME'].str.split(pat=', ')
-    inep_staff['first_name'] = inep_staff['NAME'].str[1]
-    inep_staff['last_name'] = inep_staff['NAME'].str[0]
-    inep_staff['full_name'] = inep_staff['first_name'].map(str) + ' ' + inep_staff['last_name'].map(str)
-    cphp_staff = pd.read_excel(fy22_inep_staff, sheet_name='CPHP Staff List', header=0).rename(
-        columns={'Last Name': 'last_name',
-                 'First Name': 'first_name',
-                 'Email Address': 'email'})
-    cphp_staff['full_name'] = cphp_staff['first_name'].map(str) + ' ' + cphp_staff['last_name'].map(str)
-    staff = inep_staff.drop(columns='NAME').append(
-        cphp_staff.loc[~cphp_staff['email'].isnull(), ['email', 'first_name', 'last_name', 'full_name']],
-        ignore_index=True).drop_duplicates()
-
-    # Create lookup table for unit to regional educators
-    re_lookup = pd.read_excel(fy22_inep_staff, sheet_name="RE's and CD's")[
-        ['UNIT #', 'REGIONAL EDUCATOR', 'RE E-MAIL']]
-    re_lookup['REGIONAL EDUCATOR'] = re_lookup['REGIONAL EDUCATOR'].str.replace(', Interim', '')
-    re_lookup = re_lookup.drop_duplicates()
-    re_lookup = utils.reorder_name(re_lookup, 'REGIONAL EDUCATOR', 'REGIONAL EDUCATOR', drop_substr_fields=True)
-    re_lookup['UNIT #'] = re_lookup['UNIT #'].astype(str)
+    roster = utils.load_staff_roster(staff_list)
 
     # Import lookup table for counties to unit
     unit_counties = pd.read_excel(unit_counties)
@@ -196,7 +170,7 @@ def main(creds,
 
     corrections_sums.insert(0, 'Module', corrections_sums.pop('Module'))
 
-    corrections_sums = pd.merge(corrections_sums, update_notes, how='left', on=['Module', 'Update'])
+    corrections_sums = utils.merge_update_notes(corrections_sums, update_notes, notifications=['Notification'])
 
     report_filename = 'Quarterly Coalition Survey Entry ' + fq + '.xlsx'
     report_file_path = output_dir + report_filename
@@ -249,72 +223,64 @@ def main(creds,
         # notify_staff = coa_survey_corrections_email[['reported_by_email']].drop_duplicates()
 
         # Subset current staff using the staff list
-        current_staff = notify_staff.loc[notify_staff['reported_by_email'].isin(staff['email']),
+        current_staff = notify_staff.loc[notify_staff['reported_by_email'].isin(roster.staff['email']),
                                          ['reported_by_email', 'unit']]
-        current_staff = current_staff.values.tolist()
-
-        # If email fails to send, the recipient is added to this list
-        failed_recipients = []
-
-        # Email Update Notifications to current staff
-
-        for x in current_staff:
-            recipient = x[0]
-            unit = x[1]
 
-            staff_name = staff.loc[staff['email'] == recipient, 'full_name'].item()
-
-            notification_subject = 'Coalition Survey Entry ' + fq + ', ' + staff_name
-
-            response_tag = """If you have any questions or need help please reply to this email and a member of the
+        # Resolve each recipient's names, response tag and cc before any emails are sent
+        team_response_tag = """If you have any questions or need help please reply to this email and a member of the
             FCS Evaluation Team will reach out soon.
                     <br>Thanks and have a great day!<br>
                     <br> <b> FCS Evaluation Team </b> <br>
                     <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
             """
+        re_response_tag = 'If you have any questions or need help please contact your Regional Specialist,' \
+                          ' <b>{0}</b> (<a href = "mailto: {1} ">{1}</a>).'
+        recipients = utils.recipient_context(current_staff, roster, notification_cc, team_response_tag,
+                                             re_response_tag)
+        current_staff = current_staff.values.tolist()
 
-            new_notification_cc = notification_cc
-
-            if (unit in re_lookup["UNIT #"].tolist()) \
-                and (recipient not in state_staff['E-MAIL'].tolist()) \
-                    and ('@uic.edu' not in recipient):
-                response_tag = 'If you have any questions or need help please contact your Regional Specialist,' \
-                               ' <b>{0}</b> (<a href = "mailto: {1} ">{1}</a>).'
-                re_name = re_lookup.loc[re_lookup['UNIT #'] == unit, 'REGIONAL EDUCATOR'].item()
-                re_email = re_lookup.loc[re_lookup['UNIT #'] == unit, 'NETID/E-MAIL'].item()
-                response_tag = response_tag.format(*[re_name, re_email])
-                new_notification_cc = notification_cc + ', ' + re_email
-
-            notification_dfs = {'Coalitions': utils.staff_corrections(coa_corrections,
-                                                                      former=False,
-                                                                      staff_email=recipient),
-                                'Coalition Surveys': utils.staff_corrections(coa_survey_corrections_email,
-                                                                             former=False,
-                                                                             staff_email=recipient)}
+        # Email Update Notifications to current staff
 
-            y = [staff.loc[staff['email'] == recipient, 'first_name'].item(), deadline_date, response_tag]
+        current_staff_corrections = utils.staff_corrections_bundles({'Coalitions': coa_corrections,
+                                                                     'Coalition Surveys': coa_survey_corrections_email},
+                                                                    staff_emails=[x[0] for x in current_staff])
 
-            utils.insert_dfs(notification_dfs, y)
-            new_notification_html = notification_html.format(*y)
+        # Emails to current staff are sent concurrently over reused SMTP connections
+        with utils.MailPool(username=creds['admin_username'],
+                            password=creds['admin_password'],
+                            is_tls=True) as mail_pool:
+            for x, staff_name, first_name, response_tag, new_notification_cc, (_, notification_dfs) in zip(
+                    current_staff,
+                    recipients['full_name'],
+                    recipients['first_name'],
+                    recipients['response_tag'],
+                    recipients['cc'],
+                    current_staff_corrections):
+                recipient = x[0]
+
+                notification_subject = 'Coalition Survey Entry ' + fq + ', ' + staff_name
+
+                y = [first_name, deadline_date, response_tag]
+
+                utils.insert_dfs(notification_dfs, y)
+                new_notification_html = notification_html.format(*y)
+
+                # Queue the email, the recipient is added to failed_recipients if it fails to send
+                mail_pool.send(failed_as=[staff_name, x],
+                               send_from=creds['admin_send_from'],
+                               send_to=recipient,
+                               cc=new_notification_cc,
+                               subject=notification_subject,
+                               html=new_notification_html,
+                               wb=False)
 
-            # Try to send the email, otherwise add the recipient to failed_recipients
-            try:
-                utils.send_mail(send_from=creds['admin_send_from'],
-                                send_to=recipient,
-                                cc=new_notification_cc,
-                                subject=notification_subject,
-                                html=new_notification_html,
-                                username=creds['admin_username'],
-                                password=creds['admin_password'],
-                                wb=False,
-                                is_tls=True)
-            except smtplib.SMTPException:
-                failed_recipients.append([staff_name, x])
+        # If email fails to send, the recipient is added to this list
+        failed_recipients = mail_pool.failed_recipients
 
         # Email Update Notifications for former staff
 
         # Subset former staff using the staff list
-        former_staff = notify_staff.loc[~notify_staff['reported_by_email'].isin(staff['email'])]
+        former_staff = notify_staff.loc[~notify_staff['reported_by_email'].isin(roster.staff['email'])]
 
         coa_df = utils.staff_corrections(coa_corrections, former=True, former_staff=former_staff)
         pa_df = utils.staff_corrections(coa_survey_corrections_email, former=True, former_staff=former_staff)
@@ -1,6 +1,8 @@
+import os
 import pandas as pd
 import numpy as np
 import smtplib
+from functools import partial
 import py_pears.utils as utils
 
 
@@ -13,23 +15,6 @@ def report_filename(report='corrections'):
         return 'Former Staff PEARS Updates ' + prev_month_str + '.xlsx'
 
 
-# functions for reordering comma-separated name
-# df: dataframe of staff list
-# name_field: column label of name field
-# reordered_name_field: column label of reordered name field
-# drop_substr_fields: bool for dropping name substring fields
-def reorder_name(df, name_field, reordered_name_field, drop_substr_fields=False):
-    out_df = df.copy(deep=True)
-    out_df[name_field] = out_df[name_field].str.split(pat=', ')
-    out_df['first_name'] = out_df[name_field].str[1]
-    out_df['last_name'] = out_df[name_field].str[0]
-    out_df[reordered_name_field] = out_df['first_name'].map(str) + ' ' + out_df['last_name'].map(str)
-    if drop_substr_fields:
-        out_df = out_df.drop(columns=['first_name', 'last_name'])
-
-    return out_df
-
-
 # Function to drop duplicate records from merging module data with child records
 # df: dataframe of module corrections
 # c_updates: list of labels of child record update columns
@@ -44,17 +29,18 @@ def drop_child_dupes(df, c_updates, parent_id, child_id):
 
 
 # Concatenate update columns into a single column of newline-separated update notifications
+# Columns are concatenated with Series.str.cat, so any number of update columns is joined in one pass
 # data: dataframe of PEARS module data
 # concat_col: string for the label of the concatenated column
 # update_cols: list of strings of update columns to concatenate
 def concat_updates(data, concat_col, update_cols):
     out_data = data.copy()
-    # Use a lambda/list comprehension?
-    out_data[concat_col] = out_data[update_cols].apply(lambda x: '\n'.join(x.fillna('').values.tolist()), axis=1)
-    out_data.loc[out_data[concat_col].str.isspace(), concat_col] = np.nan
-    out_data[concat_col] = out_data[concat_col].str.strip()
+    updates = out_data[update_cols].fillna('').astype(str)
+    concat = updates[update_cols[0]].str.cat(updates[update_cols[1:]], sep='\n')
+    concat = concat.where(~concat.str.isspace(), np.nan).str.strip()
     if len(update_cols) > 2:
-        out_data[concat_col] = out_data[concat_col].str.replace(r'\n+', '', regex=True)
+        concat = concat.str.replace(r'\n+', '', regex=True)
+    out_data[concat_col] = concat
     return out_data
 
 
@@ -103,24 +89,345 @@ def corrections_email_format(corrections, cols, index,
 # report_dict: dict of sheet names to dataframes of corrections data
 # file_path: string for the output directory and filename
 def write_corrections_report(report_dict, file_path):
-    writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
-    for sheet_name, df in report_dict.items():
-        df.to_excel(writer, sheet_name=sheet_name, index=False, freeze_panes=(1, 0))
-        worksheet = writer.sheets[sheet_name]
-        workbook = writer.book
-        worksheet.autofilter(0, 0, 0, len(df.columns) - 1)
-        # Conditional format for Corrections Summary
-        blue_bold = workbook.add_format({'bold': True, 'bg_color': '#DEEAF0', 'font_color': '#000000'})
-        worksheet.conditional_format(0, 0, len(df), 2,
-                                     {'type': 'formula', 'criteria': '=$B1="Total"', 'format': blue_bold})
-        for idx, col in enumerate(df):
-            series = df[col]
-            max_len = max((
-                series.astype(str).map(len).max(),
-                len(str(series.name))
-            )) + 1
-            worksheet.set_column(idx, idx, max_len)
-    writer.close()
+    # Conditional format for Corrections Summary
+    total_format = {'first_col': 0, 'last_col': 2, 'type': 'formula', 'criteria': '=$B1="Total"', 'format': 'blue_bold'}
+    utils.render_workbook(file_path,
+                          {sheet_name: {'df': df, 'freeze_panes': (1, 0), 'conditional_formats': [total_format]}
+                           for sheet_name, df in report_dict.items()},
+                          formats={'blue_bold': {'bold': True, 'bg_color': '#DEEAF0', 'font_color': '#000000'}})
+
+
+# Terms indicating false positives when flagging Coalition Members with individuals' names
+MEMBER_NAME_EXCLUDE_TERMS = ['University', 'Hospital', 'YMCA', 'Center', 'County', 'Elementary', 'Foundation',
+                             'Church', 'Club', 'Daycare', 'Housing', 'SNAP-Ed']
+
+# Intervention Channel type of hard copy materials
+HARD_COPY_MATERIALS = "Hard copy materials (e.g. flyers, pamphlets, activity books, posters, banners, postcards, " \
+                      "recipe cards, or newsletters for mailings)"
+
+# Data cleaning rules of each module, keyed by module and the stage of flagging the rules are evaluated at
+# Rules are evaluated with utils.evaluate_rules(), which documents the rule format
+# Predicates receive the stage's dataframe and the dict of run parameters:
+#   il_names: set of names used to flag Coalition Members with individuals' names
+#   ts: timestamp sessions are compared to when checking for missing participants
+#   fy: int for the fiscal year of the report
+RULES = {
+    'Coalitions': {
+        'coalitions': [
+            {'update': 'GI UPDATE1', 'when': lambda df, p: df['action_plan_name'].isnull()},
+            {'update': 'GI UPDATE2', 'when': lambda df, p: df['program_area'] != 'SNAP-Ed'},
+            {'update': 'CUSTOM DATA TAB UPDATES', 'when': lambda df, p: df['snap_ed_grant_goals'].isnull()},
+        ],
+        'member counts': [
+            {'update': 'CM UPDATE1', 'when': lambda df, p: df['# of Members'].isnull() | (df['# of Members'] == 0)},
+        ],
+        'members': [
+            {'update': 'CM UPDATE2',
+             'when': lambda df, p: (df['type'] != 'Community members/individuals') & df['site_id'].isnull()},
+            {'update': 'CM UPDATE3',
+             'when': lambda df, p: utils.flag_individual_names(df['member_name'], p['il_names'],
+                                                               MEMBER_NAME_EXCLUDE_TERMS)},
+        ],
+    },
+    'Indirect Activities': {
+        'activities': [
+            {'update': 'CUSTOM DATA TAB UPDATES', 'notification': 'Notification1',
+             'when': lambda df, p: df.duplicated(subset=['reported_by_email', 'type'], keep=False)},
+            {'update': 'CUSTOM DATA TAB UPDATES', 'notification': 'Notification2',
+             'when': lambda df, p: df['snap_ed_grant_goals'].isnull()},
+        ],
+        'intervention channels': [
+            # Flag Intervention Channels that don't contain a date in their description
+            {'update': 'IC UPDATE1',
+             'when': lambda df, p: ~df['description'].str.contains('Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec')
+                                   & ~df['description'].str.contains(r'\d+/|-|.{1}\d{2,4}')},
+            # As of 3/18/22, Indirect Activity site is set to a required field in PEARS for Illinois Extension
+            # {'update': 'IC UPDATE2',
+            #  'when': lambda df, p: df['site_name'].isnull() | (df['site_name'] == 'abc placeholder')},
+            {'update': 'IC UPDATE3', 'when': lambda df, p: df['newly_reached'].notnull() & (df['newly_reached'] != 0)},
+            # Reach is null if there are no Intervention Channels for the Indirect Activity
+            {'update': 'IC UPDATE4', 'when': lambda df, p: df['reach'].isnull() | (df['reach'] == 0)},
+            {'update': 'IC UPDATE5',
+             'when': lambda df, p: df.duplicated(subset=['activity_id', 'description', 'site_id'], keep=False)},
+            {'update': 'IC UPDATE6', 'when': lambda df, p: df['channel'] == HARD_COPY_MATERIALS},
+        ],
+    },
+    'Partnerships': {
+        'partnerships': [
+            {'update': 'GI UPDATE1', 'when': lambda df, p: df['action_plan_name'].isnull()},
+            {'update': 'GI UPDATE2',
+             'when': lambda df, p: (df['is_direct_education_intervention'] == 0) & (df['is_pse_intervention'] == 0)},
+            {'update': 'GI UPDATE3', 'when': lambda df, p: df['program_area'] != 'SNAP-Ed'},
+            {'update': 'CUSTOM DATA TAB UPDATES', 'when': lambda df, p: df['snap_ed_grant_goals'].isnull()},
+            {'update': 'EVALUATION TAB UPDATES', 'when': lambda df, p: df['relationship_depth'].isnull()},
+        ],
+    },
+    'Program Activities': {
+        'sessions': [
+            {'update': 'GI UPDATE1',
+             'when': lambda df, p: df['start_date'].notnull()
+                                   & (utils.fiscal_calendar().assign_fiscal_year(df['start_date']) != p['fy'])},
+            {'update': 'GI UPDATE2', 'notification': 'Notification1',
+             'when': lambda df, p: (df['start_date_with_time'] < p['ts']) & df['num_participants'].isnull()},
+            {'update': 'GI UPDATE2', 'notification': 'Notification2',
+             'when': lambda df, p: (df['start_date_with_time'] < p['ts']) & (df['num_participants'] == 0)},
+            {'update': 'GI UPDATE3',
+             'when': lambda df, p: df.duplicated(subset=['program_id', 'start_date_with_time'], keep=False)},
+        ],
+        'activities': [
+            {'update': 'GI UPDATE4', 'when': lambda df, p: (df['length'] < 20) | df['length'].isnull()},
+        ],
+        'custom data': [
+            {'update': 'CUSTOM DATA TAB UPDATES', 'notification': 'Notification1',
+             'when': lambda df, p: df['snap_ed_grant_goals'].isnull()},
+            {'update': 'CUSTOM DATA TAB UPDATES', 'notification': 'Notification2',
+             'when': lambda df, p: df['snap_ed_special_projects'].str.contains('None')
+                                   & (df['snap_ed_special_projects'] != 'None')},
+            {'update': 'SCD UPDATE1', 'notification': 'Notification1',
+             'when': lambda df, p: df['intervention'].isnull()},
+            {'update': 'SCD UPDATE1', 'notification': 'Notification2',
+             'when': lambda df, p: df['intervention'] != 'SNAP-Ed Community Network'},
+            {'update': 'SCD UPDATE2',
+             'when': lambda df, p: df['setting'].str.contains('Other places people|Other settings people', na=False)},
+        ],
+        # Flag Program Activities where the unique participants is equal to the sum of session participants
+        # End of year:
+        # For entries with only 1 session, the total # of session participants should = total # of unique participants.
+        'demographics': [
+            {'update': 'DEMOGRAPHICS TAB UPDATES',
+             'when': lambda df, p: (df['# of Sessions'] > 1)
+                                   & (df['Total Session Participants'] == df['participants_total'])},
+        ],
+        'fcs': [
+            {'update': 'CUSTOM DATA TAB UPDATES',
+             'when': lambda df, p: df['fcs_program_team'].str.contains('SNAP-Ed') & df['fcs_grant_goals'].isnull()},
+        ],
+    },
+    'PSE Site Activities': {
+        'site activities': [
+            {'update': 'GI UPDATE1',
+             'when': lambda df, p: (df['start_fiscal_year'] != p['fy'])
+                                   & (df['planning_stage_sites_contacted_and_agreed_to_participate'] == 1)},
+            {'update': 'GI UPDATE2', 'when': lambda df, p: df['program_area'] == 'Family Consumer Science'},
+            {'update': 'GI UPDATE3',
+             'when': lambda df, p: df['site_id'].duplicated(keep=False) & (df['pse_unit'] != 'CPHP')},
+            {'update': 'GI UPDATE4', 'when': lambda df, p: df['intervention'] != 'SNAP-Ed Community Network'},
+            {'update': 'CUSTOM DATA TAB UPDATES', 'when': lambda df, p: df['snap_ed_grant_goals'].isnull()},
+        ],
+        'assessments': [
+            {'update': 'NRE UPDATE1',
+             'when': lambda df, p: (df['assessment_type'] == 'Needs assessment/environmental scan')
+                                   & df['baseline_score'].isnull()
+                                   & ~df['assessment_tool'].str.contains('SLAQ', na=False)},
+            {'update': 'NRE UPDATE2',
+             'when': lambda df, p: (df['assessment_type'] == 'Needs assessment/environmental scan')
+                                   & df['baseline_date'].isnull()},
+            {'update': 'NRE UPDATE3',
+             'when': lambda df, p: (df['assessment_type'] == 'Needs assessment/environmental scan')
+                                   & df['follow_up_date'].notnull() & df['follow_up_score'].isnull()},
+            {'update': 'NRE UPDATE4',
+             'when': lambda df, p: (df['assessment_type'] == 'Needs assessment/environmental scan')
+                                   & df['follow_up_date'].isnull() & df['follow_up_score'].notnull()},
+        ],
+        'changes': [
+            {'update': 'CHANGES ADOPTED TAB UPDATES',
+             'when': lambda df, p: df['change_id'].notnull() & df['total_reach'].isnull()},
+        ],
+    },
+}
+
+
+# Set Coalition data cleaning flags
+# coa_data: dataframe of Coalitions
+# coa_members: dataframe of Coalition Members
+# update_notes: dict of update notifications, see utils.load_update_notes()
+# il_names: set of names used to flag Coalition Members with individuals' names
+# timings: dict that rule runtimes are added to, see utils.evaluate_rules() (default: None)
+# returns a dataframe of Coalition Members merged with their flagged Coalitions
+def flag_coalitions(coa_data, coa_members, update_notes, il_names, timings=None):
+    rules = RULES['Coalitions']
+    params = {'il_names': il_names}
+
+    coa_data = coa_data.copy()
+    coa_data['GENERAL INFORMATION TAB UPDATES'] = np.nan
+    coa_data = utils.evaluate_rules(coa_data, 'Coalitions', rules['coalitions'], update_notes, params, timings)
+
+    # Concatenate General Information tab updates
+    coa_data = concat_updates(coa_data,
+                              concat_col='GENERAL INFORMATION TAB UPDATES',
+                              update_cols=['GI UPDATE1', 'GI UPDATE2'])
+
+    coa_data['COALITION MEMBERS TAB UPDATES'] = np.nan
+
+    # Count Coalition Members of each Coalition, flag Coalitions that have none
+    coa_data['CM UPDATE1'] = np.nan
+    coa_members_count = coa_members.groupby('coalition_id')['member_id'].count().reset_index(name='# of Members')
+    coa_data = pd.merge(coa_data, coa_members_count, how='left', on='coalition_id')
+    coa_data = utils.evaluate_rules(coa_data, 'Coalitions', rules['member counts'], update_notes, params, timings)
+
+    # Subsequent updates require Members data
+    coa_members_data = pd.merge(coa_data, coa_members, how='left', on='coalition_id').rename(
+        columns={'name': 'member_name'})
+    coa_members_data = utils.evaluate_rules(coa_members_data, 'Coalitions', rules['members'], update_notes, params,
+                                            timings)
+
+    # Concatenate Coalition Members tab updates
+    coa_members_data = concat_updates(coa_members_data,
+                                      concat_col='COALITION MEMBERS TAB UPDATES',
+                                      update_cols=['CM UPDATE1', 'CM UPDATE2', 'CM UPDATE3'])
+
+    return coa_members_data
+
+
+# Set Indirect Activity data cleaning flags
+# ia_data: dataframe of Indirect Activities
+# ia_ic: dataframe of Intervention Channels
+# update_notes: dict of update notifications, see utils.load_update_notes()
+# timings: dict that rule runtimes are added to, see utils.evaluate_rules() (default: None)
+# returns a dataframe of Intervention Channels merged with their flagged Indirect Activities
+def flag_indirect_activities(ia_data, ia_ic, update_notes, timings=None):
+    rules = RULES['Indirect Activities']
+
+    ia_data = utils.evaluate_rules(ia_data, 'Indirect Activities', rules['activities'], update_notes,
+                                   timings=timings)
+
+    ia_ic = ia_ic.copy()
+    ia_ic['INTERVENTION CHANNELS AND REACH TAB UPDATES'] = np.nan
+
+    # Subsequent updates require Intervention Channels data
+    ia_ic_data = pd.merge(ia_data, ia_ic, how='left', on='activity_id')
+    ia_ic_data['description'] = ia_ic_data['description'].astype(str)
+    ia_ic_data.loc[ia_ic_data['description'] == 'nan', 'description'] = ''
+    ia_ic_data['IC UPDATE1'] = np.nan
+    ia_ic_data['IC UPDATE2'] = np.nan
+    ia_ic_data = utils.evaluate_rules(ia_ic_data, 'Indirect Activities', rules['intervention channels'],
+                                      update_notes, timings=timings)
+
+    # Concatenate Intervention Channels and Reach tab updates
+    ia_ic_data = concat_updates(ia_ic_data,
+                                concat_col='INTERVENTION CHANNELS AND REACH TAB UPDATES',
+                                update_cols=['IC UPDATE1',
+                                             'IC UPDATE2',
+                                             'IC UPDATE3',
+                                             'IC UPDATE4',
+                                             'IC UPDATE5',
+                                             'IC UPDATE6'])
+
+    return ia_ic_data
+
+
+# Set Partnerships data cleaning flags
+# part_data: dataframe of Partnerships
+# update_notes: dict of update notifications, see utils.load_update_notes()
+# timings: dict that rule runtimes are added to, see utils.evaluate_rules() (default: None)
+# returns a dataframe of flagged Partnerships
+def flag_partnerships(part_data, update_notes, timings=None):
+    part_data = part_data.copy()
+    part_data['GENERAL INFORMATION TAB UPDATES'] = np.nan
+    part_data = utils.evaluate_rules(part_data, 'Partnerships', RULES['Partnerships']['partnerships'],
+                                     update_notes, timings=timings)
+
+    # Concatenate General Information tab updates
+    part_data = concat_updates(part_data,
+                               concat_col='GENERAL INFORMATION TAB UPDATES',
+                               update_cols=['GI UPDATE1', 'GI UPDATE2', 'GI UPDATE3'])
+
+    return part_data
+
+
+# Set Program Activities data cleaning flags
+# pa_data: dataframe of SNAP-Ed Program Activities
+# pa_sessions: dataframe of Program Activity Sessions
+# update_notes: dict of update notifications, see utils.load_update_notes()
+# ts: timestamp sessions are compared to when checking for missing participants
+# fy: int for the fiscal year of the report, sessions outside the fiscal year are flagged
+# timings: dict that rule runtimes are added to, see utils.evaluate_rules() (default: None)
+# returns a dataframe of Sessions merged with their flagged Program Activities
+def flag_program_activities(pa_data, pa_sessions, update_notes, ts, fy, timings=None):
+    rules = RULES['Program Activities']
+    params = {'ts': ts, 'fy': fy}
+
+    pa_sessions = pa_sessions.copy()
+    pa_sessions['GENERAL INFORMATION TAB UPDATES'] = np.nan
+    pa_sessions['start_date'] = pd.to_datetime(pa_sessions['start_date'])
+    pa_sessions = utils.evaluate_rules(pa_sessions, 'Program Activities', rules['sessions'], update_notes, params,
+                                       timings)
+
+    # Subsequent updates require Program Activity data
+    pa_sessions_data = pd.merge(pa_data, pa_sessions, how='left', on='program_id', suffixes=('_PA', '_Session'))
+    pa_sessions_data = utils.evaluate_rules(pa_sessions_data, 'Program Activities', rules['activities'],
+                                            update_notes, params, timings)
+
+    # Concatenate General Information tab updates
+    pa_sessions_data = concat_updates(pa_sessions_data,
+                                      concat_col='GENERAL INFORMATION TAB UPDATES',
+                                      update_cols=['GI UPDATE1', 'GI UPDATE2', 'GI UPDATE3', 'GI UPDATE4'])
+
+    pa_sessions_data['CUSTOM DATA TAB UPDATES'] = np.nan
+    pa_sessions_data['SNAP-ED CUSTOM DATA TAB UPDATES'] = np.nan
+    pa_sessions_data = utils.evaluate_rules(pa_sessions_data, 'Program Activities', rules['custom data'],
+                                            update_notes, params, timings)
+
+    # Concatenate Snap-Ed Custom Data tab updates
+    pa_sessions_data = concat_updates(pa_sessions_data,
+                                      concat_col='SNAP-ED CUSTOM DATA TAB UPDATES',
+                                      update_cols=['SCD UPDATE1', 'SCD UPDATE2'])
+
+    pa_sessions_data['DEMOGRAPHICS TAB UPDATES'] = np.nan
+    pa_sessions_metrics = pa_sessions.groupby('program_id').agg(
+        {'session_id': 'count',
+         'num_participants': 'sum'}).reset_index().rename(
+        columns={'session_id': '# of Sessions',
+                 'num_participants': 'Total Session Participants'})
+    pa_sessions_data = pd.merge(pa_sessions_data, pa_sessions_metrics, how='left', on='program_id')
+    pa_sessions_data = utils.evaluate_rules(pa_sessions_data, 'Program Activities', rules['demographics'],
+                                            update_notes, params, timings)
+
+    return pa_sessions_data
+
+
+# Set PSE Site Activity data cleaning flags
+# pse_data: dataframe of PSE Site Activities
+# pse_nre: dataframe of Needs, Readiness, Effectiveness assessments
+# pse_changes: dataframe of Changes
+# update_notes: dict of update notifications, see utils.load_update_notes()
+# fy: int for the fiscal year of the report
+# timings: dict that rule runtimes are added to, see utils.evaluate_rules() (default: None)
+# returns a dataframe of Needs, Readiness, Effectiveness and Changes merged with their flagged PSE Site Activities
+def flag_pse_site_activities(pse_data, pse_nre, pse_changes, update_notes, fy, timings=None):
+    rules = RULES['PSE Site Activities']
+    params = {'fy': fy}
+
+    pse_data = pse_data.copy()
+    pse_data['GENERAL INFORMATION TAB UPDATES'] = np.nan
+    pse_data = utils.evaluate_rules(pse_data, 'PSE Site Activities', rules['site activities'], update_notes, params,
+                                    timings)
+
+    # Concatenate General Information tab updates
+    pse_data = concat_updates(pse_data,
+                              concat_col='GENERAL INFORMATION TAB UPDATES',
+                              update_cols=['GI UPDATE1', 'GI UPDATE2', 'GI UPDATE3', 'GI UPDATE4'])
+
+    # Subsequent updates require Needs, Readiness, Effectiveness data
+    pse_nre_data = pd.merge(pse_data, pse_nre, how='left', on='pse_id')
+    pse_nre_data['NEEDS, READINESS & EFFECTIVENESS TAB UPDATES'] = np.nan
+    pse_nre_data['baseline_date'] = pd.to_datetime(pse_nre_data['baseline_date'])
+    pse_nre_data['follow_up_date'] = pd.to_datetime(pse_nre_data['follow_up_date'])
+    pse_nre_data = utils.evaluate_rules(pse_nre_data, 'PSE Site Activities', rules['assessments'], update_notes,
+                                        timings=timings)
+
+    # Concatenate Needs, Readiness, Effectiveness tab updates
+    pse_nre_data = concat_updates(pse_nre_data,
+                                  concat_col='NEEDS, READINESS & EFFECTIVENESS TAB UPDATES',
+                                  update_cols=['NRE UPDATE1', 'NRE UPDATE2', 'NRE UPDATE3', 'NRE UPDATE4'])
+
+    # Subsequent updates require Changes Adopted data
+    pse_nre_changes_data = pd.merge(pse_nre_data, pse_changes[['pse_id', 'change_id']], how='left',
+                                    on='pse_id').drop_duplicates(subset=['pse_id', 'assessment_id'])
+    pse_nre_changes_data = utils.evaluate_rules(pse_nre_changes_data, 'PSE Site Activities', rules['changes'],
+                                                update_notes, timings=timings)
+
+    return pse_nre_changes_data
 
 
 # Run the Monthly Data Cleaning report
@@ -140,6 +447,10 @@ def write_corrections_report(report_dict, file_path):
 # former_staff_recipients: list-like string of email addresses for recipients of the former staff corrections email
 # report_cc: list-like string of email addresses to cc on the report email
 # report_recipients: list-like string of email addresses for recipients of the report email
+# snapshot_dir: directory of snapshots of the previous run's flags, None flags every record (default: None)
+# rule_timings: dict that data cleaning rule runtimes are added to, see utils.evaluate_rules()
+# (default: None, a new dict), the runtimes are printed at the end of the run
+# fy: int for the fiscal year of the records to clean (default: the fiscal year of the report month)
 def main(creds,
          coalitions_export,
          indirect_activities_export,
@@ -155,41 +466,27 @@ def main(creds,
          notification_cc='',
          former_staff_recipients='',
          report_cc='',
-         report_recipients=''):
+         report_recipients='',
+         snapshot_dir=None,
+         rule_timings=None,
+         fy=None):
+
+    # Time every data cleaning rule, slow rules are listed at the end of the run
+    if rule_timings is None:
+        rule_timings = {}
+
+    # Import Update Notifications, used for the Corrections Report
+    # Every notification referenced by a rule is validated before any exports are read
+    update_notes = utils.load_update_notes(update_notifications,
+                                           'Monthly Data Cleaning',
+                                           required=[note for module, stages in RULES.items()
+                                                     for rules in stages.values()
+                                                     for note in utils.rule_update_notes(module, rules)])
 
     # Import and consolidate staff lists
     # Data cleaning is only conducted on records related to SNAP-Ed and Family Consumer Science programming
 
-    fy22_inep_staff = pd.ExcelFile(staff_list)
-    # Adjust header argument in following lines for actual staff list
-    snap_ed_staff = pd.read_excel(fy22_inep_staff, sheet_name='SNAP-Ed Staff List', header=0)
-    heat_staff = pd.read_excel(fy22_inep_staff, sheet_name='HEAT Project Staff', header=0)
-    state_staff = pd.read_excel(fy22_inep_staff, sheet_name='FCS State Office', header=0)
-    staff_cols = ['NAME', 'E-MAIL']
-    staff_dfs = [snap_ed_staff[staff_cols], heat_staff[staff_cols], state_staff[staff_cols]]
-    inep_staff = pd.concat(staff_dfs, ignore_index=True).rename(columns={'E-MAIL': 'email'})
-    inep_staff = inep_staff.loc[~inep_staff.isnull().any(1)]
-    inep_staff = reorder_name(inep_staff, 'NAME', 'full_name')
-    cphp_staff = pd.read_excel(fy22_inep_staff, sheet_name='CPHP Staff List', header=0).rename(
-        columns={'Last Name': 'last_name',
-                 'First Name': 'first_name',
-                 'Email Address': 'email'})
-    cphp_staff['full_name'] = cphp_staff['first_name'].map(str) + ' ' + cphp_staff['last_name'].map(str)
-    staff = inep_staff.drop(columns='NAME').append(cphp_staff.loc[~cphp_staff['email'].isnull(),
-                                                                  ['email', 'first_name', 'last_name', 'full_name']],
-                                                   ignore_index=True).drop_duplicates()
-
-    # Create lookup table for unit to regional educators
-    re_lookup = pd.read_excel(fy22_inep_staff, sheet_name="RE's and CD's")[['UNIT #', 'REGIONAL EDUCATOR', 'RE E-MAIL']]
-    re_lookup['REGIONAL EDUCATOR'] = re_lookup['REGIONAL EDUCATOR'].str.replace(', Interim', '')
-    re_lookup = re_lookup.drop_duplicates()
-    re_lookup = reorder_name(re_lookup, 'REGIONAL EDUCATOR', 'REGIONAL EDUCATOR', drop_substr_fields=True)
-    re_lookup['UNIT #'] = re_lookup['UNIT #'].astype(str)
-
-    # Import list of former staff
-    # Used to send former staff's updates to evaluation team
-    former_snap_ed_staff = pd.read_excel(fy22_inep_staff, sheet_name='Former Staff')
-    former_snap_ed_staff['email'] = former_snap_ed_staff['NETID'].map(str) + '@illinois.edu'
+    roster = utils.load_staff_roster(staff_list)
 
     # Import lookup table for counties to unit
     unit_counties = pd.read_excel(unit_counties)
@@ -201,71 +498,73 @@ def main(creds,
                            'snap_ed_special_projects']
 
     # Import Coalitions data and Coalition Members
-    coalitions_export = pd.ExcelFile(coalitions_export)
-    coa_data = pd.read_excel(coalitions_export, 'Coalition Data')
+    coa_data = utils.read_export(coalitions_export, 'Coalition Data')
     coa_data = utils.reformat(coa_data, custom_field_labels)
     # Only data clean records for SNAP-Ed
     # SNAP-Ed staff occasionally select the wrong program_area for Coalitions
     coa_data = coa_data.loc[(coa_data['program_area'] == 'SNAP-Ed') |
-                            (coa_data['reported_by_email'].isin(snap_ed_staff['E-MAIL'])) |
+                            (coa_data['reported_by_email'].isin(roster.snap_ed_staff['E-MAIL'])) |
                             (coa_data['reported_by_email'].isin(
-                                former_snap_ed_staff['email']))]  # Filtering for former staff will include transfers
-    coa_members = pd.read_excel(coalitions_export, 'Members')
+                                roster.former_staff_emails))]  # Filtering for former staff will include transfers
+    coa_members = utils.read_export(coalitions_export, 'Members')
 
     # Import list of Illinois names, used to flag Coalition Members with individual's names
     # Source: https://www.ssa.gov/oact/babynames/state/
-    il_names = pd.read_csv(names_list,
-                           delimiter=",",
-                           names=['state', 'sex', 'year', 'name', 'frequency'])
-    il_names = il_names['name'].drop_duplicates()
-    il_names = il_names.astype(str) + ' '
+    il_names = utils.load_names(names_list)
 
     # Import Indirect Activity data and Intervention Channels
-    indirect_activities_export = pd.ExcelFile(indirect_activities_export)
-    ia_data = pd.read_excel(indirect_activities_export, 'Indirect Activity Data')
+    ia_data = utils.read_export(indirect_activities_export, 'Indirect Activity Data')
     ia_data = utils.reformat(ia_data, custom_field_labels)
     # Only data clean records for SNAP-Ed
     ia_data = ia_data.loc[ia_data['program_area'] == 'SNAP-Ed']
-    ia_ic = pd.read_excel(indirect_activities_export, 'Intervention Channels')
+    ia_ic = utils.read_export(indirect_activities_export, 'Intervention Channels')
 
     # Import Partnerships data
-    partnerships_export = pd.ExcelFile(partnerships_export)
-    part_data = pd.read_excel(partnerships_export, 'Partnership Data')
+    part_data = utils.read_export(partnerships_export, 'Partnership Data')
     part_data = utils.reformat(part_data, custom_field_labels)
     # Only data clean records for SNAP-Ed
     # SNAP-Ed staff occasionally select the wrong program_area for Partnerships
     part_data = part_data.loc[(part_data['program_area'] == 'SNAP-Ed') |
-                              (part_data['reported_by_email'].isin(snap_ed_staff['E-MAIL'])) |
+                              (part_data['reported_by_email'].isin(roster.snap_ed_staff['E-MAIL'])) |
                               (part_data['reported_by_email'].isin(
-                                  former_snap_ed_staff['email']))]  # Filtering for former staff will include transfers
+                                  roster.former_staff_emails))]  # Filtering for former staff will include transfers
 
     # Import Program Activity data and Sessions
-    program_activities_export = pd.ExcelFile(program_activities_export)
-    pa_data = pd.read_excel(program_activities_export, 'Program Activity Data')
+    pa_data = utils.read_export(program_activities_export, 'Program Activity Data')
     pa_data = utils.reformat(pa_data, custom_field_labels)
     # Subset Program Activities for Family Consumer Science
     pa_data_fcs = pa_data.loc[pa_data['program_areas'].str.contains('Family Consumer Science')]
     # Subset Program Activities for SNAP-Ed
     pa_data = pa_data.loc[pa_data['program_areas'].str.contains('SNAP-Ed')]
-    pa_sessions = pd.read_excel(program_activities_export, 'Sessions')
+    pa_sessions = utils.read_export(program_activities_export, 'Sessions')
 
     # Import PSE Site Activity data, Needs, Readiness, Effectiveness, and Changes
-    pse_site_activities_export = pd.ExcelFile(pse_site_activities_export)
-    pse_data = pd.read_excel(pse_site_activities_export, 'PSE Data')
+    pse_data = utils.read_export(pse_site_activities_export, 'PSE Data')
     pse_data = utils.reformat(pse_data, custom_field_labels)
-    pse_nre = pd.read_excel(pse_site_activities_export, 'Needs, Readiness, Effectiveness')
-    pse_changes = pd.read_excel(pse_site_activities_export, 'Changes')
-
-    # Import Update Notifications, used for the Corrections Report
-    update_notes = pd.read_excel(update_notifications,
-                                 sheet_name='Monthly Data Cleaning').drop(columns=['Tab'])
+    pse_nre = utils.read_export(pse_site_activities_export, 'Needs, Readiness, Effectiveness')
+    pse_changes = utils.read_export(pse_site_activities_export, 'Changes')
 
     # Monthly PEARS Data Cleaning
 
-    # Timestamp and report year bounds used to filter data to clean
+    # Timestamp and fiscal year used to filter data to clean
     ts = pd.to_datetime("today")
-    report_year_start = '10/01/2021'
-    report_year_end = '09/30/2022'
+    fy = utils.fiscal_calendar().fy if fy is None else fy
+
+    # Only records that changed since the previous run are flagged when snapshot_dir is set
+    # Snapshots are discarded if this report, the shared rule logic in utils,
+    # the pandas version, or any input other than the PEARS exports has changed
+    context = (utils.file_hash(__file__),
+               utils.file_hash(utils.__file__),
+               utils.file_hash(utils.CUSTOM_FIELD_VALUES),
+               pd.__version__,
+               utils.file_hash(update_notifications),
+               utils.file_hash(names_list),
+               str(fy))
+
+    def snapshot_file(module):
+        if snapshot_dir is None:
+            return None
+        return os.path.join(snapshot_dir, 'monthly_data_cleaning_' + module.lower().replace(' ', '_') + '.pkl')
 
     # Coalitions
 
@@ -286,60 +585,12 @@ def main(creds,
                              'snap_ed_grant_goals']]
 
     # Set Coalition data cleaning flags
-
-    coa_data['GENERAL INFORMATION TAB UPDATES'] = np.nan
-
-    coa_data['GI UPDATE1'] = np.nan
-    coa_data.loc[coa_data['action_plan_name'].isnull(),
-                 'GI UPDATE1'] = utils.get_update_note(update_notes, module='Coalitions', update='GI UPDATE1')
-
-    coa_data['GI UPDATE2'] = np.nan
-    coa_data.loc[coa_data['program_area'] != 'SNAP-Ed',
-                 'GI UPDATE2'] = utils.get_update_note(update_notes, module='Coalitions', update='GI UPDATE2')
-
-    # Concatenate General Information tab updates
-    coa_data = concat_updates(coa_data,
-                              concat_col='GENERAL INFORMATION TAB UPDATES',
-                              update_cols=['GI UPDATE1', 'GI UPDATE2'])
-
-    coa_data['CUSTOM DATA TAB UPDATES'] = np.nan
-    coa_data.loc[coa_data['snap_ed_grant_goals'].isnull(),
-                 'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                    module='Coalitions',
-                                                                    update='CUSTOM DATA TAB UPDATES')
-
-    coa_data['COALITION MEMBERS TAB UPDATES'] = np.nan
-
-    # Count Coalition Members of each Coalition, flag Coalitions that have none
-    coa_data['CM UPDATE1'] = np.nan
-    coa_members_count = coa_members.groupby('coalition_id')['member_id'].count().reset_index(name='# of Members')
-    coa_data = pd.merge(coa_data, coa_members_count, how='left', on='coalition_id')
-    coa_data.loc[(coa_data['# of Members'].isnull()) | (coa_data['# of Members'] == 0),
-                 'CM UPDATE1'] = utils.get_update_note(update_notes, module='Coalitions', update='CM UPDATE1')
-
-    # Subsequent updates require Members data
-    coa_members_data = pd.merge(coa_data, coa_members, how='left', on='coalition_id').rename(
-        columns={'name': 'member_name'})
-
-    coa_members_data['CM UPDATE2'] = np.nan
-    coa_members_data.loc[
-        (coa_members_data['type'] != 'Community members/individuals') & (coa_members_data['site_id'].isnull()),
-        'CM UPDATE2'] = utils.get_update_note(update_notes, module='Coalitions', update='CM UPDATE2')
-
-    # Flag Coalition Members that contain individuals' names
-    coa_members_data['CM UPDATE3'] = np.nan
-    # Terms indicating false positives
-    exclude_terms = ['University', 'Hospital', 'YMCA', 'Center', 'County', 'Elementary', 'Foundation', 'Church', 'Club',
-                     'Daycare', 'Housing', 'SNAP-Ed']
-    coa_members_data.loc[(coa_members_data['member_name'].str.contains('|'.join(il_names), na=False)) &
-                         (coa_members_data['member_name'].str.count(' ') == 1) &
-                         (~coa_members_data['member_name'].str.contains('|'.join(exclude_terms), na=False)),
-                         'CM UPDATE3'] = utils.get_update_note(update_notes, module='Coalitions', update='CM UPDATE3')
-
-    # Concatenate Coalition Members tab updates
-    coa_members_data = concat_updates(coa_members_data,
-                                      concat_col='COALITION MEMBERS TAB UPDATES',
-                                      update_cols=['CM UPDATE1', 'CM UPDATE2', 'CM UPDATE3'])
+    coa_members_data = utils.incremental_flags(coa_data, 'coalition_id',
+                                               partial(flag_coalitions, update_notes=update_notes, il_names=il_names,
+                                                       timings=rule_timings),
+                                               children=[coa_members],
+                                               snapshot_file=snapshot_file('Coalitions'),
+                                               context=context)
 
     # Subset records that require updates
     coa_corrections = coa_members_data.loc[coa_members_data.filter(like='UPDATE').notnull().any(1)]
@@ -391,21 +642,6 @@ def main(creds,
                            'type',
                            'snap_ed_grant_goals']]
 
-    # Set Indirect Activity data cleaning flags
-
-    ia_data['CUSTOM DATA TAB UPDATES'] = np.nan
-
-    ia_data.loc[ia_data.duplicated(subset=['reported_by_email', 'type'], keep=False),
-                'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                   module='Indirect Activities',
-                                                                   update='CUSTOM DATA TAB UPDATES',
-                                                                   notification='Notification1')
-    ia_data.loc[ia_data['snap_ed_grant_goals'].isnull(),
-                'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                   module='Indirect Activities',
-                                                                   update='CUSTOM DATA TAB UPDATES',
-                                                                   notification='Notification2')
-
     # Filter out test records, select relevant columns
     ia_ic = ia_ic.loc[~ia_ic['activity'].str.contains('(?i)TEST', regex=True),
                       ['activity_id',
@@ -417,67 +653,13 @@ def main(creds,
                        'site_name',
                        'reach',
                        'newly_reached']]
-    ia_ic['INTERVENTION CHANNELS AND REACH TAB UPDATES'] = np.nan
-
-    # Subsequent updates require Intervention Channels data
-    ia_ic_data = pd.merge(ia_data, ia_ic, how='left', on='activity_id')
-
-    # Flag Intervention Channels that don't contain a date in their description
-    ia_ic_data['IC UPDATE1'] = np.nan
-    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-    ia_ic_data['description'] = ia_ic_data['description'].astype(str)
-    ia_ic_data.loc[ia_ic_data['description'] == 'nan', 'description'] = ''
-    ia_ic_data.loc[~ia_ic_data['description'].str.contains('|'.join(months)) & ~ia_ic_data['description'].str.contains(
-        r'\d+/|-|.{1}\d{2,4}'),
-                   'IC UPDATE1'] = utils.get_update_note(update_notes,
-                                                         module='Indirect Activities',
-                                                         update='IC UPDATE1')
-
-    ia_ic_data['IC UPDATE2'] = np.nan
-    # ia_ic_data.loc[(ia_ic_data['site_name'].isnull()) | (ia_ic_data['site_name'] == 'abc placeholder'),
-    #                'IC UPDATE2'] = utils.get_update_note(update_notes,
-    #                module='Indirect Activities',
-    #                update='IC UPDATE2')
-    # As of 3/18/22, Indirect Activity site is set to a required field in PEARS for Illinois Extension
-
-    ia_ic_data['IC UPDATE3'] = np.nan
-    ia_ic_data.loc[(ia_ic_data['newly_reached'].notnull())
-                   & (ia_ic_data['newly_reached'] != 0),
-                   'IC UPDATE3'] = utils.get_update_note(update_notes,
-                                                         module='Indirect Activities',
-                                                         update='IC UPDATE3')
-
-    ia_ic_data['IC UPDATE4'] = np.nan
-    ia_ic_data.loc[(ia_ic_data['reach'].isnull()) | (ia_ic_data['reach'] == 0),
-                   'IC UPDATE4'] = utils.get_update_note(update_notes,
-                                                         module='Indirect Activities',
-                                                         update='IC UPDATE4')
-    # How are null reach values possible?
-    # Reach is null if there are no Intervention Channels for the Indirect Activity
-
-    ia_ic_data['IC UPDATE5'] = np.nan
-    ia_ic_data.loc[ia_ic_data.duplicated(subset=['activity_id', 'description', 'site_id'], keep=False),
-                   'IC UPDATE5'] = utils.get_update_note(update_notes,
-                                                         module='Indirect Activities',
-                                                         update='IC UPDATE5')
-
-    ia_ic_data['IC UPDATE6'] = np.nan
-    hard_copy_materials = "Hard copy materials (e.g. flyers, pamphlets, activity books, posters, banners, postcards, " \
-                          "recipe cards, or newsletters for mailings)"
-    ia_ic_data.loc[ia_ic_data['channel'] == hard_copy_materials,
-                   'IC UPDATE6'] = utils.get_update_note(update_notes,
-                                                         module='Indirect Activities',
-                                                         update='IC UPDATE6')
-
-    # Concatenate Intervention Channels and Reach tab updates
-    ia_ic_data = concat_updates(ia_ic_data,
-                                concat_col='INTERVENTION CHANNELS AND REACH TAB UPDATES',
-                                update_cols=['IC UPDATE1',
-                                             'IC UPDATE2',
-                                             'IC UPDATE3',
-                                             'IC UPDATE4',
-                                             'IC UPDATE5',
-                                             'IC UPDATE6'])
+    # Set Indirect Activity data cleaning flags
+    ia_ic_data = utils.incremental_flags(ia_data, 'activity_id',
+                                         partial(flag_indirect_activities, update_notes=update_notes, timings=rule_timings),
+                                         children=[ia_ic],
+                                         snapshot_file=snapshot_file('Indirect Activities'),
+                                         context=context,
+                                         group_cols=[['reported_by_email', 'type']])
 
     # Subset records that require updates
     ia_corrections = ia_ic_data.loc[ia_ic_data.filter(like='UPDATE').notnull().any(1)]
@@ -529,37 +711,10 @@ def main(creds,
                                'snap_ed_grant_goals']]
 
     # Set Partnerships data cleaning flags
-
-    part_data['GENERAL INFORMATION TAB UPDATES'] = np.nan
-
-    part_data['GI UPDATE1'] = np.nan
-    part_data.loc[part_data['action_plan_name'].isnull(),
-                  'GI UPDATE1'] = utils.get_update_note(update_notes, module='Partnerships', update='GI UPDATE1')
-
-    part_data['GI UPDATE2'] = np.nan
-    part_data.loc[(part_data['is_direct_education_intervention'] == 0) & (part_data['is_pse_intervention'] == 0),
-                  'GI UPDATE2'] = utils.get_update_note(update_notes, module='Partnerships', update='GI UPDATE2')
-
-    part_data['GI UPDATE3'] = np.nan
-    part_data.loc[part_data['program_area'] != 'SNAP-Ed',
-                  'GI UPDATE3'] = utils.get_update_note(update_notes, module='Partnerships', update='GI UPDATE3')
-
-    # Concatenate General Information tab updates
-    part_data = concat_updates(part_data,
-                               concat_col='GENERAL INFORMATION TAB UPDATES',
-                               update_cols=['GI UPDATE1', 'GI UPDATE2', 'GI UPDATE3'])
-
-    part_data['CUSTOM DATA TAB UPDATES'] = np.nan
-    part_data.loc[part_data['snap_ed_grant_goals'].isnull(),
-                  'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                     module='Partnerships',
-                                                                     update='CUSTOM DATA TAB UPDATES')
-
-    part_data['EVALUATION TAB UPDATES'] = np.nan
-    part_data.loc[part_data['relationship_depth'].isnull(),
-                  'EVALUATION TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                    module='Partnerships',
-                                                                    update='EVALUATION TAB UPDATES')
+    part_data = utils.incremental_flags(part_data, 'partnership_id',
+                                        partial(flag_partnerships, update_notes=update_notes, timings=rule_timings),
+                                        snapshot_file=snapshot_file('Partnerships'),
+                                        context=context)
 
     # Subset records that require updates
     part_corrections = part_data.loc[part_data.filter(like='UPDATE').notnull().any(1)]
@@ -584,8 +739,6 @@ def main(creds,
 
     # Program Activities
 
-    # Set Program Activities data cleaning flags
-
     # Select relevant columns
     pa_sessions = pa_sessions.loc[:, ['session_id',
                                       'program_id',
@@ -594,35 +747,6 @@ def main(creds,
                                       'length',
                                       'num_participants']]
 
-    pa_sessions['GENERAL INFORMATION TAB UPDATES'] = np.nan
-
-    pa_sessions['GI UPDATE1'] = np.nan
-    pa_sessions['start_date'] = pd.to_datetime(pa_sessions['start_date'])
-    pa_sessions.loc[(pa_sessions['start_date'] < report_year_start) | (pa_sessions['start_date'] > report_year_end),
-                    'GI UPDATE1'] = utils.get_update_note(update_notes,
-                                                          module='Program Activities',
-                                                          update='GI UPDATE1')
-
-    pa_sessions['GI UPDATE2'] = np.nan
-    pa_sessions.loc[(pa_sessions['start_date_with_time'] < ts)
-                    & (pa_sessions['num_participants'].isnull()),
-                    'GI UPDATE2'] = utils.get_update_note(update_notes,
-                                                          module='Program Activities',
-                                                          update='GI UPDATE2',
-                                                          notification='Notification1')
-    pa_sessions.loc[(pa_sessions['start_date_with_time'] < ts)
-                    & (pa_sessions['num_participants'] == 0),
-                    'GI UPDATE2'] = utils.get_update_note(update_notes,
-                                                          module='Program Activities',
-                                                          update='GI UPDATE2',
-                                                          notification='Notification2')
-
-    pa_sessions['GI UPDATE3'] = np.nan
-    pa_sessions.loc[pa_sessions.duplicated(subset=['program_id', 'start_date_with_time'], keep=False),
-                    'GI UPDATE3'] = utils.get_update_note(update_notes,
-                                                          module='Program Activities',
-                                                          update='GI UPDATE3')
-
     # Convert counties to units for use in update notification email
     pa_data = utils.counties_to_units(data=pa_data, unit_field='unit', unit_counties=unit_counties)
 
@@ -647,82 +771,22 @@ def main(creds,
                            'snap_ed_grant_goals',
                            'snap_ed_special_projects']]
 
-    # Subsequent updates require Program Activity data
-    pa_sessions_data = pd.merge(pa_data, pa_sessions, how='left', on='program_id', suffixes=('_PA', '_Session'))
-
-    pa_sessions_data['GI UPDATE4'] = np.nan
-    pa_sessions_data.loc[(pa_sessions_data['length'] < 20) | (pa_sessions_data['length'].isnull()),
-                         'GI UPDATE4'] = utils.get_update_note(update_notes,
-                                                               module='Program Activities',
-                                                               update='GI UPDATE4')
-
-    # Concatenate General Information tab updates
-    pa_sessions_data = concat_updates(pa_sessions_data,
-                                      concat_col='GENERAL INFORMATION TAB UPDATES',
-                                      update_cols=['GI UPDATE1', 'GI UPDATE2', 'GI UPDATE3', 'GI UPDATE4'])
-
-    pa_sessions_data['CUSTOM DATA TAB UPDATES'] = np.nan
-    pa_sessions_data.loc[pa_sessions_data['snap_ed_grant_goals'].isnull(),
-                         'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                            module='Program Activities',
-                                                                            update='CUSTOM DATA TAB UPDATES',
-                                                                            notification='Notification1')
-    pa_sessions_data.loc[(pa_sessions_data['snap_ed_special_projects'].str.contains('None'))
-                         & (pa_sessions_data['snap_ed_special_projects'] != 'None'),
-                         'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                            module='Program Activities',
-                                                                            update='CUSTOM DATA TAB UPDATES',
-                                                                            notification='Notification2')
-
-    pa_sessions_data['SNAP-ED CUSTOM DATA TAB UPDATES'] = np.nan
-
-    pa_sessions_data['SCD UPDATE1'] = np.nan
-    pa_sessions_data.loc[pa_sessions_data['intervention'].isnull(),
-                         'SCD UPDATE1'] = utils.get_update_note(update_notes,
-                                                                module='Program Activities',
-                                                                update='SCD UPDATE1',
-                                                                notification='Notification1')
-    pa_sessions_data.loc[pa_sessions_data['intervention'] != 'SNAP-Ed Community Network',
-                         'SCD UPDATE1'] = utils.get_update_note(update_notes,
-                                                                module='Program Activities',
-                                                                update='SCD UPDATE1',
-                                                                notification='Notification2')
-
-    pa_sessions_data['SCD UPDATE2'] = np.nan
-    settings_other = ['Other places people', 'Other settings people']
-    pa_sessions_data.loc[pa_sessions_data['setting'].str.contains('|'.join(settings_other), na=False),
-                         'SCD UPDATE2'] = utils.get_update_note(update_notes,
-                                                                module='Program Activities',
-                                                                update='SCD UPDATE2')
-
-    # Concatenate Snap-Ed Custom Data tab updates
-    pa_sessions_data = concat_updates(pa_sessions_data,
-                                      concat_col='SNAP-ED CUSTOM DATA TAB UPDATES',
-                                      update_cols=['SCD UPDATE1', 'SCD UPDATE2'])
-
-    # Flag Program Activities where the unique participants is equal to the sum of session participants
-    pa_sessions_data['DEMOGRAPHICS TAB UPDATES'] = np.nan
-    pa_sessions_metrics = pa_sessions.groupby('program_id').agg(
-        {'session_id': 'count',
-         'num_participants': 'sum'}).reset_index().rename(
-        columns={'session_id': '# of Sessions',
-                 'num_participants': 'Total Session Participants'})
-    pa_sessions_data = pd.merge(pa_sessions_data, pa_sessions_metrics, how='left', on='program_id')
-    pa_sessions_data.loc[(pa_sessions_data['# of Sessions'] > 1) &
-                         (pa_sessions_data['Total Session Participants'] == pa_sessions_data['participants_total']),
-                         'DEMOGRAPHICS TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                             module='Program Activities',
-                                                                             update='DEMOGRAPHICS TAB UPDATES')
-    # End of year:
-    # For entries with only 1 session, the total # of session participants should = total # of unique participants.
+    # Set Program Activities data cleaning flags
+    pa_sessions_data = utils.incremental_flags(pa_data, 'program_id',
+                                               partial(flag_program_activities,
+                                                       update_notes=update_notes,
+                                                       ts=ts,
+                                                       fy=fy,
+                                                       timings=rule_timings),
+                                               children=[pa_sessions],
+                                               snapshot_file=snapshot_file('Program Activities'),
+                                               context=context,
+                                               time_cols=['start_date_with_time'],
+                                               ts=ts)
 
     # Data clean FCS Program Activities
-    pa_data_fcs['CUSTOM DATA TAB UPDATES'] = np.nan
-    pa_data_fcs.loc[(pa_data_fcs['fcs_program_team'].str.contains('SNAP-Ed'))
-                    & (pa_data_fcs['fcs_grant_goals'].isnull()),
-                    'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                       module='Program Activities',
-                                                                       update='CUSTOM DATA TAB UPDATES')
+    pa_data_fcs = utils.evaluate_rules(pa_data_fcs, 'Program Activities', RULES['Program Activities']['fcs'],
+                                       update_notes, timings=rule_timings)
 
     # Append FCS Program Activities to SNAP-Ed Program Activities
     add_cols = pa_sessions_data.columns[~pa_sessions_data.columns.isin(pa_data_fcs.columns)].tolist()
@@ -791,39 +855,6 @@ def main(creds,
          'intervention',
          'snap_ed_grant_goals']]
 
-    # Set PSE data cleaning flags
-
-    pse_data['GENERAL INFORMATION TAB UPDATES'] = np.nan
-
-    pse_data['GI UPDATE1'] = np.nan
-    pse_data.loc[(pse_data['start_fiscal_year'] != 2022) & (
-            pse_data['planning_stage_sites_contacted_and_agreed_to_participate'] == 1),
-                 'GI UPDATE1'] = utils.get_update_note(update_notes, module='PSE Site Activities', update='GI UPDATE1')
-
-    pse_data['GI UPDATE2'] = np.nan
-    pse_data.loc[pse_data['program_area'] == 'Family Consumer Science',
-                 'GI UPDATE2'] = utils.get_update_note(update_notes, module='PSE Site Activities', update='GI UPDATE2')
-
-    pse_data['GI UPDATE3'] = np.nan
-    pse_data.loc[(pse_data['site_id'].duplicated(keep=False))
-                 & (pse_data['pse_unit'] != 'CPHP'),
-                 'GI UPDATE3'] = utils.get_update_note(update_notes, module='PSE Site Activities', update='GI UPDATE3')
-
-    pse_data['GI UPDATE4'] = np.nan
-    pse_data.loc[pse_data['intervention'] != 'SNAP-Ed Community Network',
-                 'GI UPDATE4'] = utils.get_update_note(update_notes, module='PSE Site Activities', update='GI UPDATE4')
-
-    # Concatenate General Information tab updates
-    pse_data = concat_updates(pse_data,
-                              concat_col='GENERAL INFORMATION TAB UPDATES',
-                              update_cols=['GI UPDATE1', 'GI UPDATE2', 'GI UPDATE3', 'GI UPDATE4'])
-
-    pse_data['CUSTOM DATA TAB UPDATES'] = np.nan
-    pse_data.loc[pse_data['snap_ed_grant_goals'].isnull(),
-                 'CUSTOM DATA TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                    module='PSE Site Activities',
-                                                                    update='CUSTOM DATA TAB UPDATES')
-
     # Select relevant Needs, Readiness, Effectiveness columns
     pse_nre = pse_nre.loc[:, ['pse_id',
                               'assessment_id',
@@ -834,60 +865,14 @@ def main(creds,
                               'follow_up_date',
                               'follow_up_score']]
 
-    # Subsequent updates require Needs, Readiness, Effectiveness data
-    pse_nre_data = pd.merge(pse_data, pse_nre, how='left', on='pse_id')
-
-    pse_nre_data['NEEDS, READINESS & EFFECTIVENESS TAB UPDATES'] = np.nan
-
-    pse_nre_data['NRE UPDATE1'] = np.nan
-    pse_nre_data.loc[(pse_nre_data['assessment_type'] == 'Needs assessment/environmental scan')
-                     & (pse_nre_data['baseline_score'].isnull())
-                     & (~pse_nre_data['assessment_tool'].str.contains('SLAQ', na=False)),
-                     'NRE UPDATE1'] = utils.get_update_note(update_notes,
-                                                            module='PSE Site Activities',
-                                                            update='NRE UPDATE1')
-
-    pse_nre_data['NRE UPDATE2'] = np.nan
-    pse_nre_data['baseline_date'] = pd.to_datetime(pse_nre_data['baseline_date'])
-    pse_nre_data.loc[(pse_nre_data['assessment_type'] == 'Needs assessment/environmental scan')
-                     & (pse_nre_data['baseline_date'].isnull()),
-                     'NRE UPDATE2'] = utils.get_update_note(update_notes,
-                                                            module='PSE Site Activities',
-                                                            update='NRE UPDATE2')
-
-    pse_nre_data['NRE UPDATE3'] = np.nan
-    pse_nre_data['follow_up_date'] = pd.to_datetime(pse_nre_data['follow_up_date'])
-    pse_nre_data.loc[(pse_nre_data['assessment_type'] == 'Needs assessment/environmental scan')
-                     & (pse_nre_data['follow_up_date'].notnull())
-                     & (pse_nre_data['follow_up_score'].isnull()),
-                     'NRE UPDATE3'] = utils.get_update_note(update_notes,
-                                                            module='PSE Site Activities',
-                                                            update='NRE UPDATE3')
-
-    pse_nre_data['NRE UPDATE4'] = np.nan
-    pse_nre_data.loc[(pse_nre_data['assessment_type'] == 'Needs assessment/environmental scan')
-                     & (pse_nre_data['follow_up_date'].isnull())
-                     & (pse_nre_data['follow_up_score'].notnull()),
-                     'NRE UPDATE4'] = utils.get_update_note(update_notes,
-                                                            module='PSE Site Activities',
-                                                            update='NRE UPDATE4')
-
-    # Concatenate Needs, Readiness, Effectiveness tab updates
-    pse_nre_data = concat_updates(pse_nre_data,
-                                  concat_col='NEEDS, READINESS & EFFECTIVENESS TAB UPDATES',
-                                  update_cols=['NRE UPDATE1', 'NRE UPDATE2', 'NRE UPDATE3', 'NRE UPDATE4'])
-
-    # Subsequent updates require Changes Adopted data
-    pse_nre_changes_data = pd.merge(pse_nre_data, pse_changes[['pse_id', 'change_id']], how='left',
-                                    on='pse_id').drop_duplicates(subset=['pse_id', 'assessment_id'])
-
-    pse_nre_changes_data['CHANGES ADOPTED TAB UPDATES'] = np.nan
-    pse_nre_changes_data.loc[(pse_nre_changes_data['change_id'].notnull())
-                             & (pse_nre_changes_data['total_reach'].isnull()),
-                             'CHANGES ADOPTED TAB UPDATES'] = utils.get_update_note(update_notes,
-                                                                                    module='PSE Site Activities',
-                                                                                    update='CHANGES ADOPTED '
-                                                                                           'TAB UPDATES')
+    # Set PSE data cleaning flags
+    pse_nre_changes_data = utils.incremental_flags(pse_data, 'pse_id',
+                                                   partial(flag_pse_site_activities, update_notes=update_notes, fy=fy,
+                                                           timings=rule_timings),
+                                                   children=[pse_nre, pse_changes[['pse_id', 'change_id']]],
+                                                   snapshot_file=snapshot_file('PSE Site Activities'),
+                                                   context=context,
+                                                   group_cols=[['site_id']])
 
     # Subset records that require updates
     pse_corrections = pse_nre_changes_data.loc[pse_nre_changes_data.filter(like='UPDATE').notnull().any(1)]
@@ -935,7 +920,7 @@ def main(creds,
 
     corrections_sums = pd.concat(module_sums, ignore_index=True)
     corrections_sums.insert(0, 'Module', corrections_sums.pop('Module'))
-    corrections_sums = pd.merge(corrections_sums, update_notes, how='left', on=['Module', 'Update'])
+    corrections_sums = utils.merge_update_notes(corrections_sums, update_notes)
 
     # Calculate the month for this report
     prev_month = utils.previous_month(return_type='period')
@@ -953,6 +938,10 @@ def main(creds,
                                           'PSE': pse_corrections},
                              file_path=corrections_report_path)
 
+    # Report the runtime of each data cleaning rule, slowest rules first
+    print('Monthly Data Cleaning rule timings:')
+    print(utils.rule_timings_summary(rule_timings).to_string(index=False))
+
     # Email Update Notifications
 
     if send_emails:
@@ -1008,90 +997,72 @@ def main(creds,
             subset=['reported_by', 'reported_by_email'], keep='first').reset_index(drop=True)
 
         # Subset current staff using the staff list
-        current_staff = notify_staff.loc[notify_staff['reported_by_email'].isin(staff['email']),
+        current_staff = notify_staff.loc[notify_staff['reported_by_email'].isin(roster.staff['email']),
                                          ['reported_by', 'reported_by_email', 'unit']]
-        current_staff = current_staff.values.tolist()
-
-        # Verify emails?
-
-        # If email fails to send, the recipient is added to this list
-        failed_recipients = []
-
-        # Email Update Notifications to current staff
 
-        for x in current_staff:
-
-            staff_corrections_dict = {'Coalitions': utils.staff_corrections(coa_corrections_email,
-                                                                            former=False,
-                                                                            staff_email=x[1]),
-                                      'Indirect Activities': utils.staff_corrections(ia_corrections_email,
-                                                                                     former=False,
-                                                                                     staff_email=x[1]),
-                                      'Partnerships': utils.staff_corrections(part_corrections_email,
-                                                                              former=False,
-                                                                              staff_email=x[1]),
-                                      'Program Activities': utils.staff_corrections(pa_corrections_email,
-                                                                                    former=False,
-                                                                                    staff_email=x[1]),
-                                      'PSE Site Activities': utils.staff_corrections(pse_corrections_email,
-                                                                                     former=False,
-                                                                                     staff_email=x[1])}
-
-            staff_name = x[0]
-            send_to = x[1]
-            unit = x[2]
-
-            # If the recipient's unit is an INEP unit, they are directed to contact their Regional Specialist
-            # Else, they are directed to contact the FCS Evaluation team
-
-            response_tag = """If you have any questions or need help please reply to this email and a member of the
+        # Resolve each recipient's salutation, response tag and cc before any emails are sent
+        # If the recipient's unit is an INEP unit, they are directed to contact their Regional Specialist
+        # Else, they are directed to contact the FCS Evaluation team
+        team_response_tag = """If you have any questions or need help please reply to this email and a member of the
             FCS Evaluation Team will reach out soon.
                     <br>Thanks and have a great day!<br>
 
                     <br> <b> FCS Evaluation Team </b> <br>
                     <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
             """
+        re_response_tag = 'If you have any questions or need help please contact your Regional Specialist, ' \
+                          '<b>{0}</b> (<a href = "mailto: {1} ">{1}</a>).'
+        recipients = utils.recipient_context(current_staff, roster, notification_cc, team_response_tag,
+                                             re_response_tag)
+        current_staff = current_staff.values.tolist()
 
-            new_cc = notification_cc
-
-            if ((unit in re_lookup["UNIT #"].tolist()) and
-                (send_to not in state_staff['E-MAIL'].tolist()) and
-                    ('@uic.edu' not in send_to) and
-                    (re_lookup.loc[re_lookup['UNIT #'] == unit].empty is False)):
-                response_tag = 'If you have any questions or need help please contact your Regional Specialist, ' \
-                               '<b>{0}</b> (<a href = "mailto: {1} ">{1}</a>).'
-                re_name = re_lookup.loc[re_lookup['UNIT #'] == unit, 'REGIONAL EDUCATOR'].item()
-                re_email = re_lookup.loc[re_lookup['UNIT #'] == unit, 'RE E-MAIL'].item()
-                response_tag = response_tag.format(*[re_name, re_email])
-                new_cc = notification_cc + ', ' + re_email
+        # Verify emails?
 
-            # Staff's first name is used in the email salutation
-            first_name = staff.loc[staff['email'] == send_to, 'first_name'].item()
+        # Email Update Notifications to current staff
 
-            subject = 'PEARS Entries Updates ' + prev_month.strftime('%b-%Y') + ', Unit ' + unit + ', ' + staff_name
+        current_staff_corrections = utils.staff_corrections_bundles({'Coalitions': coa_corrections_email,
+                                                                     'Indirect Activities': ia_corrections_email,
+                                                                     'Partnerships': part_corrections_email,
+                                                                     'Program Activities': pa_corrections_email,
+                                                                     'PSE Site Activities': pse_corrections_email},
+                                                                    staff_emails=[x[1] for x in current_staff])
 
-            # Insert the corrections dfs into the email body
-            y = [first_name, deadline_date, response_tag]
-            utils.insert_dfs(staff_corrections_dict, y)
-            new_html = html.format(*y)
+        # Emails to current staff are sent concurrently over reused SMTP connections
+        with utils.MailPool(username=creds['admin_username'],
+                            password=creds['admin_password'],
+                            is_tls=True) as mail_pool:
+            for x, first_name, response_tag, new_cc, (_, staff_corrections_dict) in zip(current_staff,
+                                                                                       recipients['first_name'],
+                                                                                       recipients['response_tag'],
+                                                                                       recipients['cc'],
+                                                                                       current_staff_corrections):
+
+                staff_name = x[0]
+                send_to = x[1]
+                unit = x[2]
+
+                subject = 'PEARS Entries Updates ' + prev_month.strftime('%b-%Y') + ', Unit ' + unit + ', ' + staff_name
+
+                # Insert the corrections dfs into the email body, the staff's first name is used in the salutation
+                y = [first_name, deadline_date, response_tag]
+                utils.insert_dfs(staff_corrections_dict, y)
+                new_html = html.format(*y)
+
+                # Queue the email, the recipient is added to failed_recipients if it fails to send
+                mail_pool.send(failed_as=x,
+                               send_from=creds['admin_send_from'],
+                               send_to=send_to,
+                               cc=new_cc,
+                               subject=subject,
+                               html=new_html)
 
-            # Try to send the email, otherwise add the recipient's email address to failed_recipients
-            try:
-                utils.send_mail(send_from=creds['admin_send_from'],
-                                send_to=send_to,
-                                cc=new_cc,
-                                subject=subject,
-                                html=new_html,
-                                username=creds['admin_username'],
-                                password=creds['admin_password'],
-                                is_tls=True)
-            except smtplib.SMTPException:
-                failed_recipients.append(x)
+        # If email fails to send, the recipient is added to this list
+        failed_recipients = mail_pool.failed_recipients
 
         # Email Update Notifications for former staff
 
         # Subset former staff using the staff list
-        former_staff = notify_staff.loc[~notify_staff['reported_by_email'].isin(staff['email'])]
+        former_staff = notify_staff.loc[~notify_staff['reported_by_email'].isin(roster.staff['email'])]
 
         # Export former staff corrections as an Excel file
 
@@ -1109,8 +1080,7 @@ def main(creds,
         former_staff_filename = report_filename(report='former staff')
         former_staff_path = output_dir + '/' + former_staff_filename
 
-        # UPDATE utils.write_report() TO ACCEPT DICT
-        utils.write_report(former_staff_path, former_staff_dict.keys, former_staff_dict.values)
+        utils.write_report(former_staff_path, report_dict=former_staff_dict)
 
         # Send former staff updates email
 
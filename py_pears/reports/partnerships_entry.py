@@ -44,33 +44,28 @@ def main(creds,
     custom_field_labels = ['fcs_program_team', 'snap_ed_grant_goals', 'fcs_grant_goals', 'fcs_special_projects',
                            'snap_ed_special_projects']
 
-    pa_export = pd.ExcelFile(program_activities_export)
-    pa_data = pd.read_excel(pa_export, 'Program Activity Data')
+    pa_data = utils.read_export(program_activities_export, 'Program Activity Data')
     pa_data = utils.reformat(pa_data, custom_field_labels)
     pa_data = pa_data.loc[pa_data['program_areas'] == 'SNAP-Ed']
 
-    ia_export = pd.ExcelFile(indirect_activities_export)
-    ia_data = pd.read_excel(ia_export, 'Indirect Activity Data')
+    ia_data = utils.read_export(indirect_activities_export, 'Indirect Activity Data')
     ia_data = utils.reformat(ia_data, custom_field_labels)
     ia_data = ia_data.loc[ia_data['program_area'] == 'SNAP-Ed']
-    ia_ic = pd.read_excel(ia_export, 'Intervention Channels')
+    ia_ic = utils.read_export(indirect_activities_export, 'Intervention Channels')
     ia_ic = utils.select_pears_data(ia_ic, record_name_field='activity')
     ia_ic_data = pd.merge(ia_data, ia_ic, how='inner', on='activity_id')
 
-    sites = pd.read_excel(sites_export, sheet_name='Site Data')
+    sites = utils.read_export(sites_export, 'Site Data')
     sites = sites.loc[sites['is_active'] == 1]
 
-    part_export = pd.ExcelFile(partnerships_export)
-    part_data = pd.read_excel(part_export, 'Partnership Data')
+    part_data = utils.read_export(partnerships_export, 'Partnership Data')
     part_data = utils.reformat(part_data, custom_field_labels)
     part_data = part_data.loc[part_data['program_area'] == 'SNAP-Ed']
 
-    part_data_2021 = pd.read_excel(prev_year_part_export,
-                                   sheet_name='Partnership Data')
+    part_data_2021 = utils.read_export(prev_year_part_export, 'Partnership Data')
 
-    fy22_inep_staff = pd.read_excel(staff_list,
-                                    sheet_name='SNAP-Ed Staff List')
-    user_export = pd.read_excel(users_export, sheet_name='User Data')
+    fy22_inep_staff = utils.load_staff_roster(staff_list).snap_ed_staff
+    user_export = utils.read_export(users_export, 'User Data')
 
     # Import lookup table for counties to unit
     unit_counties = pd.read_excel(unit_counties,
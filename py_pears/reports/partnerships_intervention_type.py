@@ -10,39 +10,25 @@ import py_pears.utils as utils
 # output_dir: directory where report outputs are saved
 # staff_list: path to the staff list Excel workbook
 def main(creds, export_dir, output_dir, staff_list):
-    # Download required PEARS exports from S3
-    utils.download_s3_exports(profile=creds['aws_profile'],
-                              org=creds['s3_organization'],
-                              modules=['User',
-                                       'Site',
-                                       'Program_Activities',
-                                       'Indirect_Activity',
-                                       'Partnership',
-                                       'PSE_Site_Activity'])
-
-    fy22_inep_staff = pd.ExcelFile(staff_list)
-    # Adjust header argument in following lines for actual staff list
-    snap_ed_staff = pd.read_excel(fy22_inep_staff, sheet_name='SNAP-Ed Staff List', header=1)
-    # Import list of former staff
-    former_snap_ed_staff = pd.read_excel(fy22_inep_staff, sheet_name='Former Staff')
-    former_snap_ed_staff['email'] = former_snap_ed_staff['E-MAIL/NETID'].map(str) + '@illinois.edu'
+    # Required PEARS exports are downloaded to export_dir by the scheduler
+    roster = utils.load_staff_roster(staff_list)
 
     # Import Indirect Activity data and Intervention Channels
-    indirect_activities_export = pd.ExcelFile(export_dir + "Indirect_Activity_Export.xlsx")
-    ia_data = pd.read_excel(indirect_activities_export, 'Indirect Activity Data')
+    indirect_activities_export = export_dir + "Indirect_Activity_Export.xlsx"
+    ia_data = utils.read_export(indirect_activities_export, 'Indirect Activity Data')
     # Only data clean records for SNAP-Ed
     ia_data = ia_data.loc[ia_data['program_area'] == 'SNAP-Ed']
-    ia_ic = pd.read_excel(indirect_activities_export, 'Intervention Channels')
+    ia_ic = utils.read_export(indirect_activities_export, 'Intervention Channels')
     ia_ic_data = pd.merge(ia_data, ia_ic, how='left', on='activity_id')[['activity_id', 'site_id']]
 
     # Import Partnerships data
-    partnerships_export = pd.ExcelFile(export_dir + "Partnership_Export.xlsx")
-    part_data = pd.read_excel(partnerships_export, 'Partnership Data')
+    partnerships_export = export_dir + "Partnership_Export.xlsx"
+    part_data = utils.read_export(partnerships_export, 'Partnership Data')
     # Only data clean records for SNAP-Ed
     # SNAP-Ed staff occasionally select the wrong program_area for Partnerships
     part_data = part_data.loc[(part_data['program_area'] == 'SNAP-Ed') |
-                              (part_data['reported_by_email'].isin(snap_ed_staff['E-MAIL'])) |
-                              (part_data['reported_by_email'].isin(former_snap_ed_staff['email'])),
+                              (part_data['reported_by_email'].isin(roster.snap_ed_staff['E-MAIL'])) |
+                              (part_data['reported_by_email'].isin(roster.former_staff_emails)),
                               ['partnership_id',
                                'partnership_name',
                                'is_direct_education_intervention',
@@ -51,16 +37,16 @@ def main(creds, export_dir, output_dir, staff_list):
     # Filtering for former staff will include transfers
 
     # Import Program Activity data
-    program_activities_export = pd.ExcelFile(export_dir + "program_activities_export.xlsx")
-    pa_data = pd.read_excel(program_activities_export, 'Program Activity Data')
+    program_activities_export = export_dir + "Program_Activities_Export.xlsx"
+    pa_data = utils.read_export(program_activities_export, 'Program Activity Data')
     # Subset Program Activities for Family Consumer Science
     pa_data_fcs = pa_data.loc[pa_data['program_areas'].str.contains('Family Consumer Science')]
     # Subset Program Activities for SNAP-Ed
     pa_data = pa_data.loc[pa_data['program_areas'].str.contains('SNAP-Ed'), ['program_id', 'site_id']]
 
     # Import PSE Site Activity data, Needs, Readiness, Effectiveness, and Changes
-    pse_site_activities_export = pd.ExcelFile(export_dir + "PSE_Site_Activity_Export.xlsx")
-    pse_data = pd.read_excel(pse_site_activities_export, 'PSE Data')[['pse_id', 'site_id']]
+    pse_site_activities_export = export_dir + "PSE_Site_Activity_Export.xlsx"
+    pse_data = utils.read_export(pse_site_activities_export, 'PSE Data')[['pse_id', 'site_id']]
 
     # Create a class, list of objects for these lists
     related_records = [ia_ic_data, pa_data, pse_data]
@@ -1,46 +1,35 @@
 import pandas as pd
-from datetime import datetime
-from functools import reduce
+import numpy as np
 import py_pears.utils as utils
 
 
-# Report all four quarters, if previous month isn't the end of a quarter
-fq_df = utils.previous_fq(columns=['fq', 'fq_int'])
-fq = fq_df['fq'].item()
-fq_int = fq_df['fq_int'].item()
-
-
-# report: 'corrections' or 'former staff'
-# UPDATE use utils.current_fy() once implemented
-def report_filename():
-    return 'DHS Report FY2022 ' + fq + '.xlsx'
+# fy: int for the fiscal year of the report (default: the fiscal year of the report month)
+def report_filename(fy=None):
+    fy = utils.fiscal_calendar().fy if fy is None else fy
+    return 'DHS Report FY' + str(fy) + ' ' + utils.fiscal_calendar().fq + '.xlsx'
 
 
 # Assign and explode records by quarter
+# Records are repeated for their quarter and each subsequent quarter of the fiscal year (YTD),
+# records outside the bounds are dropped
 # df: dataframe of module export sheet records
-# qtr_bounds: list of date strings for the lower/upper bounds of each quarter
+# qtr_bounds: array of dates for the lower/upper bounds of each quarter, from utils.FiscalCalendar.report_quarter_bounds()
 # date_field: df column name of the date field to base quarters on (default: 'created')
+# returns a copy of df with date_field converted to datetime and an int8 'report_quarter' column
 def explode_quarters(df, qtr_bounds, date_field='created'):
-    df[date_field] = pd.to_datetime(df[date_field])  # SettingWithCopyWarning
-    df['report_quarter'] = ''  # SettingWithCopyWarning
-    dt_list = [datetime.strptime(s, "%m/%d/%Y") for s in qtr_bounds]
-    # Upper bound is exclusive
-    df.loc[(df[date_field] >= dt_list[0]) & (df[date_field] < dt_list[1]), 'report_quarter'] = '1, 2, 3, 4'
-    df.loc[(df[date_field] >= dt_list[1]) & (df[date_field] < dt_list[2]), 'report_quarter'] = '2, 3, 4'
-    df.loc[(df[date_field] >= dt_list[2]) & (df[date_field] < dt_list[3]), 'report_quarter'] = '3, 4'
-    df.loc[(df[date_field] >= dt_list[3]) & (df[date_field] < dt_list[4]), 'report_quarter'] = '4'
-    df['report_quarter'] = df['report_quarter'].str.split(', ').tolist()  # SettingWithCopyWarning
-    df = df.explode('report_quarter')
-    df['report_quarter'] = pd.to_numeric(df['report_quarter'])
-    return df
-
-
-# Explode snap_ed_grant_goals field
-# df: dataframe of module export sheet records
-def explode_goals(df):
-    df['goal'] = df['snap_ed_grant_goals'].str.split(',').tolist()
-    df = df.explode('goal')
-    return df
+    dates = pd.to_datetime(df[date_field])
+    # Upper bound is exclusive, records outside the bounds are assigned quarter 0
+    start_quarters = utils.fiscal_calendar().assign_quarter(dates, bounds=qtr_bounds).to_numpy()
+    n_quarters = len(qtr_bounds) - 1
+    repeats = np.where(start_quarters > 0, n_quarters + 1 - start_quarters, 0)
+    positions = np.repeat(np.arange(len(df)), repeats)
+    # Position of each exploded row within its record's repeats
+    offsets = np.arange(len(positions)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+
+    exploded = df.iloc[positions].copy()
+    exploded[date_field] = dates.to_numpy()[positions]
+    exploded['report_quarter'] = (start_quarters[positions] + offsets).astype('int8')
+    return exploded
 
 
 # Function to calculate the quarterly value of a given field
@@ -57,14 +46,68 @@ def quarterly_value(df, field, metric, label, goals=False):
         return df.groupby('report_quarter')[field].agg(metric).reset_index(name=label)
 
 
-# Class that bundles the input arguments of quarterly_value()
+# Function to calculate the quarterly value of a given field for each goal
+# Goals are reduced as a multi-hot matrix, rather than exploding records by goal
+# df: dataframe of PEARS module data with 'report_quarter' column
+# goals: boolean dataframe of goal indicators with the same rows as df, from utils.custom_field_indicators()
+# field: column used to calculate the quarterly value
+# metric: 'sum' or 'count'
+# label: string for the column label of the quarterly value
+# keys: list of column labels to group by in addition to 'report_quarter' and 'Goal' (default: None)
+def quarterly_goal_value(df, goals, field, metric, label, keys=None):
+    keys = keys if keys else []
+    columns = ['report_quarter', 'Goal'] + keys + [label]
+    if goals.columns.empty:
+        return pd.DataFrame(columns=columns)
+
+    goal_matrix = goals.to_numpy(dtype=bool)
+    values = df[field].to_numpy()
+    if metric == 'count':
+        weighted = goal_matrix & pd.notna(values)[:, None]
+    else:
+        weighted = np.where(goal_matrix, values[:, None], 0)
+
+    by = [df[key].to_numpy() for key in ['report_quarter'] + keys]
+    grouped = pd.DataFrame(weighted, columns=goals.columns).groupby(by).sum()
+    # Only report goals that have at least one record in the group
+    has_goal = pd.DataFrame(goal_matrix, columns=goals.columns).groupby(by).any()
+
+    goal_values = grouped.stack()[has_goal.stack().to_numpy()]
+    goal_values.index.names = ['report_quarter'] + keys + ['Goal']
+    return goal_values.reset_index(name=label)[columns].sort_values(
+        ['report_quarter', 'Goal'] + keys, ignore_index=True)
+
+
+# Return each record's last goal in the order of the goal binary columns, or NaN for records without a goal
+# goals: boolean dataframe of goal indicators from utils.custom_field_indicators()
+def last_goal(goals):
+    goal_matrix = goals.to_numpy(dtype=bool)
+    if goals.columns.empty:
+        return np.full(len(goals), np.nan, dtype=object)
+    last_index = goal_matrix.shape[1] - 1 - goal_matrix[:, ::-1].argmax(axis=1)
+    return np.where(goal_matrix.any(axis=1), goals.columns.to_numpy(dtype=object)[last_index], np.nan)
+
+
+# Function to calculate several quarterly values of a dataframe in a single groupby
+# df: dataframe of PEARS module data with 'report_quarter' column
+# specs: list of (field, metric, label) tuples, see quarterly_value()
+def quarterly_values(df, specs):
+    return df.groupby('report_quarter').agg(**{label: (field, metric) for field, metric, label in specs}).reset_index()
+
+
+# Class that bundles the input arguments of quarterly_values()
 class QuarterlyValueInputs:
-    def __init__(self, df, field, metric, label, goals=False):
+    def __init__(self, df, specs):
         self.df = df
-        self.field = field
-        self.metric = metric
-        self.label = label
-        self.goals = goals
+        self.specs = specs
+
+
+# Function to calculate the quarterly values of several dataframes, joined on 'report_quarter'
+# Rows are sorted by quarter, even if the first dataframe has no records for some quarters
+# inputs: list of QuarterlyValueInputs objects
+def join_quarterly_values(inputs):
+    dfs = [quarterly_values(item.df, item.specs).set_index('report_quarter') for item in inputs]
+    return pd.concat(dfs, axis=1, sort=True).reset_index()
 
 
 # Function to assign a percent column to a dataframe
@@ -96,12 +139,14 @@ def filter_fq(dfs, fq):
 # program_activities_export: path to PEARS export of Program Activities
 # pse_site_activities_export: path to PEARS export of PSE Site Activities
 # output_dir: directory where report outputs are saved
+# fy: int for the fiscal year of the report (default: the fiscal year of the report month)
 def main(coalitions_export,
          indirect_activities_export,
          partnerships_export,
          program_activities_export,
          pse_site_activities_export,
-         output_dir):
+         output_dir,
+         fy=None):
 
     # Custom fields that require reformatting
     # Only needed for multi-select dropdowns
@@ -109,99 +154,99 @@ def main(coalitions_export,
                            'snap_ed_special_projects']
 
     # Import Indirect Activity data and Intervention Channels
-    indirect_activities_export = pd.ExcelFile(indirect_activities_export)
-    ia_export = pd.read_excel(indirect_activities_export, 'Indirect Activity Data')
+    ia_export = utils.read_export(indirect_activities_export, 'Indirect Activity Data')
     # Only report on records for SNAP-Ed
     ia_data = ia_export.loc[
         (ia_export['program_area'] == 'SNAP-Ed') & (~ia_export['title'].str.contains('(?i)TEST', regex=True))]
-    ia_ic_export = pd.read_excel(indirect_activities_export, 'Intervention Channels')
+    ia_ic_export = utils.read_export(indirect_activities_export, 'Intervention Channels')
 
     # Import Coalitions data and Coalition Members
-    coalitions_export = pd.ExcelFile(coalitions_export)
-    coa_export = pd.read_excel(coalitions_export, 'Coalition Data')
+    coa_export = utils.read_export(coalitions_export, 'Coalition Data')
     # Only report on records for SNAP-Ed
     coa_data = coa_export.loc[
         (coa_export['program_area'] == 'SNAP-Ed') & (
             ~coa_export['coalition_name'].str.contains('(?i)TEST', regex=True))]
-    coa_members_export = pd.read_excel(coalitions_export, 'Members')
+    coa_members_export = utils.read_export(coalitions_export, 'Members')
 
     # Import Program Activity data and Sessions
-    program_activities_export = pd.ExcelFile(program_activities_export)
-    pa_export = pd.read_excel(program_activities_export, 'Program Activity Data')
+    pa_export = utils.read_export(program_activities_export, 'Program Activity Data')
     # PA is only module to have cross-program_area collaboration
     pa_data = pa_export.loc[
         (pa_export['program_areas'].str.contains('SNAP-Ed')) & (
             ~pa_export['name'].str.contains('(?i)TEST', regex=True))]
-    pa_sessions_export = pd.read_excel(program_activities_export, 'Sessions')
+    pa_sessions_export = utils.read_export(program_activities_export, 'Sessions')
 
     # Import Partnerships data
-    partnerships_export = pd.ExcelFile(partnerships_export)
-    part_export = pd.read_excel(partnerships_export, 'Partnership Data')
+    part_export = utils.read_export(partnerships_export, 'Partnership Data')
     # Only report on records for SNAP-Ed
     part_data = part_export.loc[(part_export['program_area'] == 'SNAP-Ed') & (
         ~part_export['partnership_name'].str.contains('(?i)TEST', regex=True))]
 
     # Import PSE Site Activity data, Needs, Readiness, Effectiveness, and Changes
-    pse_site_activities_export = pd.ExcelFile(pse_site_activities_export)
-    pse_export = pd.read_excel(pse_site_activities_export, 'PSE Data')
+    pse_export = utils.read_export(pse_site_activities_export, 'PSE Data')
     pse_data = pse_export.loc[~pse_export['name'].str.contains('(?i)TEST', regex=True, na=False)]
-    pse_changes_export = pd.read_excel(pse_site_activities_export, 'Changes')
-    pse_nre_export = pd.read_excel(pse_site_activities_export, 'Needs, Readiness, Effectiveness')
+    pse_changes_export = utils.read_export(pse_site_activities_export, 'Changes')
+    pse_nre_export = utils.read_export(pse_site_activities_export, 'Needs, Readiness, Effectiveness')
 
     # Assign Quarters
 
-    fy_22_qtr_bounds = ['10/01/2021', '01/11/2022', '04/11/2022', '07/11/2022', '10/18/2022']
+    fy = utils.fiscal_calendar().fy if fy is None else fy
+    qtr_bounds = utils.fiscal_calendar().report_quarter_bounds(fy)
 
     # Prep Coalitions data
     coa_data = utils.reformat(coa_data, custom_field_labels)
-    coa_data = explode_quarters(coa_data, fy_22_qtr_bounds)
+    coa_data = explode_quarters(coa_data, qtr_bounds)
     coa_members_data = pd.merge(coa_members_export, coa_data[['coalition_id', 'program_area', 'report_quarter']],
                                 how='left', on='coalition_id')
     coa_members_data = coa_members_data.loc[coa_members_data['program_area'] == 'SNAP-Ed']
 
     # Prep Indirect Activities data
     ia_data = utils.reformat(ia_data, custom_field_labels)
-    ia_data = explode_quarters(ia_data, fy_22_qtr_bounds)
+    ia_data = explode_quarters(ia_data, qtr_bounds)
     ia_ic_data = pd.merge(ia_ic_export, ia_data[['activity_id', 'program_area', 'report_quarter']], how='left',
                           on='activity_id')
     ia_ic_data = ia_ic_data.loc[ia_ic_data['program_area'] == 'SNAP-Ed']
     # Use IC created field when export updated
 
     # Prep Program Activities data
+    # Goal indicators are built once from the binary columns, and aligned with exploded records by index
+    pa_goals = utils.custom_field_indicators(pa_data, 'snap_ed_grant_goals')
     pa_data = utils.reformat(pa_data, custom_field_labels)
-    pa_data = explode_quarters(pa_data, fy_22_qtr_bounds)
+    # Sessions are assigned quarters by start date, so include sessions of programs created before the fiscal year
     pa_sessions_data = pd.merge(pa_sessions_export, pa_data[['program_id', 'program_areas']].drop_duplicates(),
                                 how='left',
                                 on='program_id')
+    pa_data = explode_quarters(pa_data, qtr_bounds)
     pa_sessions_data = pa_sessions_data.loc[pa_sessions_data['program_areas'].str.contains('SNAP-Ed', na=False)]
-    pa_sessions_data = explode_quarters(pa_sessions_data, fy_22_qtr_bounds, date_field='start_date')
-    pa_sessions_data = pa_sessions_data.loc[pa_sessions_data['report_quarter'] != '']
+    pa_sessions_data = explode_quarters(pa_sessions_data, qtr_bounds, date_field='start_date')
     # EARS – Program Activity Sessions:
     # Only program activities that have either more than one session or one
     # session greater than or equal to 20 minutes in length are counted.
 
     # Prep Partnerships data
     part_data = utils.reformat(part_data, custom_field_labels)
-    part_data = explode_quarters(part_data, fy_22_qtr_bounds)
+    part_data = explode_quarters(part_data, qtr_bounds)
 
     # Prep PSE Site Activities data
+    pse_goals = utils.custom_field_indicators(pse_data, 'snap_ed_grant_goals')
     pse_data = utils.reformat(pse_data, custom_field_labels)
-    pse_data = explode_quarters(pse_data, fy_22_qtr_bounds)
-    pse_nre_data = explode_quarters(pse_nre_export, fy_22_qtr_bounds, date_field='baseline_date')
-    pse_nre_data = pse_nre_data.loc[pse_nre_data['baseline_date'] >= fy_22_qtr_bounds[0]]
+    pse_data = explode_quarters(pse_data, qtr_bounds)
+    pse_nre_data = explode_quarters(pse_nre_export, qtr_bounds, date_field='baseline_date')
+    pse_nre_data = pse_nre_data.loc[pse_nre_data['baseline_date'] >= qtr_bounds[0]]
 
     # Calculate DHS report metrics
 
     # # of unique programming sites (direct ed & PSE)
 
-    unique_sites = pa_data[['report_quarter', 'snap_ed_grant_goals', 'site_id']].append(
-        pse_data[['report_quarter', 'snap_ed_grant_goals', 'site_id']], ignore_index=True).drop_duplicates()
-    unique_sites = explode_goals(unique_sites)
-    unique_sites = quarterly_value(df=unique_sites,
-                                   field='site_id',
-                                   metric='count',
-                                   label='# of unique programming sites (direct ed & PSE)',
-                                   goals=True)
+    sites = pa_data[['report_quarter', 'site_id']].append(pse_data[['report_quarter', 'site_id']], ignore_index=True)
+    site_goals = pd.concat([pa_goals.loc[pa_data.index], pse_goals.loc[pse_data.index]],
+                           ignore_index=True).fillna(False).astype(bool)
+    unique_site_rows = ~pd.concat([sites, site_goals], axis=1).duplicated().to_numpy()
+    unique_sites = quarterly_goal_value(df=sites.loc[unique_site_rows],
+                                        goals=site_goals.loc[unique_site_rows],
+                                        field='site_id',
+                                        metric='count',
+                                        label='# of unique programming sites (direct ed & PSE)')
     # Remove (direct ed & PSE) from column, add to snap_ed_grant_goals?
 
     unique_coalitions = quarterly_value(coa_data[['report_quarter', 'coalition_id']].drop_duplicates(),
@@ -215,14 +260,16 @@ def main(coalitions_export,
     # Total Unique Reach
     # Create package function for total_unique_reach(), pending FY23 guidance
 
-    pa_sites_reach = pa_data[['report_quarter', 'snap_ed_grant_goals', 'site_id', 'participants_total']]
-    pa_sites_reach = explode_goals(pa_sites_reach)
-    pa_sites_reach = pa_sites_reach.rename(columns={'participants_total': 'PA_participants_total'}).groupby(
-        ['report_quarter', 'goal', 'site_id'])['PA_participants_total'].agg('sum').reset_index(
-        name='PA_participants_sum')
-    pse_sites_reach = explode_goals(pse_data.loc[
-                                        pse_data['total_reach'].notnull(), ['report_quarter', 'snap_ed_grant_goals',
-                                                                            'site_id', 'total_reach']])
+    pa_sites_reach = quarterly_goal_value(df=pa_data,
+                                          goals=pa_goals.loc[pa_data.index],
+                                          field='participants_total',
+                                          metric='sum',
+                                          label='PA_participants_sum',
+                                          keys=['site_id']).rename(columns={'Goal': 'goal'})
+    # Each site's PSE reach is attributed to the last goal of its record with the greatest reach
+    pse_reach_rows = pse_data['total_reach'].notnull().to_numpy()
+    pse_sites_reach = pse_data.loc[pse_reach_rows, ['report_quarter', 'site_id', 'total_reach']]
+    pse_sites_reach.insert(1, 'goal', last_goal(pse_goals.loc[pse_data.index].loc[pse_reach_rows]))
     pse_sites_reach = pse_sites_reach.sort_values(['report_quarter', 'site_id', 'total_reach']).rename(
         columns={'total_reach': 'PSE_total_reach'}).drop_duplicates(subset=['report_quarter', 'site_id'], keep='last')
     site_reach = pd.merge(pa_sites_reach, pse_sites_reach, how='outer', on=['report_quarter', 'goal', 'site_id'])
@@ -248,7 +295,6 @@ def main(coalitions_export,
 
     # DE participants reached
 
-    pa_demo_dfs = []
     demo_subsets = {'participants_total': 'Total',
                     'participants_race_amerind': 'American Indian or Alaska Native',
                     'participants_race_asian': 'Asian',
@@ -259,11 +305,8 @@ def main(coalitions_export,
                     'participants_ethnicity_non_hispanic': 'Non-Hispanic/Non-Latinx'
                     }
 
-    for demo_field, demo_label in demo_subsets.items():
-        pa_demo_dfs.append(quarterly_value(df=pa_data, field=demo_field, metric='sum', label=demo_label))
-
-    # Create function for merging lists of dfs on report_quarter
-    pa_demo = reduce(lambda left, right: pd.merge(left, right, how='outer', on='report_quarter'), pa_demo_dfs)
+    pa_demo = quarterly_values(pa_data, [(demo_field, 'sum', demo_label)
+                                         for demo_field, demo_label in demo_subsets.items()])
 
     for demo_field in demo_subsets.values():
         if demo_field == 'Total':
@@ -287,37 +330,20 @@ def main(coalitions_export,
     reach_inputs = [
         QuarterlyValueInputs(
             df=pa_sites_reach,
-            field='PA_participants_sum',
-            metric='sum',
-            label='# of unique participants attending direct education'),
-        QuarterlyValueInputs(
-            df=pa_sessions_data,
-            field='num_participants',
-            metric='sum',
-            label='# of educational contacts via direct education'),
+            specs=[('PA_participants_sum', 'sum', '# of unique participants attending direct education')]),
         QuarterlyValueInputs(
             df=pa_sessions_data,
-            field='report_quarter',
-            metric='count',
-            label='# of lessons attended'),
+            specs=[('num_participants', 'sum', '# of educational contacts via direct education'),
+                   ('report_quarter', 'count', '# of lessons attended')]),
         QuarterlyValueInputs(
             df=ia_ic_data,
-            field='reach',
-            metric='sum',
-            label='# of indirect education contacts'),
+            specs=[('reach', 'sum', '# of indirect education contacts')]),
         QuarterlyValueInputs(
             df=pse_sites_reach,
-            field='PSE_total_reach',
-            metric='sum',
-            label='PSE total estimated reach')
+            specs=[('PSE_total_reach', 'sum', 'PSE total estimated reach')])
     ]
 
-    reach_dfs = []
-
-    for inputs in reach_inputs:
-        reach_dfs.append(quarterly_value(inputs.df, inputs.field, inputs.metric, inputs.label))
-
-    re_aim_reach = reduce(lambda left, right: pd.merge(left, right, how='outer', on='report_quarter'), reach_dfs)
+    re_aim_reach = join_quarterly_values(reach_inputs)
 
     # Adoption
 
@@ -411,10 +437,10 @@ def main(coalitions_export,
 
     report_dfs = [goals_sites_reach, pa_demo, re_aim_reach, re_aim_adoption, re_aim_implementation]
 
-    utils.write_report(file=output_dir + report_filename(),
+    utils.write_report(file=output_dir + report_filename(fy),
                        sheet_names=['Unique Sites and Reach by Goal',
                                     'Direct Education Demographics',
                                     'RE-AIM Reach',
                                     'RE-AIM Adoption',
                                     'RE-AIM Implementation'],
-                       dfs=filter_fq(report_dfs, fq_int))
+                       dfs=filter_fq(report_dfs, utils.fiscal_calendar().fq_int))
@@ -1,6 +1,5 @@
 import pandas as pd
 import py_pears.utils as utils
-import smtplib
 
 
 def report_filename():
@@ -28,8 +27,8 @@ def main(creds,
          report_recipients=''):
 
     # Import input data
-    sites = pd.read_excel(sites_export, sheet_name='Site Data')
-    users = pd.read_excel(users_export, sheet_name='User Data')
+    sites = utils.read_export(sites_export, 'Site Data')
+    users = utils.read_export(users_export, 'User Data')
 
     # Sites Report
 
@@ -142,26 +141,23 @@ def main(creds,
         </html>
         """
 
-        # Build the following pattern into a wrapper function?
-
-        failed_recipients = []
-
-        for x in staff_list:
-            staff_name = x[0]
-            notification_send_to = x[1]
-            user_html = notification_html.format(staff_name)
-            # Try to send the email, otherwise add the recipient's email address to failed_recipients
-            try:
-                utils.send_mail(send_from=creds['admin_send_from'],
-                                send_to=notification_send_to,
-                                cc=notification_cc,
-                                subject=notification_subject,
-                                html=user_html,
-                                username=creds['admin_username'],
-                                password=creds['admin_password'],
-                                is_tls=True)
-            except smtplib.SMTPException:
-                failed_recipients.append(x)
+        # Notifications are sent concurrently over reused SMTP connections
+        with utils.MailPool(username=creds['admin_username'],
+                            password=creds['admin_password'],
+                            is_tls=True) as mail_pool:
+            for x in staff_list:
+                staff_name = x[0]
+                notification_send_to = x[1]
+                user_html = notification_html.format(staff_name)
+                # Queue the email, the recipient is added to failed_recipients if it fails to send
+                mail_pool.send(failed_as=x,
+                               send_from=creds['admin_send_from'],
+                               send_to=notification_send_to,
+                               cc=notification_cc,
+                               subject=notification_subject,
+                               html=user_html)
+
+        failed_recipients = mail_pool.failed_recipients
 
         # Notify admin of any failed attempts to send an email
         utils.send_failure_notice(failed_recipients=failed_recipients,
@@ -1,5 +1,5 @@
 import pandas as pd
-from functools import reduce
+import numpy as np
 import py_pears.utils as utils
 
 
@@ -11,98 +11,136 @@ def report_filename(agency='SNAP-Ed'):
         return 'CPHP Staff PEARS Entries ' + prev_month_str + '.xlsx'
 
 
-# Timestamp for day the report is run
-ts = pd.to_datetime("today").date()
-# PeriodArray/Index object for report month
-prev_month = utils.previous_month(return_type='period')
-# Start date of the report period
-prev_month_lb = (ts.replace(day=1) - pd.DateOffset(months=1)).date()
-# End date of the report period
-# Prior month's records are typically entered by the 10th day of subsequent month
-prev_month_ub = ts.replace(day=10)
+# Record count metrics from entry_count_windows() and their column labels, in report column order
+ENTRY_COUNT_LABELS = {'prev_mo_created': 'Created {date}',
+                      'prev_mo_modified': 'Modified {date}',
+                      'ytd_created': 'Created YTD',
+                      'prev_mo_collab': 'Collaborated Created {date}',
+                      'prev_mo_collab_mod': 'Collaborated Modified {date}',
+                      'ytd_collab': 'Collaborated Created YTD'}
 
 
 # Function for merging PEARS module records with collaborator data
-# pears_users: dataframe of PEARS users
-# df: dataframe of module data
-# module_id: string for the module's id column label
-# excel_file: pandas.ExcelFile of the module export
-def merge_collaborators(pears_users, df, module_id, excel_file):
-    collaborators = pd.read_excel(excel_file, 'Collaborators')
-    collaborators = pd.merge(collaborators, pears_users, how='left', left_on='user', right_on='full_name')
-    collaborators = pd.merge(collaborators, df, how='left', on=module_id)
-    collaborators = collaborators.loc[:, [module_id, 'user', 'email', 'created', 'modified']]
-    return collaborators
-
-
-# CREATE an util function for subsetting data by date bounds (inclusive/exclusive?)
-
-# Function to create list of dataframes consisting of
-# counts of record creation data created during the previous month,
-# counts of record creation data modified during the previous month,
-# counts of record creation data created during the current year to date,
-# counts of collaboration data created during the previous month,
-# counts of collaboration data modified during the previous month,
-# counts of collaboration data created during the current year to date
+# Collaborators of every module are resolved to emails against the user index in a single pass
+# user_index: utils.UserIndex of PEARS users
+# modules: list of (df, module_id, unit_col, export) tuples of module data, the module's id column label,
+# the module's unit column label (None if the module has no unit), and the path to the PEARS export of the module
+# Units are used to resolve collaborators whose names are shared by multiple users
+# returns a list of collaborator dataframes in the order of modules,
+# with module_id, 'user', 'email', 'created', and 'modified' columns
+def merge_collaborators(user_index, modules):
+    module_collaborators = []
+    for df, module_id, unit_col, export in modules:
+        collaborators = utils.read_export(export, 'Collaborators')[[module_id, 'user']]
+        records = df[[module_id, 'created', 'modified']].assign(unit=np.nan if unit_col is None else df[unit_col])
+        module_collaborators.append(pd.merge(collaborators, records, how='left', on=module_id))
+
+    names = pd.concat([collaborators['user'] for collaborators in module_collaborators], ignore_index=True)
+    units = pd.concat([collaborators['unit'] for collaborators in module_collaborators], ignore_index=True)
+    emails = user_index.resolve(names, units).to_numpy(dtype=object)
+
+    bounds = np.cumsum([0] + [len(collaborators) for collaborators in module_collaborators])
+    for index, (df, module_id, unit_col, export) in enumerate(modules):
+        collaborators = module_collaborators[index]
+        collaborators['email'] = emails[bounds[index]:bounds[index + 1]]
+        module_collaborators[index] = collaborators.loc[:, [module_id, 'user', 'email', 'created', 'modified']]
+    return module_collaborators
+
+
+# Time windows of record creation and collaboration data counted for the report
+# Windows are (date field, start date, end date) tuples, bounds are inclusive and None is unbounded
+# Windows added here also need a column label in ENTRY_COUNT_LABELS
+# date_lb: datetime.date object for the start date of the report period (default: utils.fiscal_calendar().prev_month_lb)
+# date_ub: datetime.date object for the end date of the report period (default: utils.fiscal_calendar().prev_month_ub)
+def entry_count_windows(date_lb=None, date_ub=None):
+    if date_lb is None:
+        date_lb = utils.fiscal_calendar().prev_month_lb
+    if date_ub is None:
+        date_ub = utils.fiscal_calendar().prev_month_ub
+    return {'created': {'prev_mo_created': ('created', date_lb, date_ub),
+                        'prev_mo_modified': ('modified', date_lb, date_ub),
+                        'ytd_created': ('created', None, None)},
+            'collab': {'prev_mo_collab': ('created', date_lb, date_ub),
+                       'prev_mo_collab_mod': ('modified', date_lb, date_ub),
+                       'ytd_collab': ('created', None, None)}}
+
+
+# Function to count each email's records in every time window in a single pass
+# Windows may overlap, so each window is an indicator column and all windows are summed in one groupby
+# df: dataframe of module records with an 'email' column
+# module_id: string for the module's id column label, records without an id aren't counted
+# windows: dict of metric names and (date field, start date, end date) tuples, see entry_count_windows()
+# returns a long format dataframe of 'email', 'metric', and 'value' columns, for emails with records in the window
+def window_counts(df, module_id, windows):
+    days = {}
+    in_window = {}
+    for metric, (date_field, start, end) in windows.items():
+        mask = np.ones(len(df), dtype=bool)
+        if start is not None or end is not None:
+            if date_field not in days:
+                days[date_field] = pd.to_datetime(df[date_field]).to_numpy(dtype='datetime64[ns]').astype(
+                    'datetime64[D]')
+            if start is not None:
+                mask &= days[date_field] >= np.datetime64(start, 'D')
+            if end is not None:
+                mask &= days[date_field] <= np.datetime64(end, 'D')
+        in_window[metric] = mask
+
+    in_window = pd.DataFrame(in_window)
+    counted = in_window & df[module_id].notnull().to_numpy()[:, None]
+    grouped = pd.concat([in_window, counted], axis=1, keys=['in_window', 'count']).groupby(
+        df['email'].to_numpy()).sum()
+
+    counts = grouped['count'].stack()[grouped['in_window'].stack().to_numpy() > 0]
+    counts.index.names = ['email', 'metric']
+    return counts.reset_index(name='value')
+
+
+# Function to count a module's record creation and collaboration data in each time window
 # df_created: dataframe of module record creation data
 # df_collab: dataframe of module collaboration data
 # module_id: string for the module's id column label
-# date_lb: datetime.date object for the start date of the report period
-# date_ub: datetime.date object for the end date of the report period
-def created_collab_dfs(df_created, df_collab, module_id, date_lb=prev_month_lb, date_ub=prev_month_ub):
+# module: string of the module name
+# windows: dict of 'created' and 'collab' time windows (default: entry_count_windows())
+# returns a long format dataframe of 'email', 'module', 'metric', and 'value' columns
+def created_collab_counts(df_created, df_collab, module_id, module, windows=None):
+    if windows is None:
+        windows = entry_count_windows()
     df_created = df_created.rename(columns={'reported_by_email': 'email'})
-    df_created['created'] = pd.to_datetime(df_created['created']).dt.date
-    prev_mo_created = df_created.loc[(df_created['created'] >= date_lb)
-                                     & (df_created['created'] <= date_ub)].groupby(
-        'email')[module_id].count().reset_index(name='prev_mo_created')
-
-    df_created['modified'] = pd.to_datetime(df_created['modified']).dt.date
-    prev_mo_modified = df_created.loc[(df_created['modified'] >= date_lb)
-                                      & (df_created['modified'] <= date_ub)].groupby(
-        'email')[module_id].count().reset_index(name='prev_mo_modified')
-
-    ytd_created = df_created.groupby('email')[module_id].count().reset_index(name='ytd_created')
-
-    df_collab['created'] = pd.to_datetime(df_collab['created']).dt.date
-    prev_mo_collab = df_collab.loc[(df_collab['created'] >= date_lb)
-                                   & (df_collab['created'] <= date_ub)].groupby('email')[
-        module_id].count().reset_index(name='prev_mo_collab')
-
-    df_collab['modified'] = pd.to_datetime(df_collab['modified']).dt.date
-    prev_mo_collab_mod = df_collab.loc[(df_collab['modified'] >= date_lb)
-                                       & (df_collab['modified'] <= date_ub)].groupby('email')[
-        module_id].count().reset_index(name='prev_mo_collab_mod')
-
-    ytd_collab = df_collab.groupby('email')[module_id].count().reset_index(name='ytd_collab')
-
-    dfs = [prev_mo_created, prev_mo_modified, ytd_created, prev_mo_collab, prev_mo_collab_mod, ytd_collab]
-    return dfs
+    counts = pd.concat([window_counts(df_created, module_id, windows['created']),
+                        window_counts(df_collab, module_id, windows['collab'])], ignore_index=True)
+    counts.insert(1, 'module', module)
+    return counts
 
 
 # Function to merge record counts and staff list
-# dfs: list of dataframes returned from created_collab_dfs()
+# Counts of every module are pivoted once and merged with the staff list in a single join
+# counts: dataframe of long format record counts, from created_collab_counts()
 # staff: dataframe of staff
-# module: string of the module name
-# data: string for Month-Year
-def module_staff_entries(dfs, staff, module, date=prev_month.strftime('%b-%Y')):
-    dfs = [staff] + dfs
-
-    df_merged = reduce(lambda left, right: pd.merge(left, right, how='left', on='email'), dfs)
+# modules: list of module names in report column order
+# date: string for Month-Year (default: the report month)
+def module_staff_entries(counts, staff, modules, date=None):
+    if date is None:
+        date = utils.fiscal_calendar().prev_month.strftime('%b-%Y')
+
+    count_cols = pd.MultiIndex.from_product([modules, list(ENTRY_COUNT_LABELS)], names=['module', 'metric'])
+    wide = counts.pivot(index='email', columns=['module', 'metric'], values='value').reindex(columns=count_cols)
+    wide.columns = [module + ' ' + ENTRY_COUNT_LABELS[metric].format(date=date) for module, metric in wide.columns]
+
+    df_merged = pd.merge(staff, wide.rename_axis('email').reset_index(), how='left', on='email')
+    # Counts are integers, unless a staff member has no records for that count
+    complete_cols = [col for col in wide.columns if df_merged[col].notnull().all()]
+    df_merged[complete_cols] = df_merged[complete_cols].astype('int64')
     df_merged = df_merged.fillna(0)
-
-    df_merged = df_merged.rename(columns={'prev_mo_created': module + ' Created ' + date,
-                                          'prev_mo_modified': module + ' Modified ' + date,
-                                          'ytd_created': module + ' Created YTD',
-                                          'prev_mo_collab': module + ' Collaborated Created ' + date,
-                                          'prev_mo_collab_mod': module + ' Collaborated Modified ' + date,
-                                          'ytd_collab': module + ' Collaborated Created YTD'})
     return df_merged
 
 
 # Function to compile the staff report formatted to each agency's specifications
-# dfs: list of record count dfs returned from module_staff_entries()
+# report: dataframe of staff record counts returned from module_staff_entries()
 # agency: string, either 'Extension' or 'CPHP'
-def compile_report(dfs, agency='Extension'):
+def compile_report(report, agency='Extension'):
+    # PeriodArray/Index object for report month
+    prev_month = utils.fiscal_calendar().prev_month
     sort_cols = []
     staff_cols = []
     rename_cols = {}
@@ -115,8 +153,6 @@ def compile_report(dfs, agency='Extension'):
         sort_cols = ['full_name']
         rename_cols = {'full_name': 'Name', 'email': 'Email'}
 
-    report = reduce(lambda left, right: pd.merge(left, right, how='outer', on=staff_cols), dfs)
-
     report = report.sort_values(by=sort_cols)
     report['Total Entries Created ' + prev_month.strftime('%b-%Y')] = report.loc[:, report.columns.str.contains(
         'Created ' + prev_month.strftime('%b-%Y')) & ~report.columns.str.contains('Collaborated ')].sum(axis=1)
@@ -166,28 +202,18 @@ def save_staff_report(dfs, file_path, agency='Extension'):
         freeze_cols = 3
         cond_form = [1, '=A1=TRUE']
 
-    writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
-    for sheetname, df in dfs.items():
-        df.to_excel(writer, sheet_name=sheetname, index=False, freeze_panes=(1, freeze_cols))
-        worksheet = writer.sheets[sheetname]
-        workbook = writer.book
-        red_format = workbook.add_format({'bg_color': '#FFC7CE', 'font_color': '#9C0006'})
-        worksheet.autofilter(0, 0, 0, len(df.columns) - 1)
-        # Highlight staff who have 0 entries for the month
-        worksheet.conditional_format(0, cond_form[0], len(df), cond_form[0],
-                                     {'type': 'formula',
-                                      'criteria': cond_form[1],
-                                      'format': red_format})
-
-        for idx, col in enumerate(df):
-            series = df[col]
-            max_len = max((
-                series.astype(str).map(len).max(),  # len of largest item
-                len(str(series.name))  # len of column name/header
-            )) + 1
-            worksheet.set_column(idx, idx, max_len)
-
-        writer.close()
+    # Highlight staff who have 0 entries for the month
+    zero_entries_format = {'first_col': cond_form[0],
+                           'last_col': cond_form[0],
+                           'type': 'formula',
+                           'criteria': cond_form[1],
+                           'format': 'red'}
+    utils.render_workbook(file_path,
+                          {sheetname: {'df': df,
+                                       'freeze_panes': (1, freeze_cols),
+                                       'conditional_formats': [zero_entries_format]}
+                           for sheetname, df in dfs.items()},
+                          formats={'red': {'bg_color': '#FFC7CE', 'font_color': '#9C0006'}})
 
 
 # Run the Staff Report
@@ -223,27 +249,22 @@ def main(creds,
 
     # Import SNAP-Ed staff
 
-    inep_staff = pd.ExcelFile(staff_list)
-    # Adjust header argument below for actual staff list
-    snap_ed_staff = pd.read_excel(inep_staff, sheet_name='SNAP-Ed Staff List', header=0)
+    roster = utils.load_staff_roster(staff_list)
+    snap_ed_staff = roster.snap_ed_staff.copy()
     snap_ed_staff['NAME'] = snap_ed_staff['NAME'].str.strip()
     snap_ed_staff['E-MAIL'] = snap_ed_staff['E-MAIL'].str.strip()
 
     # Import CPHP staff
 
-    # Adjust header argument below for actual staff list
-    cphp_staff = pd.read_excel(inep_staff, sheet_name='CPHP Staff List', header=0).rename(
-        columns={'Last Name': 'last_name',
-                 'First Name': 'first_name',
-                 'Email Address': 'email'})
-    cphp_staff['full_name'] = cphp_staff['first_name'].map(str) + ' ' + cphp_staff['last_name'].map(str)
-    cphp_staff = cphp_staff.loc[cphp_staff['email'].notnull(), ['full_name', 'email']]
+    cphp_staff = roster.cphp_staff[['full_name', 'email']].copy()
     cphp_staff['email'] = cphp_staff['email'].str.strip()
 
     # Import PEARS users
 
-    pears_users = pd.read_excel(users_export, sheet_name='User Data')
+    pears_users = utils.read_export(users_export, 'User Data')
     pears_users = pears_users.loc[pears_users['is_active'] == 1]
+    # Full name to email index of active users, used to resolve collaborators
+    user_index = utils.UserIndex(pears_users)
 
     # Refactor this data and for loop using the Module class?
     # Desired modules to report on
@@ -260,19 +281,21 @@ def main(creds,
 
     module_ids = ['program_id', 'activity_id', 'coalition_id', 'partnership_id', 'pse_id', 'story_id']
 
-    # Import record creation and collaboration data for each module
+    # Unit column labels for each module in import_modules
 
-    module_dfs = []
+    module_units = ['unit', 'unit', 'coalition_unit', 'partnership_unit', 'pse_unit', 'unit']
 
-    for index, item in enumerate(import_modules):
-        wb = pd.ExcelFile(item[0])
-        # Record creation data
-        # Module records aggregated by the user specified in the 'reported_by' field
-        create_df = pd.read_excel(wb, item[1])
-        # Colloboration data
-        # Module records aggregated by the user(s) specified in the 'collaborators' field
-        collab_df = merge_collaborators(pears_users, create_df, module_ids[index], wb)
-        module_dfs.append([create_df, collab_df])
+    # Import record creation and collaboration data for each module
+
+    # Record creation data
+    # Module records aggregated by the user specified in the 'reported_by' field
+    create_dfs = [utils.read_export(item[0], item[1]) for item in import_modules]
+    # Colloboration data
+    # Module records aggregated by the user(s) specified in the 'collaborators' field
+    collab_dfs = merge_collaborators(user_index, [(create_df, module_ids[index], module_units[index],
+                                                   import_modules[index][0])
+                                                  for index, create_df in enumerate(create_dfs)])
+    module_dfs = list(zip(create_dfs, collab_dfs))
 
     # Create PEARS SNAP-Ed Staff Report
 
@@ -292,20 +315,12 @@ def main(creds,
 
     # For each module, aggregate record creation/collaboration counts by each timeframe
 
-    module_created_collab_dfs = []
-
-    for index, item in enumerate(module_dfs):
-        module_created_collab_dfs.append(created_collab_dfs(item[0], item[1], module_ids[index]))
+    entry_counts = pd.concat([created_collab_counts(item[0], item[1], module_ids[index], modules[index])
+                              for index, item in enumerate(module_dfs)], ignore_index=True)
 
     # Merge record counts for each module with SNAP-Ed staff
-
-    extension_staff_modules = []
-
-    for index, item in enumerate(module_created_collab_dfs):
-        extension_staff_modules.append(module_staff_entries(item, snap_ed_staff, modules[index]))
-
     # Compiled staff report for Extension (SNAP-Ed)
-    extension_report = compile_report(extension_staff_modules)
+    extension_report = compile_report(module_staff_entries(entry_counts, snap_ed_staff, modules))
     # Save extension report
 
     extension_report_dfs = {'Extension Staff PEARS Entries': extension_report}
@@ -316,12 +331,7 @@ def main(creds,
 
     # Create PEARS CPHP Staff Report
 
-    cphp_staff_modules = []
-
-    for index, item in enumerate(module_created_collab_dfs):
-        cphp_staff_modules.append(module_staff_entries(item, cphp_staff, modules[index]))
-
-    cphp_report = compile_report(cphp_staff_modules, agency='CPHP')
+    cphp_report = compile_report(module_staff_entries(entry_counts, cphp_staff, modules), agency='CPHP')
 
     cphp_report_dfs = {'CPHP Staff PEARS Entries': cphp_report}
     cphp_report_filename = report_filename(agency='CPHP')
@@ -335,7 +345,7 @@ def main(creds,
 
         # Email the SNAP-Ed staff report
 
-        extension_report_subject = 'Extension Staff PEARS Entries ' + prev_month.strftime('%Y-%m')
+        extension_report_subject = 'Extension Staff PEARS Entries ' + utils.fiscal_calendar().prev_month_str
         extension_report_text = extension_report_subject + ' attached.'
 
         utils.send_mail(send_from=creds['admin_send_from'],
@@ -352,7 +362,7 @@ def main(creds,
 
         # Email the CPHP staff report
 
-        cphp_report_subject = 'CPHP Staff PEARS Entries ' + prev_month.strftime('%Y-%m')
+        cphp_report_subject = 'CPHP Staff PEARS Entries ' + utils.fiscal_calendar().prev_month_str
         cphp_report_text = cphp_report_subject + ' attached.'
 
         utils.send_mail(send_from=creds['admin_send_from'],
@@ -1,13 +1,9 @@
 import os
+import time
+import importlib
+import traceback
 from datetime import date
-import py_pears.utils as utils
-import py_pears.reports.sites_report as sites_report
-import py_pears.reports.staff_report as staff_report
-import py_pears.reports.monthly_data_cleaning as monthly_data_cleaning
-import py_pears.reports.quarterly_program_evaluation as quarterly_program_evaluation
-import py_pears.reports.partnerships_entry as partnerships_entry
-import py_pears.reports.coalition_survey_cleaning as coalition_survey_cleaning
-import py_pears.reports.partnerships_intervention_type as partnerships_intervention_type
+from concurrent.futures import ProcessPoolExecutor
 
 
 # Calculate the path to the root directory of this package
@@ -28,30 +24,262 @@ NAMES_LIST = TEST_INPUTS_DIR + 'BABY_NAMES_IL.TXT'
 UNIT_COUNTIES = TEST_INPUTS_DIR + 'Illinois Extension Unit Counties.xlsx'
 UPDATE_NOTIFICATIONS = TEST_INPUTS_DIR + 'Update Notifications.xlsx'
 
+# Same directory as utils.SNAPSHOT_DIR, defined here so building the schedule doesn't import utils
+SNAPSHOT_DIR = ROOT_DIR + '/export_cache/snapshots'
+
 # Refactor schedule using OOP?
 
 
 # Compare date to the given year, month, or day
+# Uses the standard library rather than utils.FiscalCalendar, so checking the schedule doesn't import pandas
 # left_date: datetime date that subsequent arguments are compared to (default: date.today())
-# year: int for the year to compare left_date to (default: date.today().year)
-# month: int for the month to compare left_date to (default: date.today().month)
-# day: int for the day to compare left_date to (default: date.today().day)
-def compare_date(left_date=date.today(),
-                 year=date.today().year,
-                 month=date.today().month,
-                 day=date.today().day):
-    return left_date == date(year, month, day)
+# year: int for the year to compare left_date to (default: left_date.year)
+# month: int for the month to compare left_date to (default: left_date.month)
+# day: int for the day to compare left_date to (default: left_date.day)
+def compare_date(left_date=None, year=None, month=None, day=None):
+    left_date = date.today() if left_date is None else left_date
+    return ((year is None or left_date.year == year)
+            and (month is None or left_date.month == month)
+            and (day is None or left_date.day == day))
 
 
-# Compare today's date at the start of each quarter
+# Compare today's date at the start of each fiscal quarter
 # days: int list for the days to today's date to
-def compare_date_quarterly(days):
-    quarter_start_months = [1, 4, 7, 10]
-    for month in quarter_start_months:
-        for day in days:
-            if compare_date(month=month, day=day):
-                return True
-    return False
+# left_date: datetime date to compare (default: date.today())
+def compare_date_quarterly(days, left_date=None):
+    left_date = date.today() if left_date is None else left_date
+    return left_date.month in (1, 4, 7, 10) and left_date.day in days
+
+
+# Class that bundles a report's schedule, required PEARS modules, and main() arguments
+# name: string for the name of the report
+# due: boolean for whether the report is scheduled to run today
+# modules: list of strings for the PEARS modules to download before the report runs
+# func: the report's main() function, or its dotted path (e.g. 'py_pears.reports.sites_report.main')
+# Report modules given by dotted path are only imported when the report runs
+# kwargs: dict of keyword arguments passed to func
+class ScheduledReport:
+    def __init__(self, name, due, modules, func, kwargs):
+        self.name = name
+        self.due = due
+        self.modules = modules
+        self.func = func
+        self.kwargs = kwargs
+
+    def run(self):
+        func = self.func
+        if isinstance(func, str):
+            module_name, func_name = func.rsplit('.', 1)
+            func = getattr(importlib.import_module(module_name), func_name)
+        return func(**self.kwargs)
+
+
+# Compute the union of PEARS modules required by a list of reports
+# reports: list of ScheduledReport objects
+# returns a list of module strings in the order they're first required
+def required_modules(reports):
+    modules = []
+    for report in reports:
+        for module in report.modules:
+            if module not in modules:
+                modules.append(module)
+    return modules
+
+
+# Create the list of scheduled reports
+# Reports that are due today share a single download of their PEARS exports to pears_export_dir
+def scheduled_reports(creds,
+                      pears_export_dir,
+                      prev_year_dir,
+                      coalition_surveys_dir,
+                      staff_list,
+                      names_list,
+                      unit_counties,
+                      update_notifications,
+                      outputs_dir):
+    # Previous year's exports for the annual report, only required if that report is due
+    prev_year_exports = creds.get('pears_prev_year', prev_year_dir)
+
+    return [
+        # Monthly Reports
+
+        # Run Sites Report with default inputs
+        ScheduledReport(name='Sites Report',
+                        due=compare_date(day=2),
+                        modules=['Site', 'User'],
+                        func='py_pears.reports.sites_report.main',
+                        kwargs=dict(creds=creds,
+                                    sites_export=pears_export_dir + "Site_Export.xlsx",
+                                    users_export=pears_export_dir + "User_Export.xlsx",
+                                    output_dir=outputs_dir)),
+
+        # Run Staff Report with default inputs
+        ScheduledReport(name='Staff Report',
+                        due=compare_date(day=11),
+                        modules=['User',
+                                 'Program_Activities',
+                                 'Indirect_Activity',
+                                 'Coalition',
+                                 'Partnership',
+                                 'PSE_Site_Activity',
+                                 'Success_Story'],
+                        func='py_pears.reports.staff_report.main',
+                        kwargs=dict(creds=creds,
+                                    users_export=pears_export_dir + "User_Export.xlsx",
+                                    program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
+                                    indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
+                                    coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
+                                    partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
+                                    pse_site_activities_export=pears_export_dir + "PSE_Site_Activity_Export.xlsx",
+                                    success_stories_export=pears_export_dir + "Success_Story_Export.xlsx",
+                                    staff_list=staff_list,
+                                    output_dir=outputs_dir)),
+
+        # Run Monthly Data Cleaning with default inputs
+        ScheduledReport(name='Monthly Data Cleaning',
+                        due=compare_date(day=12),
+                        modules=['Coalition',
+                                 'Indirect_Activity',
+                                 'Partnership',
+                                 'Program_Activities',
+                                 'PSE_Site_Activity'],
+                        func='py_pears.reports.monthly_data_cleaning.main',
+                        kwargs=dict(creds=creds,
+                                    coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
+                                    indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
+                                    partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
+                                    program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
+                                    pse_site_activities_export=pears_export_dir + "PSE_Site_Activity_Export.xlsx",
+                                    staff_list=staff_list,
+                                    names_list=names_list,
+                                    unit_counties=unit_counties,
+                                    update_notifications=update_notifications,
+                                    output_dir=outputs_dir,
+                                    snapshot_dir=SNAPSHOT_DIR)),
+
+        # Run Monthly Partnerships Entry with default inputs
+        ScheduledReport(name='Partnerships Entry',
+                        due=compare_date(day=20),
+                        modules=['User',
+                                 'Site',
+                                 'Program_Activities',
+                                 'Indirect_Activity',
+                                 'Partnership'],
+                        func='py_pears.reports.partnerships_entry.main',
+                        kwargs=dict(creds=creds,
+                                    users_export=pears_export_dir + "User_Export.xlsx",
+                                    sites_export=pears_export_dir + "Site_Export.xlsx",
+                                    program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
+                                    indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
+                                    partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
+                                    staff_list=staff_list,
+                                    unit_counties=unit_counties,
+                                    prev_year_part_export=prev_year_dir + 'Partnership_Export.xlsx',
+                                    output_dir=outputs_dir)),
+
+        # Quarterly Reports
+
+        # Run Coalition Survey Cleaning with default inputs
+        ScheduledReport(name='Coalition Survey Cleaning',
+                        due=compare_date_quarterly(days=[12, 23]),
+                        modules=['Coalition'],
+                        func='py_pears.reports.coalition_survey_cleaning.main',
+                        kwargs=dict(creds=creds,
+                                    coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
+                                    coalition_surveys_dir=coalition_surveys_dir,
+                                    staff_list=staff_list,
+                                    unit_counties=unit_counties,
+                                    update_notifications=update_notifications,
+                                    output_dir=outputs_dir)),
+
+        # Run Quarterly Program Evaluation with default inputs
+        ScheduledReport(name='Quarterly Program Evaluation',
+                        due=compare_date_quarterly(days=[13]),
+                        modules=['Program_Activities',
+                                 'Indirect_Activity',
+                                 'Coalition',
+                                 'Partnership',
+                                 'PSE_Site_Activity'],
+                        func='py_pears.reports.quarterly_program_evaluation.main',
+                        kwargs=dict(coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
+                                    indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
+                                    partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
+                                    program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
+                                    pse_site_activities_export=pears_export_dir + "PSE_Site_Activity_Export.xlsx",
+                                    output_dir=outputs_dir)),
+
+        # Annual Reports
+
+        # Run Partnerships Intervention Type Cleaning with default inputs
+        ScheduledReport(name='Partnerships Intervention Type',
+                        due=compare_date(month=10, day=4),
+                        modules=['User',
+                                 'Site',
+                                 'Program_Activities',
+                                 'Indirect_Activity',
+                                 'Partnership',
+                                 'PSE_Site_Activity'],
+                        func='py_pears.reports.partnerships_intervention_type.main',
+                        kwargs=dict(creds=creds,
+                                    export_dir=pears_export_dir,
+                                    output_dir=outputs_dir,
+                                    staff_list=staff_list)),
+
+        # Annual Program Evaluation Report
+        # Uses the previous year's exports, so no modules are downloaded
+        # The report month on October 18th is September, so the report defaults to the fiscal year that just ended
+        ScheduledReport(name='Annual Program Evaluation',
+                        due=compare_date(month=10, day=18),
+                        modules=[],
+                        func='py_pears.reports.quarterly_program_evaluation.main',
+                        kwargs=dict(coalitions_export=prev_year_exports + "Coalition_Export.xlsx",
+                                    indirect_activities_export=prev_year_exports + "Indirect_Activity_Export.xlsx",
+                                    partnerships_export=prev_year_exports + "Partnership_Export.xlsx",
+                                    program_activities_export=prev_year_exports + "Program_Activities_Export.xlsx",
+                                    pse_site_activities_export=prev_year_exports + "PSE_Site_Activity_Export.xlsx",
+                                    output_dir=outputs_dir))
+    ]
+
+
+# Run a scheduled report, timing it and capturing any exception it raises
+# report: ScheduledReport object
+# returns a tuple of the report name, run time in seconds, and the traceback string if the report failed (else None)
+def run_report(report):
+    start = time.perf_counter()
+    error = None
+    try:
+        report.run()
+    except Exception:
+        error = traceback.format_exc()
+    return report.name, time.perf_counter() - start, error
+
+
+# Run a list of scheduled reports
+# A report that raises an exception doesn't prevent the remaining reports from running
+# If a worker process dies (e.g. BrokenProcessPool), the reports it takes down are recorded as failed
+# reports: list of ScheduledReport objects
+# max_workers: int for the number of reports to run concurrently in separate processes (default: 1, run in-process)
+# returns a list of run_report() tuples in the order of reports
+def run_reports(reports, max_workers=1):
+    if max_workers > 1 and len(reports) > 1:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(reports))) as executor:
+            futures = [executor.submit(run_report, report) for report in reports]
+            results = []
+            for report, future in zip(reports, futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    results.append((report.name, time.perf_counter() - start, traceback.format_exc()))
+    else:
+        results = [run_report(report) for report in reports]
+
+    for name, seconds, error in results:
+        if error is None:
+            print('%s completed in %.1f seconds.' % (name, seconds))
+        else:
+            print('%s failed after %.1f seconds:\n%s' % (name, seconds, error))
+    return results
 
 
 def main(pears_export_dir=PEARS_EXPORT_DIR,
@@ -61,135 +289,48 @@ def main(pears_export_dir=PEARS_EXPORT_DIR,
          names_list=NAMES_LIST,
          unit_counties=UNIT_COUNTIES,
          update_notifications=UPDATE_NOTIFICATIONS,
-         outputs_dir=OUT_DIR):
+         outputs_dir=OUT_DIR,
+         max_workers=1):
+
+    inputs = dict(pears_export_dir=pears_export_dir,
+                  prev_year_dir=prev_year_dir,
+                  coalition_surveys_dir=coalition_surveys_dir,
+                  staff_list=staff_list,
+                  names_list=names_list,
+                  unit_counties=unit_counties,
+                  update_notifications=update_notifications,
+                  outputs_dir=outputs_dir)
+
+    # Exit before importing pandas, boto3, or any report if nothing is due today
+    if not any(report.due for report in scheduled_reports(creds={}, **inputs)):
+        print('No reports are due today.')
+        return []
+
+    import py_pears.utils as utils
 
     creds = utils.load_org_settings()
 
-    # Monthly Reports
+    # Remove cached export sheets that are no longer needed
+    utils.prune_export_cache()
+
+    reports = scheduled_reports(creds=creds, **inputs)
+    due_reports = [report for report in reports if report.due]
 
-    # Run Sites Report with default inputs
-    if compare_date(day=2):
-        # Download required PEARS exports from S3
+    # Download the PEARS exports required by every report due today in a single pass
+    modules = required_modules(due_reports)
+    if modules:
         utils.download_s3_exports(profile=creds['aws_profile'],
                                   org=creds['s3_organization'],
                                   dst=pears_export_dir,
-                                  modules=['Site', 'User'])
-        sites_report.main(creds=creds,
-                          sites_export=pears_export_dir + "Site_Export.xlsx",
-                          users_export=pears_export_dir + "User_Export.xlsx",
-                          output_dir=outputs_dir)
-
-    # Run Staff Report with default inputs
-    if compare_date(day=11):
-        utils.download_s3_exports(profile=creds['aws_profile'],
-                                  org=creds['s3_organization'],
-                                  modules=['User',
-                                           'Program_Activities',
-                                           'Indirect_Activity',
-                                           'Coalition',
-                                           'Partnership',
-                                           'PSE_Site_Activity',
-                                           'Success_Story'])
-        staff_report.main(creds=creds,
-                          users_export=pears_export_dir + "User_Export.xlsx",
-                          program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
-                          indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
-                          coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
-                          partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
-                          pse_site_activities_export=pears_export_dir + "PSE_Site_Activity_Export.xlsx",
-                          success_stories_export=pears_export_dir + "Success_Story_Export.xlsx",
-                          staff_list=staff_list,
-                          output_dir=outputs_dir)
-
-    # Run Monthly Data Cleaning with default inputs
-    if compare_date(day=12):
-        utils.download_s3_exports(profile=creds['aws_profile'],
-                                  org=creds['s3_organization'],
-                                  modules=['Coalition',
-                                           'Indirect_Activity',
-                                           'Partnership',
-                                           'Program_Activities',
-                                           'PSE_Site_Activity'])
-        monthly_data_cleaning.main(creds=creds,
-                                   coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
-                                   indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
-                                   partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
-                                   program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
-                                   pse_site_activities_export=pears_export_dir + "PSE_Site_Activity_Export.xlsx",
-                                   staff_list=staff_list,
-                                   names_list=names_list,
-                                   unit_counties=unit_counties,
-                                   update_notifications=update_notifications,
-                                   output_dir=outputs_dir)
-
-    # Run Monthly Partnerships Entry with default inputs
-    if compare_date(day=20):
-        utils.download_s3_exports(profile=creds['aws_profile'],
-                                  org=creds['s3_organization'],
-                                  modules=['User',
-                                           'Site',
-                                           'Program_Activities',
-                                           'Indirect_Activity',
-                                           'Partnership'])
-        partnerships_entry.main(creds=creds,
-                                users_export=pears_export_dir + "User_Export.xlsx",
-                                sites_export=pears_export_dir + "Site_Export.xlsx",
-                                program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
-                                indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
-                                partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
-                                staff_list=staff_list,
-                                unit_counties=unit_counties,
-                                prev_year_part_export=prev_year_dir + 'Partnership_Export.xlsx',
-                                output_dir=outputs_dir)
-
-    # Quarterly Reports
-
-    # Run Coalition Survey Cleaning with default inputs
-    if compare_date_quarterly(days=[12, 23]):
-        utils.download_s3_exports(profile=creds['aws_profile'],
-                                  org=creds['s3_organization'],
-                                  modules=['Coalition'])
-        coalition_survey_cleaning.main(creds=creds,
-                                       coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
-                                       coalition_surveys_dir=coalition_surveys_dir,
-                                       staff_list=staff_list,
-                                       unit_counties=unit_counties,
-                                       update_notifications=update_notifications,
-                                       output_dir=outputs_dir)
-
-    # Run Quarterly Program Evaluation with default inputs
-    if compare_date_quarterly(days=[13]):
-        utils.download_s3_exports(profile=creds['aws_profile'],
-                                  org=creds['s3_organization'],
-                                  modules=['Program_Activities',
-                                           'Indirect_Activity',
-                                           'Coalition',
-                                           'Partnership',
-                                           'PSE_Site_Activity'])
-        quarterly_program_evaluation.main(coalitions_export=pears_export_dir + "Coalition_Export.xlsx",
-                                          indirect_activities_export=pears_export_dir + "Indirect_Activity_Export.xlsx",
-                                          partnerships_export=pears_export_dir + "Partnership_Export.xlsx",
-                                          program_activities_export=pears_export_dir + "Program_Activities_Export.xlsx",
-                                          pse_site_activities_export=pears_export_dir + "PSE_Site_Activity_Export.xlsx",
-                                          output_dir=outputs_dir)
-
-    # Annual Reports
-
-    # Run Partnerships Intervention Type Cleaning with default inputs
-    if compare_date(month=10, day=4):
-        partnerships_intervention_type.main(creds=creds,
-                                            export_dir=pears_export_dir,
-                                            output_dir=outputs_dir,
-                                            staff_list=staff_list)
-
-    # Annual Program Evaluation Report
-    if compare_date(month=10, day=18):
-        quarterly_program_evaluation.main(coalitions_export=creds['pears_prev_year'] + "Coalition_Export.xlsx",
-                                          indirect_activities_export=creds['pears_prev_year'] + "Indirect_Activity_Export.xlsx",
-                                          partnerships_export=creds['pears_prev_year'] + "Partnership_Export.xlsx",
-                                          program_activities_export=creds['pears_prev_year'] + "Program_Activities_Export.xlsx",
-                                          pse_site_activities_export=creds['pears_prev_year'] + "PSE_Site_Activity_Export.xlsx",
-                                          output_dir=outputs_dir)
+                                  modules=modules)
+
+    # Parse the staff list once for every report due today
+    # Forked report processes inherit the roster, other processes load it from the export cache
+    if any(report.kwargs.get('staff_list') == staff_list for report in due_reports):
+        utils.load_staff_roster(staff_list)
+
+    # Reports only share read-only inputs, so they can run in parallel processes
+    return run_reports(due_reports, max_workers=max_workers)
 
 
 if __name__ == '__main__':
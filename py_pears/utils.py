@@ -1,9 +1,17 @@
 import os
 import shutil
+import hashlib
+import threading
+import time
+import datetime
 import boto3
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import json
+import xlsxwriter
+from functools import lru_cache, cached_property
 import smtplib
 import ssl
 from email.mime.multipart import MIMEMultipart
@@ -16,71 +24,376 @@ from email import encoders
 # Calculate the path to the root directory of this script
 ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '.'))
 
+# Directory where parsed PEARS export sheets are cached
+EXPORT_CACHE_DIR = ROOT_DIR + '/export_cache'
+
+# Map of custom field value label suffixes to dropdown values
+CUSTOM_FIELD_VALUES = ROOT_DIR + '/custom_field_values.json'
+
+# Directory where snapshots of data cleaning flags are stored for incremental runs
+# Snapshots are kept in a subdirectory so prune_export_cache() doesn't delete them between monthly runs
+SNAPSHOT_DIR = EXPORT_CACHE_DIR + '/snapshots'
+
+# SMTP server used to send emails
+SMTP_HOST = 'smtp.office365.com'
+SMTP_PORT = 587
+
 
 # Download PEARS Exports from AWS S3
+# Exports are downloaded concurrently, and exports whose ETag and size match the manifest of a previous download
+# are skipped
 # profile: string for AWS named profile
 # org: string for the organization's bucket subdirectory (eg. 'uie')
 # date: string in %Y/%m/%d format for the export date (default is today's date)
 # dst: string for destination directory to download PEARS exports to
 # modules: list of strings for the PEARS modules to download
-def download_s3_exports(profile, org, date=pd.to_datetime("today").strftime("%Y/%m/%d"),
-                        dst=ROOT_DIR + "/pears_exports", modules=None):
+# max_workers: int for the number of exports to download concurrently (default: 4)
+# manifest: string for the path of the JSON manifest of downloaded exports
+# (default: a manifest in EXPORT_CACHE_DIR keyed by the path of dst)
+# returns a list of strings for the filenames of the exports in dst
+def download_s3_exports(profile, org, date=None, dst=ROOT_DIR + "/pears_exports", modules=None, max_workers=4,
+                        manifest=None):
+    if date is None:
+        date = pd.to_datetime("today").strftime("%Y/%m/%d")
+
     # Use PEARS AWS S3 credentials
     session = boto3.Session(profile_name=profile)
 
     # Access S3 objects uploaded the day reformatting script is run
+    # Clients are thread-safe, so a single client is shared by the download threads
     conn = session.client('s3')
     my_bucket = 'exports.pears.oeie.org'
 
-    response = conn.list_objects_v2(
-        Bucket=my_bucket,
-        Prefix=org + '/' + date + '/',
-        MaxKeys=100)
-
     # Create a list of filenames to download from the S3
     # Might need additional string operations (capitalization, spaces to underscores)
     # Throw exception for invalid modules
-    # What happens if modules is None? > 'NoneType' object is not iterable
-    # Add _Export.xlsx for all exc
     module_filenames = []
     if modules is not None:
         module_filenames = [s + '_Export.xlsx' for s in modules]
 
-    # Download the Excel files to the destination directory
-    for f in response['Contents']:
-        file = f['Key']
-        filename = file[file.rfind('/') + 1:]
-        if modules is not None and filename not in module_filenames:
+    # List every export for the date, following continuation tokens past a single page of keys
+    objects = {}
+    paginator = conn.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=my_bucket, Prefix=org + '/' + date + '/'):
+        for f in page.get('Contents', []):
+            file = f['Key']
+            filename = file[file.rfind('/') + 1:]
+            if modules is not None and filename not in module_filenames:
+                continue
+            objects[filename] = f
+
+    # The manifest is kept out of dst so the export directory only contains PEARS exports
+    if manifest is None:
+        dst_hash = hashlib.sha256(os.path.realpath(dst).encode('utf-8')).hexdigest()[:16]
+        manifest = EXPORT_CACHE_DIR + '/s3_manifest_' + dst_hash + '.json'
+    downloaded = {}
+    if os.path.isfile(manifest):
+        with open(manifest) as manifest_f:
+            downloaded = json.load(manifest_f)
+
+    # Skip exports that are already on disk and unchanged since they were downloaded
+    to_download = []
+    for filename, f in objects.items():
+        local_file = dst + '/' + filename
+        entry = downloaded.get(filename, {})
+        if (entry.get('etag') == f['ETag'] and entry.get('size') == f['Size']
+                and os.path.isfile(local_file) and os.path.getsize(local_file) == f['Size']):
             continue
-        conn.download_file(my_bucket, file, dst + '/' + filename)
+        to_download.append(filename)
+
+    # Download the Excel files to the destination directory with the boto3 transfer manager
+    config = TransferConfig(max_concurrency=max_workers)
+
+    def download(filename):
+        conn.download_file(my_bucket, objects[filename]['Key'], dst + '/' + filename, Config=config)
+        return filename
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for filename in executor.map(download, to_download):
+                downloaded[filename] = {'etag': objects[filename]['ETag'], 'size': objects[filename]['Size']}
+    finally:
+        os.makedirs(os.path.dirname(manifest) or '.', exist_ok=True)
+        with open(manifest, 'w') as manifest_f:
+            json.dump(downloaded, manifest_f, indent=2)
+
+    return list(objects)
+
+
+# Memo of export content hashes, keyed by (path, size, mtime) so each file is hashed once per process
+_export_hashes = {}
+
+
+# Compute the SHA-256 hash of a file's contents
+# file: string for the path of the file to hash
+# chunk_size: int for the number of bytes to read at a time (default: 1 MiB)
+def file_hash(file, chunk_size=1024 * 1024):
+    stat = os.stat(file)
+    key = (os.path.realpath(file), stat.st_size, stat.st_mtime_ns)
+    if key not in _export_hashes:
+        sha = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        _export_hashes[key] = sha.hexdigest()
+    return _export_hashes[key]
+
+
+# Read a sheet of a PEARS export, parsing the workbook only if the sheet isn't already cached
+# Parsed sheets are pickled to cache_dir keyed by the export's content hash,
+# so an export that hasn't changed is only parsed once no matter how many reports read it
+# Cache hits refresh the cached sheet's modification time, so prune_export_cache() keeps recently used sheets
+# export: string for the path of the PEARS export workbook
+# sheet_name: string for the label of the sheet to read
+# cache_dir: string for the directory of cached sheets (default: EXPORT_CACHE_DIR), None disables the cache
+def read_export(export, sheet_name, cache_dir=EXPORT_CACHE_DIR):
+    if cache_dir is None:
+        return pd.read_excel(export, sheet_name=sheet_name)
+    # Sheet names are hashed so names that only differ in punctuation or spacing never share a cache file
+    sheet_hash = hashlib.sha256(sheet_name.encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, file_hash(export) + '_' + sheet_hash + '.pkl')
+    if os.path.isfile(cache_file):
+        os.utime(cache_file)
+        return pd.read_pickle(cache_file)
+    df = pd.read_excel(export, sheet_name=sheet_name)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so concurrent readers never load a partial pickle
+    tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    df.to_pickle(tmp_file)
+    os.replace(tmp_file, cache_file)
+    return df
+
+
+# Delete cached export sheets and name sets that haven't been used within the given number of days
+# Reading a cached file refreshes its modification time, so only files unused for max_age_days are deleted
+# cache_dir: string for the directory of cached sheets (default: EXPORT_CACHE_DIR)
+# max_age_days: int for the number of days cached sheets are kept (default: 7)
+def prune_export_cache(cache_dir=EXPORT_CACHE_DIR, max_age_days=7):
+    if not os.path.isdir(cache_dir):
+        return
+    cutoff = pd.Timestamp.now().timestamp() - max_age_days * 24 * 60 * 60
+    for filename in os.listdir(cache_dir):
+        file_path = os.path.join(cache_dir, filename)
+        if filename.endswith('.pkl') and os.path.getmtime(file_path) < cutoff:
+            os.unlink(file_path)
+
+
+# Load the set of distinct names from a names file
+# The set is pickled to cache_dir keyed by the file's content hash, so the names file is only parsed once
+# names_list: string for the path of a comma-delimited names file (state, sex, year, name, frequency)
+# Source: https://www.ssa.gov/oact/babynames/state/
+# cache_dir: string for the directory of cached name sets (default: EXPORT_CACHE_DIR), None disables the cache
+def load_names(names_list, cache_dir=EXPORT_CACHE_DIR):
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'names_' + file_hash(names_list) + '.pkl')
+        if os.path.isfile(cache_file):
+            os.utime(cache_file)
+            return pd.read_pickle(cache_file)
+    names = pd.read_csv(names_list,
+                        delimiter=",",
+                        names=['state', 'sex', 'year', 'name', 'frequency'])
+    names = frozenset(names['name'].drop_duplicates().astype(str))
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+        pd.to_pickle(names, tmp_file)
+        os.replace(tmp_file, cache_file)
+    return names
+
+
+# Flag values of the form "<first> <last>" that likely contain an individual's name
+# A value is flagged if it contains exactly one space, the word before the space ends in a name from names,
+# and it doesn't contain any of the exclude terms
+# Each distinct first word is only checked once, with a set lookup per suffix of the word
+# values: Series of strings to flag
+# names: set of names, see load_names()
+# exclude_terms: list of regex terms indicating false positives
+def flag_individual_names(values, names, exclude_terms=[]):
+    two_words = values.str.count(' ').eq(1)
+    first_words = values[two_words].str.split(' ', n=1).str[0]
+    codes, uniques = pd.factorize(first_words)
+    matched = np.array([any(word[i:] in names for i in range(len(word) + 1)) for word in uniques], dtype=bool)
+    flags = pd.Series(False, index=values.index)
+    flags[two_words] = matched[codes]
+    if exclude_terms:
+        flags &= ~values.str.contains('|'.join(exclude_terms), na=False)
+    return flags
+
+
+# Fingerprint each record by the content of its row and its child records' rows
+# records: dataframe of parent records, with one row per record
+# id_col: column label of the record id shared by records and children
+# children: list of dataframes of child records
+# returns a uint64 array of fingerprints aligned with records
+def record_fingerprints(records, id_col, children=()):
+    fingerprints = pd.util.hash_pandas_object(records, index=False).values.copy()
+    record_positions = pd.Index(records[id_col])
+    for child in children:
+        child_hashes = pd.util.hash_pandas_object(child, index=False).values
+        positions = record_positions.get_indexer(child[id_col])
+        matched = positions >= 0
+        # Unsigned addition wraps, so child hashes combine without overflow regardless of their order
+        np.add.at(fingerprints, positions[matched], child_hashes[matched])
+    return fingerprints
+
+
+# Flag records incrementally, re-evaluating only records that changed since the previous run's snapshot
+# The snapshot stores each record's modified timestamp and fingerprint (see record_fingerprints()) by record id,
+# along with the flagged rows of the previous run
+# Records are re-evaluated if they're new, their modified timestamp or fingerprint changed,
+# they share group_cols values with a changed or removed record,
+# or one of their flagged rows has a time_cols value that passed since the previous run
+# records: dataframe of parent records to flag, with one row per record
+# id_col: column label of the record id shared by records and children
+# flag: function of records and children (in order) that returns the dataframe of flagged rows, with id_col
+# children: list of dataframes of child records, filtered to the records being re-evaluated
+# snapshot_file: string for the path of the snapshot, None evaluates every record without a snapshot (default: None)
+# context: tuple of strings for inputs other than records that flags depend on, such as file hashes and report
+#          year bounds, a snapshot with a different context is discarded (default: ())
+# group_cols: list of lists of column labels that flags compare records by, such as in DataFrame.duplicated()
+# time_cols: list of column labels of flagged rows compared to ts
+# ts: timestamp of this run (default: now)
+# returns the dataframe of flagged rows, equivalent to flag(records, *children)
+def incremental_flags(records, id_col, flag, children=(), snapshot_file=None, context=(), group_cols=(),
+                      time_cols=(), ts=None):
+    if snapshot_file is None:
+        return flag(records, *children)
+    if ts is None:
+        ts = pd.to_datetime("today")
+    context_key = hashlib.sha256(repr(tuple(context)).encode()).hexdigest()
+    group_labels = list(dict.fromkeys(col for cols in group_cols for col in cols))
+
+    fingerprints = records[[id_col] + group_labels].copy()
+    fingerprints['modified'] = records['modified'] if 'modified' in records else np.nan
+    fingerprints['fingerprint'] = record_fingerprints(records, id_col, children)
+
+    snapshot = None
+    if os.path.isfile(snapshot_file):
+        snapshot = pd.read_pickle(snapshot_file)
+        if snapshot['context'] != context_key:
+            snapshot = None
+
+    if snapshot is None:
+        flagged = flag(records, *children)
+    else:
+        prev = snapshot['fingerprints']
+        positions = pd.Index(prev[id_col]).get_indexer(records[id_col])
+        known = positions >= 0
+        positions = np.where(known, positions, 0)
+        if len(prev) == 0:
+            unchanged = known
+        else:
+            prev_modified = pd.Series(prev['modified'].values[positions], index=records.index)
+            unchanged = (known
+                         & (prev['fingerprint'].values[positions] == fingerprints['fingerprint'].values)
+                         & ((prev_modified == fingerprints['modified'])
+                            | (prev_modified.isnull() & fingerprints['modified'].isnull())).values)
+        dirty = pd.Series(~unchanged, index=records.index)
+        # Records that share group values with a changed or removed record
+        stale = prev.loc[prev[id_col].isin(records.loc[dirty, id_col]) | ~prev[id_col].isin(records[id_col])]
+        for cols in group_cols:
+            keys = pd.concat([records.loc[dirty, cols], stale[cols]]).drop_duplicates()
+            shared = records[cols].merge(keys, how='left', on=cols, indicator=True)['_merge'] == 'both'
+            dirty |= pd.Series(shared.values, index=records.index)
+        # Records with flagged rows whose times have passed since the previous run
+        cached = snapshot['flags']
+        for col in time_cols:
+            dirty |= records[id_col].isin(cached.loc[(cached[col] >= snapshot['ts']) & (cached[col] < ts), id_col])
+
+        flagged = [cached.loc[cached[id_col].isin(records.loc[~dirty, id_col])]]
+        if dirty.any():
+            dirty_ids = records.loc[dirty, id_col]
+            flagged.append(flag(records.loc[dirty], *[child.loc[child[id_col].isin(dirty_ids)] for child in children]))
+        flagged = pd.concat([df for df in flagged if not df.empty] or flagged[:1])
+        # Restore the order a full evaluation returns flagged rows in, which follows the order of records
+        record_order = pd.Series(np.arange(len(records)), index=records[id_col].values)
+        flagged = flagged.iloc[np.argsort(record_order.loc[flagged[id_col]].values, kind='stable')]
+        flagged = flagged.reset_index(drop=True)
+
+    os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+    tmp_file = snapshot_file + '.' + str(os.getpid()) + '.tmp'
+    pd.to_pickle({'context': context_key, 'ts': ts, 'fingerprints': fingerprints, 'flags': flagged}, tmp_file)
+    os.replace(tmp_file, snapshot_file)
+    return flagged
+
+
+# Load the map of custom field value label suffixes to their dropdown values
+# New PEARS custom field values only need to be added to custom_field_values.json
+# file: string for the path of the JSON map (default: CUSTOM_FIELD_VALUES)
+@lru_cache(maxsize=None)
+def load_custom_field_values(file=CUSTOM_FIELD_VALUES):
+    with open(file) as f:
+        return json.load(f)
 
 
 # Function to convert custom field's label to its dropdown value
+# Conversions are memoized, so each binary column label is only converted once per process
 # text: string value of the label suffix
 # custom_field_label: string for the custom field label's prefix
+@lru_cache(maxsize=None)
 def replace_all(text, custom_field_label):
-    dic = {
-        custom_field_label: '',
-        # Map label suffixes to response options
-        'family_life': 'Family Life',
-        'nutrition_wellness': 'Nutrition & Wellness',
-        'consumer_economics': 'Consumer Economics',
-        'snap_ed': 'SNAP-Ed',
-        'efnep': 'EFNEP',
-        'improve_diet_quality': 'Improve diet quality',
-        'increase_physical_activity_opportunities': 'Increase physical activity opportunities',
-        'increase_food_access': 'Increase food access',
-        'none': 'None',
-        'abcs_of_school_nutrition': 'ABCs of School Nutrition',
-        'growing_together_illinois': 'Growing Together Illinois',
-        'heat': 'HEAT',
-        'cphp_shape_up_chicago_youth_trainers': 'CPHP - Shape Up Chicago Youth Trainers',
-        'cphp_chicago_grows_groceries': 'CPHP - Chicago Grows Groceries',
-        '_': '',
-    }
-    for i, j in dic.items():
-        text = text.replace(i, j)
-    return text
+    custom_field_values = load_custom_field_values()
+    suffix = text.replace(custom_field_label, '')
+    value = custom_field_values.get(suffix.strip('_'))
+    if value is not None:
+        return value
+    # Labels without an exact match have each known suffix replaced in turn
+    for i, j in custom_field_values.items():
+        suffix = suffix.replace(i, j)
+    return suffix.replace('_', '')
+
+
+# Collapse a custom field's value binary columns into a Series of list-like strings
+# binary_df: dataframe of the custom field's value binary columns
+# custom_field_label: string for the custom field label
+def collapse_binary_cols(binary_df, custom_field_label):
+    values = np.array([replace_all(col, custom_field_label) for col in binary_df.columns], dtype=object)
+    is_one = binary_df.eq(1).to_numpy()
+    is_zero = binary_df.eq(0).to_numpy()
+    binary_rows = (is_one | is_zero).all(axis=1)
+    collapsed = np.full(len(binary_df), np.nan, dtype=object)
+
+    # Rows of only 0/1 values share a small number of distinct patterns, so each pattern is joined once
+    if binary_rows.any():
+        row_bits = is_one[binary_rows]
+        if row_bits.shape[1] < 63:
+            # Pack each row's bits into an integer code and factorize the codes with a hash table
+            bit_weights = np.left_shift(1, np.arange(row_bits.shape[1], dtype=np.int64))
+            inverse, codes = pd.factorize(row_bits.astype(np.int64) @ bit_weights)
+            patterns = (codes[:, None] & bit_weights).astype(bool)
+        else:
+            patterns, inverse = np.unique(row_bits, axis=0, return_inverse=True)
+        joined = np.array([','.join(value for value in values[pattern] if value) or np.nan for pattern in patterns],
+                          dtype=object)
+        collapsed[binary_rows] = joined[inverse.reshape(-1)]
+
+    # Any other values (eg. missing values) are kept as strings in the list, column by column
+    if not binary_rows.all():
+        tokens = np.where(is_one, values, np.where(is_zero, '', binary_df.to_numpy().astype(str)))[~binary_rows]
+        other = tokens[:, 0].astype(object)
+        for col_idx in range(1, tokens.shape[1]):
+            other = other + ',' + tokens[:, col_idx]
+        other = pd.Series(other, dtype=object).str.strip(',').str.replace(r',+', ',', regex=True)
+        collapsed[~binary_rows] = other.where(other != '', np.nan).to_numpy()
+
+    return pd.Series(collapsed, index=binary_df.index, dtype=object)
+
+
+# Convert a custom field's value binary columns into a multi-hot dataframe of its dropdown values
+# Columns are the dropdown values in the order of the binary columns, values other than 1 (eg. missing values) are False
+# df: dataframe of records with the custom field's value binary columns, before reformat() collapses them
+# custom_field_label: string for the custom field label
+def custom_field_indicators(df, custom_field_label):
+    labels = df.columns.str.replace(r'_custom_data', '')
+    is_binary = labels.str.contains(custom_field_label)
+    values = [replace_all(label, custom_field_label) for label in labels[is_binary]]
+    indicators = pd.DataFrame(df.loc[:, is_binary].eq(1).to_numpy(), index=df.index, columns=values)
+    # Drop the collapsed custom field column, if df was already reformatted
+    indicators = indicators.loc[:, indicators.columns != '']
+    if indicators.columns.duplicated().any():
+        indicators = indicators.groupby(level=0, axis=1, sort=False).any()
+    return indicators
 
 
 # Convert custom field value binary columns into a single custom field column of list-like strings
@@ -94,15 +407,8 @@ def reformat(df, labels):
         binary_cols = reformatted_df.columns[reformatted_df.columns.str.contains(label)]
         if binary_cols.empty:
             continue
-        for col in binary_cols:
-            reformatted_df.loc[reformatted_df[col] == 1, col] = replace_all(col, label)
-            reformatted_df.loc[reformatted_df[col] == 0, col] = ''
         # Create custom field column of list-like strings
-        reformatted_df[label] = reformatted_df[binary_cols].apply(lambda row:
-                                                                  ','.join(row.values.astype(str)),
-                                                                  axis=1).str.strip(',').str.replace(r',+',
-                                                                                                     ',', regex=True)
-        reformatted_df.loc[reformatted_df[label] == '', label] = np.nan
+        reformatted_df[label] = collapse_binary_cols(reformatted_df[binary_cols], label)
         # Remove custom field value binary columns
         reformatted_df.drop(columns=binary_cols, inplace=True)
     return reformatted_df
@@ -111,35 +417,170 @@ def reformat(df, labels):
 # Return the previous month
 # return_type: either 'datetime', 'period', '%m', '%Y-%m' (default: 'datetime')
 def previous_month(return_type='datetime'):
-    prev_month = pd.to_datetime("today") - pd.DateOffset(months=1)
+    calendar = fiscal_calendar()
     if return_type == 'datetime':
-        return prev_month
+        return calendar.prev_month_dt
     elif return_type == 'period':
-        return prev_month.to_period('M')
+        return calendar.prev_month
     elif return_type == '%m':
-        return prev_month.strftime('%m')
+        return calendar.prev_month_dt.strftime('%m')
     elif return_type == '%Y-%m':
-        return prev_month.strftime('%Y-%m')
+        return calendar.prev_month_str
+
+
+# Fiscal quarters keyed by the month (%m) that ends them
+FISCAL_QUARTERS = pd.DataFrame({'month': ['12', '03', '06', '09'],
+                                'fq': ['Q1', 'Q2', 'Q3', 'Q4'],
+                                'fq_int': [1, 2, 3, 4],
+                                'survey_fq': ['Quarter 1 (October-December)', 'Quarter 2 (January-March)',
+                                              'Quarter 3 (April-June)', 'Quarter 4 (July-September)']})
 
 
 # Return a DataFrame of datatypes associated with the previous fiscal quarter
+# Report all four quarters (Q4), if previous month isn't the end of a quarter
 # columns: any of 'fq', 'fq_int', 'month', 'survey_fq'
-# UPDATE: Implement a try-catch?
-def previous_fq(columns='fq'):
-    fq_lookup = pd.DataFrame({'month': ['12', '03', '06', '09'],
-                              'fq': ['Q1', 'Q2', 'Q3', 'Q4'],
-                              'fq_int': [1, 2, 3, 4],
-                              'survey_fq': ['Quarter 1 (October-December)', 'Quarter 2 (January-March)',
-                                            'Quarter 3 (April-June)', 'Quarter 4 (July-September)']})
-
-    prev_month = previous_month(return_type='%m')
+# prev_month: string for the previous month as '%m' (default: previous_month(return_type='%m'))
+def previous_fq(columns='fq', prev_month=None):
+    fq_lookup = FISCAL_QUARTERS
+    if prev_month is None:
+        prev_month = fiscal_calendar().prev_month_dt.strftime('%m')
     if prev_month not in fq_lookup['month'].values.tolist():
-        return fq_lookup.loc[fq_lookup['month'] == 'Q4', columns]
+        return fq_lookup.loc[fq_lookup['fq'] == 'Q4', columns]
     else:
         return fq_lookup.loc[fq_lookup['month'] == prev_month, columns]
 
 
-# IMPLEMENT def current_fy()
+# First fiscal year covered by FiscalCalendar boundaries
+FIRST_FISCAL_YEAR = 2015
+
+# Start of each report quarter as (year offset from the fiscal year, '%m-%d')
+# Records for a quarter are entered by the 10th day of the following quarter,
+# and the final bound is the day the Annual Program Evaluation is run
+REPORT_QUARTER_STARTS = [(-1, '10-01'), (0, '01-11'), (0, '04-11'), (0, '07-11'), (0, '10-18')]
+
+
+# Report periods relative to the day a report is run
+# Each period is computed on first use, so importing a report doesn't compute any dates
+# Fiscal years start October 1st, boundaries are numpy.datetime64 arrays for bucketing dates with searchsorted
+# today: datetime for the day the report is run (default: pd.to_datetime('today'))
+class FiscalCalendar:
+    def __init__(self, today=None):
+        self._today = today
+
+    @cached_property
+    def today(self):
+        return pd.to_datetime('today') if self._today is None else pd.Timestamp(self._today)
+
+    # Datetime one month before today
+    @cached_property
+    def prev_month_dt(self):
+        return self.today - pd.DateOffset(months=1)
+
+    # Period object for the report month
+    @cached_property
+    def prev_month(self):
+        return self.prev_month_dt.to_period('M')
+
+    # String for the report month as '%Y-%m'
+    @cached_property
+    def prev_month_str(self):
+        return self.prev_month_dt.strftime('%Y-%m')
+
+    # Start date of the report period
+    @cached_property
+    def prev_month_lb(self):
+        return (self.today.date().replace(day=1) - pd.DateOffset(months=1)).date()
+
+    # End date of the report period
+    # Prior month's records are typically entered by the 10th day of subsequent month
+    @cached_property
+    def prev_month_ub(self):
+        return self.today.date().replace(day=10)
+
+    # Dict of the previous fiscal quarter's 'month', 'fq', 'fq_int', and 'survey_fq'
+    @cached_property
+    def previous_fq(self):
+        fq_df = previous_fq(columns=FISCAL_QUARTERS.columns.tolist(),
+                            prev_month=self.prev_month_dt.strftime('%m'))
+        return fq_df.iloc[0].to_dict()
+
+    @property
+    def fq(self):
+        return self.previous_fq['fq']
+
+    @property
+    def fq_int(self):
+        return int(self.previous_fq['fq_int'])
+
+    @property
+    def survey_fq(self):
+        return self.previous_fq['survey_fq']
+
+    # Fiscal year of the report month
+    @cached_property
+    def fy(self):
+        return self.prev_month_dt.year + int(self.prev_month_dt.month >= 10)
+
+    # First day of each fiscal year from FIRST_FISCAL_YEAR through the next fiscal year,
+    # followed by the first day of the fiscal year after that
+    @cached_property
+    def fy_bounds(self):
+        return np.arange(np.datetime64(str(FIRST_FISCAL_YEAR - 1) + '-10'),
+                         np.datetime64(str(self.fy + 1) + '-10') + 1, 12, dtype='datetime64[M]').astype('datetime64[D]')
+
+    # First day of each fiscal quarter over the same span as fy_bounds
+    @cached_property
+    def quarter_bounds(self):
+        return np.arange(self.fy_bounds[0].astype('datetime64[M]'), self.fy_bounds[-1].astype('datetime64[M]') + 1, 3,
+                         dtype='datetime64[M]').astype('datetime64[D]')
+
+    # Return the lower/upper bounds of each report quarter of a fiscal year
+    # fy: int for the fiscal year (default: the fiscal year of the report month)
+    def report_quarter_bounds(self, fy=None):
+        fy = self.fy if fy is None else fy
+        return np.array([str(fy + offset) + '-' + month_day for offset, month_day in REPORT_QUARTER_STARTS],
+                        dtype='datetime64[D]')
+
+    # Index of the bucket each date falls in, or -1 for missing dates and dates outside the bounds
+    # Lower bounds are inclusive, upper bounds are exclusive
+    @staticmethod
+    def _bucket(series, bounds):
+        dates = pd.to_datetime(series).to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+        buckets = np.searchsorted(bounds, dates, side='right') - 1
+        buckets[np.isnat(dates) | (buckets >= len(bounds) - 1)] = -1
+        return buckets
+
+    # Return the fiscal year of each date in a series, 0 for missing dates and dates outside fy_bounds
+    # series: series of dates
+    def assign_fiscal_year(self, series):
+        buckets = self._bucket(series, self.fy_bounds)
+        return pd.Series(np.where(buckets >= 0, FIRST_FISCAL_YEAR + buckets, 0), index=series.index)
+
+    # Return the quarter of each date in a series, 0 for missing dates and dates outside the bounds
+    # series: series of dates
+    # bounds: array of dates for the lower/upper bounds of each quarter, e.g. report_quarter_bounds()
+    # (default: fiscal quarters from quarter_bounds)
+    def assign_quarter(self, series, bounds=None):
+        if bounds is None:
+            buckets = self._bucket(series, self.quarter_bounds)
+            quarters = buckets % 4 + 1
+        else:
+            buckets = self._bucket(series, np.asarray(bounds, dtype='datetime64[D]'))
+            quarters = buckets + 1
+        return pd.Series(np.where(buckets >= 0, quarters, 0), index=series.index)
+
+
+_fiscal_calendars = {}
+
+
+# Return the FiscalCalendar for today, shared by every report run on the same day
+# today: datetime for the day the report is run (default: pd.to_datetime('today'))
+def fiscal_calendar(today=None):
+    today = pd.to_datetime('today') if today is None else pd.Timestamp(today)
+    key = today.date()
+    if key not in _fiscal_calendars:
+        _fiscal_calendars[key] = FiscalCalendar(today)
+    return _fiscal_calendars[key]
 
 
 # Select records from PEARS module export
@@ -177,6 +618,122 @@ def reorder_name(df, name_field, reordered_name_field, drop_substr_fields=False)
     return out_df
 
 
+# Memo of parsed staff rosters, keyed by (path, mtime) so a staff list is only parsed again once it's modified
+_staff_rosters = {}
+
+
+# Staff list workbook parsed into the staff frames and lookups shared by reports
+# Sheets are read with read_export(), so reports running in separate processes share the parsed sheets,
+# use load_staff_roster() to share the roster itself between reports in the same process
+# Frames are shared between reports, so copy them before modifying them
+# staff_list: path to the staff list Excel workbook
+# cache_dir: string for the directory of cached sheets (default: EXPORT_CACHE_DIR), None disables the cache
+class StaffRoster:
+    def __init__(self, staff_list, cache_dir=EXPORT_CACHE_DIR):
+        def read(sheet_name):
+            return read_export(staff_list, sheet_name, cache_dir=cache_dir)
+
+        self.snap_ed_staff = read('SNAP-Ed Staff List')
+        self.heat_staff = read('HEAT Project Staff')
+        self.state_staff = read('FCS State Office')
+        staff_cols = ['NAME', 'E-MAIL']
+        staff_dfs = [self.snap_ed_staff[staff_cols], self.heat_staff[staff_cols], self.state_staff[staff_cols]]
+        inep_staff = pd.concat(staff_dfs, ignore_index=True).rename(columns={'E-MAIL': 'email'})
+        inep_staff = inep_staff.loc[~inep_staff.isnull().any(axis=1)]
+        inep_staff = reorder_name(inep_staff, 'NAME', 'full_name')
+
+        cphp_staff = read('CPHP Staff List').rename(columns={'Last Name': 'last_name',
+                                                             'First Name': 'first_name',
+                                                             'Email Address': 'email'})
+        cphp_staff['full_name'] = cphp_staff['first_name'].map(str) + ' ' + cphp_staff['last_name'].map(str)
+        self.cphp_staff = cphp_staff.loc[cphp_staff['email'].notnull(),
+                                         ['email', 'first_name', 'last_name', 'full_name']]
+
+        # Current staff, with email, first_name, last_name and full_name columns
+        self.staff = pd.concat([inep_staff.drop(columns='NAME'), self.cphp_staff],
+                               ignore_index=True).drop_duplicates()
+
+        # Lookup table for unit to regional educators
+        re_lookup = read("RE's and CD's")[['UNIT #', 'REGIONAL EDUCATOR', 'RE E-MAIL']]
+        re_lookup = re_lookup.assign(**{'REGIONAL EDUCATOR': re_lookup['REGIONAL EDUCATOR'].str.replace(', Interim',
+                                                                                                        '')})
+        re_lookup = re_lookup.drop_duplicates()
+        re_lookup = reorder_name(re_lookup, 'REGIONAL EDUCATOR', 'REGIONAL EDUCATOR', drop_substr_fields=True)
+        re_lookup['UNIT #'] = re_lookup['UNIT #'].astype(str)
+        self.re_lookup = re_lookup
+
+        # Former staff, used to send former staff's updates to the evaluation team
+        former_staff = read('Former Staff')
+        self.former_staff = former_staff.assign(email=former_staff['NETID'].map(str) + '@illinois.edu')
+
+        # Indexed lookups, the first row of a duplicated email or unit is used
+        staff = self.staff.drop_duplicates(subset='email')
+        self.first_names = dict(zip(staff['email'], staff['first_name']))
+        self.full_names = dict(zip(staff['email'], staff['full_name']))
+        re_lookup = re_lookup.drop_duplicates(subset='UNIT #')
+        self.regional_educators = dict(zip(re_lookup['UNIT #'], zip(re_lookup['REGIONAL EDUCATOR'],
+                                                                    re_lookup['RE E-MAIL'])))
+        self.state_staff_emails = frozenset(self.state_staff['E-MAIL'])
+        self.former_staff_emails = frozenset(self.former_staff['email'])
+
+    # Check if an email belongs to current staff
+    def is_current(self, email):
+        return email in self.first_names
+
+    # Get the first name of a current staff member, used in email salutations
+    def first_name(self, email):
+        return self.first_names[email]
+
+    # Get the full name of a current staff member
+    def full_name(self, email):
+        return self.full_names[email]
+
+    # Get a (name, email) tuple of a unit's Regional Educator, or None if the unit doesn't have one
+    # unit: string for the unit number
+    def regional_educator(self, unit):
+        return self.regional_educators.get(unit)
+
+
+# Load the staff roster of a staff list, parsing the workbook only if it's modified since it was last loaded
+# staff_list: path to the staff list Excel workbook
+# cache_dir: string for the directory of cached sheets (default: EXPORT_CACHE_DIR), None disables the cache
+def load_staff_roster(staff_list, cache_dir=EXPORT_CACHE_DIR):
+    key = (os.path.realpath(staff_list), os.stat(staff_list).st_mtime_ns, cache_dir)
+    if key not in _staff_rosters:
+        _staff_rosters[key] = StaffRoster(staff_list, cache_dir=cache_dir)
+    return _staff_rosters[key]
+
+
+# Index of PEARS user identities for resolving full names (eg. in 'Collaborators' sheets) to email addresses
+# Each name resolves to at most one email, so users that share a name aren't counted once per match
+# Names shared by users with different emails are resolved by unit, if only one of them is in the record's unit,
+# otherwise they're left unresolved and listed in shared_names
+# users: dataframe of PEARS users with 'full_name', 'email', and 'unit' columns
+class UserIndex:
+    def __init__(self, users):
+        identities = users[['full_name', 'email']].dropna().drop_duplicates()
+        is_shared = identities['full_name'].duplicated(keep=False)
+        self.emails = dict(zip(identities.loc[~is_shared, 'full_name'], identities.loc[~is_shared, 'email']))
+        self.shared_names = set(identities.loc[is_shared, 'full_name'])
+
+        unit_identities = users.loc[users['full_name'].isin(self.shared_names),
+                                    ['full_name', 'unit', 'email']].dropna().drop_duplicates()
+        unit_identities = unit_identities.loc[~unit_identities.duplicated(['full_name', 'unit'], keep=False)]
+        self.unit_emails = dict(zip(zip(unit_identities['full_name'], unit_identities['unit']),
+                                    unit_identities['email']))
+
+    # Resolve a series of full names to emails, NaN for names that can't be resolved
+    # names: series of user full names
+    # units: series of units with the same index as names, used to resolve shared names (default: None)
+    def resolve(self, names, units=None):
+        emails = names.map(self.emails).to_numpy(dtype=object)
+        if units is not None and self.unit_emails:
+            is_shared = names.isin(self.shared_names).to_numpy()
+            shared_identities = pd.Series(list(zip(names[is_shared], units[is_shared])), dtype=object)
+            emails[is_shared] = shared_identities.map(self.unit_emails).to_numpy(dtype=object)
+        return pd.Series(emails, index=names.index, dtype=object)
+
+
 # Convert county values in the 'unit' field to units
 # data: dataframe of PEARS module data
 # unit_field: string for the label of the unit field (default: 'unit')
@@ -191,14 +748,119 @@ def counties_to_units(data, unit_field='unit', unit_counties=pd.DataFrame()):
     return out_data
 
 
+# Memo of update notification indexes, keyed by the workbook's content hash and sheet name
+_update_note_indexes = {}
+
+
+# Index update notifications by (module, update, notification column)
+# Blank notifications are left out of the index, so rules that reference them fail validation
+# update_notes: dataframe of update notifications with Module and Update columns and a column per notification
+# returns a dict of notification strings
+def update_note_index(update_notes):
+    dupes = update_notes.loc[update_notes.duplicated(['Module', 'Update']), ['Module', 'Update']]
+    if not dupes.empty:
+        raise ValueError('Duplicate update notifications for ' + ', '.join(map(str, dupes.itertuples(index=False,
+                                                                                                       name=None))))
+    notification_cols = update_notes.columns.drop(['Module', 'Tab', 'Update'], errors='ignore')
+    notes = update_notes.melt(id_vars=['Module', 'Update'], value_vars=notification_cols,
+                              var_name='Notification').dropna(subset=['value'])
+    return dict(zip(zip(notes['Module'], notes['Update'], notes['Notification']), notes['value']))
+
+
+# Load the index of update notifications for a report
+# The sheet is read with read_export(), so it's only parsed once across the reports of a scheduler run,
+# and the index is only built once per process
+# update_notifications: path to a workbook that compiles the update notifications
+# sheet_name: string for the label of the report's sheet of update notifications
+# required: iterable of (module, update, notification) keys the report uses,
+# validated when the index is loaded so a missing notification fails the report before any data is processed
+# cache_dir: string for the directory of cached sheets (default: EXPORT_CACHE_DIR), None disables the cache
+# returns a dict of notification strings keyed by (module, update, notification column)
+def load_update_notes(update_notifications, sheet_name, required=(), cache_dir=EXPORT_CACHE_DIR):
+    key = (file_hash(update_notifications), sheet_name)
+    if key not in _update_note_indexes:
+        _update_note_indexes[key] = update_note_index(read_export(update_notifications, sheet_name,
+                                                                  cache_dir=cache_dir))
+    update_notes = _update_note_indexes[key]
+    missing = [note for note in required if note not in update_notes]
+    if missing:
+        raise ValueError(sheet_name + ' sheet of ' + update_notifications + ' is missing update notifications for '
+                         + ', '.join(map(str, missing)))
+    return update_notes
+
+
 # Get the update notification
-# update_notes: dataframe of update notification
+# update_notes: dict of update notifications, see load_update_notes()
 # module: string for the PEARS module
 # update: string for the label of the update column
 # notification: string for the desired notification column from update_notes (default: 'Notification1')
 def get_update_note(update_notes, module, update, notification='Notification1'):
-    return update_notes.loc[(update_notes['Module'] == module)
-                            & (update_notes['Update'] == update), notification].item()
+    return update_notes[(module, update, notification)]
+
+
+# Add update notification columns to a summary of corrections, blank where an update has no notification
+# corrections_sums: dataframe of corrections counts with Module and Update columns
+# update_notes: dict of update notifications, see load_update_notes()
+# notifications: list of strings for the notification columns to add (default: ['Notification1', 'Notification2'])
+def merge_update_notes(corrections_sums, update_notes, notifications=['Notification1', 'Notification2']):
+    corrections_sums = corrections_sums.copy()
+    keys = list(zip(corrections_sums['Module'], corrections_sums['Update']))
+    for notification in notifications:
+        corrections_sums[notification] = [update_notes.get((module, update, notification), np.nan)
+                                          for module, update in keys]
+    return corrections_sums
+
+
+# List the update notifications referenced by data cleaning rules
+# module: string for the PEARS module
+# rules: list of rule dicts, see evaluate_rules()
+# returns a list of (module, update, notification) keys for load_update_notes()
+def rule_update_notes(module, rules):
+    return [(module, rule['update'], rule.get('notification', 'Notification1')) for rule in rules]
+
+
+# Evaluate data cleaning rules in one pass, setting each rule's update column to its update notification
+# A rule is a dict of:
+#   'update': string for the label of the update column set by the rule
+#   'notification': string for the notification column of update_notes (default: 'Notification1')
+#   'when': function of (df, params) returning a boolean Series of the records to flag
+# Every predicate is evaluated against df before any update column is written,
+# and rules of the same update are applied in order, so later rules overwrite earlier rules' notifications.
+# Update columns are written in place if they already exist, otherwise they're appended in rule order.
+# df: dataframe of PEARS module data
+# module: string for the PEARS module
+# rules: list of rule dicts
+# update_notes: dict of update notifications, see load_update_notes()
+# params: dict of run parameters passed to each predicate (eg. report year bounds)
+# timings: dict that each rule's predicate runtime in seconds is added to, keyed by (module, update, notification)
+def evaluate_rules(df, module, rules, update_notes, params=None, timings=None):
+    params = {} if params is None else params
+    df = df.copy()
+    updates = {}
+    for rule in rules:
+        notification = rule.get('notification', 'Notification1')
+        note = get_update_note(update_notes, module=module, update=rule['update'], notification=notification)
+        start = time.perf_counter()
+        mask = rule['when'](df, params)
+        mask = mask.to_numpy(dtype=bool, na_value=False) if isinstance(mask, pd.Series) else np.asarray(mask, bool)
+        if timings is not None:
+            key = (module, rule['update'], notification)
+            timings[key] = timings.get(key, 0) + time.perf_counter() - start
+        updates.setdefault(rule['update'], []).append((mask, note))
+    for update, flags in updates.items():
+        values = np.full(len(df), np.nan, dtype=object)
+        for mask, note in flags:
+            values[mask] = note
+        df[update] = values
+    return df
+
+
+# Summarize rule timings collected by evaluate_rules(), slowest rules first
+# timings: dict of rule runtimes in seconds keyed by (module, update, notification)
+def rule_timings_summary(timings):
+    summary = pd.DataFrame([key + (seconds,) for key, seconds in timings.items()],
+                           columns=['Module', 'Update', 'Notification', 'Seconds'])
+    return summary.sort_values('Seconds', ascending=False, ignore_index=True)
 
 
 # Merge records to Partnerships via site_id, compute module counts
@@ -233,34 +895,142 @@ def corrections_sum(df, module, total=True):
     return df_sum
 
 
+# Cell formats of report workbooks, matching the formats of DataFrame.to_excel()
+HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+DATETIME_FORMAT = {'num_format': 'YYYY-MM-DD HH:MM:SS'}
+DATE_FORMAT = {'num_format': 'YYYY-MM-DD'}
+
+
+# Convert a dataframe column to a list of values xlsxwriter can write, as DataFrame.to_excel() does
+# Missing values are converted to None, which is skipped rather than written as a blank cell
+# series: Series of the column's values
+def excel_values(series):
+    if (pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series)) and not series.hasnans:
+        return series.tolist()
+    if pd.api.types.is_float_dtype(series):
+        values = series.astype(object)
+        values[np.isposinf(series)] = 'inf'
+        values[np.isneginf(series)] = '-inf'
+        return values.where(series.notna(), None).tolist()
+    if pd.api.types.is_datetime64_dtype(series):
+        return series.astype(object).where(series.notna(), None).tolist()
+    return [excel_value(value) for value in series.tolist()]
+
+
+# Convert a single value of an object column to a value xlsxwriter can write, see excel_values()
+# value: the value to convert
+def excel_value(value):
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, (str, bool, datetime.date)):
+        return value
+    if isinstance(value, float):
+        if np.isnan(value):
+            return None
+        return value if not np.isinf(value) else ('inf' if value > 0 else '-inf')
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds() / 86400
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, np.floating):
+        return excel_value(float(value))
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return str(value)
+
+
+# Stream a dataframe to a worksheet row by row, with a header row of column labels
+# Compatible with xlsxwriter's constant_memory mode, since every row is written once and in order
+# Column widths are measured as each value is written, so values are never converted to strings in bulk
+# worksheet: xlsxwriter Worksheet to write to
+# df: dataframe to write
+# formats: dict of 'header', 'datetime' and 'date' xlsxwriter Formats
+# width_sample: int for the number of rows measured for column widths, None measures every row (default: None)
+# returns a list of ints for the width of each column
+def write_df(worksheet, df, formats, width_sample=None):
+    widths = [len(str(col)) for col in df.columns]
+    for col_idx, col in enumerate(df.columns):
+        worksheet.write(0, col_idx, col, formats['header'])
+
+    columns = [excel_values(df.iloc[:, col_idx]) for col_idx in range(len(df.columns))]
+    for row_idx, row in enumerate(zip(*columns), start=1):
+        measure = width_sample is None or row_idx <= width_sample
+        for col_idx, value in enumerate(row):
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                worksheet.write_datetime(row_idx, col_idx, value, formats['datetime'])
+            elif isinstance(value, datetime.date):
+                worksheet.write_datetime(row_idx, col_idx, value, formats['date'])
+            else:
+                worksheet.write(row_idx, col_idx, value)
+            if measure:
+                width = len(str(value))
+                if width > widths[col_idx]:
+                    widths[col_idx] = width
+    return widths
+
+
+# Export dataframes as an Excel workbook formatted by declarative sheet specs
+# Sheets are streamed with xlsxwriter's constant_memory mode, so only one row is held in memory at a time
+# Formats are added to the workbook once and shared by every sheet
+# file: string for the name or path of the file
+# sheets: dict of sheet names to dataframes, or to dicts of sheet specs with the keys:
+#   'df': dataframe to write to the sheet
+#   'widths': column width strategy, either None to measure every row, an int for the number of rows to measure,
+#             or a list of ints for fixed column widths (default: None)
+#   'freeze_panes': tuple of the (row, col) to freeze panes at (default: no frozen panes)
+#   'autofilter': boolean, True to add an autofilter to the header row (default: True)
+#   'conditional_formats': list of dicts of xlsxwriter conditional format options applied to every row,
+#                          with 'first_col' and 'last_col' for the columns and 'format' as a key of formats
+# formats: dict of format names to dicts of xlsxwriter format properties used by conditional formats
+def render_workbook(file, sheets, formats=None):
+    workbook = xlsxwriter.Workbook(file, {'constant_memory': True})
+    cell_formats = {'header': workbook.add_format(HEADER_FORMAT),
+                    'datetime': workbook.add_format(DATETIME_FORMAT),
+                    'date': workbook.add_format(DATE_FORMAT)}
+    for name, properties in (formats or {}).items():
+        cell_formats[name] = workbook.add_format(properties)
+
+    for sheet_name, spec in sheets.items():
+        if isinstance(spec, pd.DataFrame):
+            spec = {'df': spec}
+        df = spec['df']
+        widths = spec.get('widths')
+        worksheet = workbook.add_worksheet(sheet_name)
+        if spec.get('freeze_panes') is not None:
+            worksheet.freeze_panes(*spec['freeze_panes'])
+
+        measured = write_df(worksheet, df, cell_formats, width_sample=0 if isinstance(widths, list) else widths)
+        # Set column widths, adding a little extra space to measured widths
+        if not isinstance(widths, list):
+            widths = [width + 1 for width in measured]
+        for idx, width in enumerate(widths):
+            worksheet.set_column(idx, idx, width)
+
+        if spec.get('autofilter', True):
+            worksheet.autofilter(0, 0, 0, len(df.columns) - 1)
+        for conditional_format in spec.get('conditional_formats', []):
+            options = dict(conditional_format)
+            first_col = options.pop('first_col')
+            last_col = options.pop('last_col')
+            options['format'] = cell_formats[options['format']]
+            worksheet.conditional_format(0, first_col, len(df), last_col, options)
+    workbook.close()
+
+
 # Export a list of dataframes as an Excel workbook
 # file: string for the name or path of the file
 # sheet_names: list of strings for the name of each sheet
 # dfs: list of dataframes for the report
 # report_dict: a dict to be used in place of sheet_names and dfs
-def write_report(file, sheet_names=None, dfs=None, report_dict=None):
+# width_sample: int for the number of rows measured for column widths, None measures every row (default: None)
+def write_report(file, sheet_names=None, dfs=None, report_dict=None, width_sample=None):
     if report_dict is None:
         report_dict = dict(zip(sheet_names, dfs))
-    writer = pd.ExcelWriter(file, engine='xlsxwriter')
-    # Loop through dict of dataframes
-    for sheet_name, df in report_dict.items():
-        # Send df to writer
-        df.to_excel(writer, sheet_name=sheet_name, index=False)
-        # Pull worksheet object
-        worksheet = writer.sheets[sheet_name]
-        # Loop through all columns
-        for idx, col in enumerate(df):
-            series = df[col]
-            max_len = max((
-                # Len of the largest item
-                series.astype(str).map(len).max(),
-                # Len of column name/header
-                len(str(series.name))
-            )) + 1  # adding a little extra space
-            # Set column width
-            worksheet.set_column(idx, idx, max_len)
-            worksheet.autofilter(0, 0, 0, len(df.columns) - 1)
-    writer.close()
+    render_workbook(file, {sheet_name: {'df': df, 'widths': width_sample} for sheet_name, df in report_dict.items()})
 
 
 # Convert sheet openpyxl Workbook Worksheet to DataFrame
@@ -290,29 +1060,16 @@ def load_org_settings():
     return org_settings_data
 
 
-# Send an email with or without a xlsx attachment
+# Build an email with or without a xlsx attachment
 # send_from: string for the sender's email address
 # send_to: string for the recipient's email address
 # Cc: string of comma-separated cc addresses
 # subject: string for the email subject line
 # html: string for the email body
-# username: string for the username to authenticate with
-# password: string for the password to authenticate with
-# isTls: boolean, True to put the SMTP connection in Transport Layer Security mode (default: True)
 # wb: boolean, whether an Excel file should be attached to this email (default: False)
 # file_path: string for the xlsx attachment's filepath (default: '')
 # filename: string for the xlsx attachments filename (default: '')
-def send_mail(send_from,
-              send_to,
-              cc,
-              subject,
-              html,
-              username,
-              password,
-              is_tls=True,
-              wb=False,
-              file_path='',
-              filename=''):
+def build_mail(send_from, send_to, cc, subject, html, wb=False, file_path='', filename=''):
     msg = MIMEMultipart()
     msg['From'] = send_from
     msg['To'] = send_to
@@ -330,15 +1087,198 @@ def send_mail(send_from,
         part.add_header('Content-Disposition', 'attachment', filename=filename)
         msg.attach(part)
 
-    smtp = smtplib.SMTP('smtp.office365.com', 587)
-    if is_tls:
-        smtp.starttls()
+    return msg
+
+
+# List the To and Cc addresses of an email, skipping blanks
+# msg: MIMEMultipart email, see build_mail()
+def mail_recipients(msg):
+    return [addr.strip() for addr in (msg['To'] + ',' + msg['Cc']).split(',') if addr.strip()]
+
+
+# Open an SMTP connection and authenticate with it
+# username: string for the username to authenticate with, authentication is skipped if empty
+# password: string for the password to authenticate with
+# is_tls: boolean, True to put the SMTP connection in Transport Layer Security mode (default: True)
+# host: string for the SMTP server's hostname (default: SMTP_HOST)
+# port: int for the SMTP server's port (default: SMTP_PORT)
+def smtp_connect(username, password, is_tls=True, host=SMTP_HOST, port=SMTP_PORT):
+    smtp = smtplib.SMTP(host, port)
     try:
-        smtp.login(username, password)
-        smtp.sendmail(send_from, send_to.split(',') + msg['Cc'].split(','), msg.as_string())
+        if is_tls:
+            smtp.starttls()
+        if username:
+            smtp.login(username, password)
+    except smtplib.SMTPException:
+        smtp.close()
+        raise
+    return smtp
+
+
+# Close an SMTP connection, even if the server has already dropped it
+# smtp: smtplib.SMTP connection
+def smtp_quit(smtp):
+    try:
+        smtp.quit()
+    except smtplib.SMTPException:
+        smtp.close()
+
+
+# Send an email with or without a xlsx attachment
+# send_from: string for the sender's email address
+# send_to: string for the recipient's email address
+# Cc: string of comma-separated cc addresses
+# subject: string for the email subject line
+# html: string for the email body
+# username: string for the username to authenticate with
+# password: string for the password to authenticate with
+# isTls: boolean, True to put the SMTP connection in Transport Layer Security mode (default: True)
+# wb: boolean, whether an Excel file should be attached to this email (default: False)
+# file_path: string for the xlsx attachment's filepath (default: '')
+# filename: string for the xlsx attachments filename (default: '')
+# host: string for the SMTP server's hostname (default: SMTP_HOST)
+# port: int for the SMTP server's port (default: SMTP_PORT)
+def send_mail(send_from,
+              send_to,
+              cc,
+              subject,
+              html,
+              username,
+              password,
+              is_tls=True,
+              wb=False,
+              file_path='',
+              filename='',
+              host=SMTP_HOST,
+              port=SMTP_PORT):
+    msg = build_mail(send_from, send_to, cc, subject, html, wb=wb, file_path=file_path, filename=filename)
+
+    try:
+        smtp = smtp_connect(username, password, is_tls=is_tls, host=host, port=port)
     except smtplib.SMTPAuthenticationError:
         print("Authentication failed. Make sure to provide a valid username and password.")
-    smtp.quit()
+        return
+    try:
+        smtp.sendmail(send_from, mail_recipients(msg), msg.as_string())
+    finally:
+        smtp_quit(smtp)
+
+
+# Send emails concurrently over persistent SMTP connections
+# Each worker thread opens one authenticated connection and reuses it for every email it sends
+# Transient failures (dropped connections, 4xx replies) are retried on a new connection with exponential backoff
+# Emails that still fail are collected in failed_recipients for send_failure_notice()
+# If authentication fails, the remaining emails fail without logging in again, so the account isn't locked out
+# username: string for the username to authenticate with
+# password: string for the password to authenticate with
+# is_tls: boolean, True to put the SMTP connections in Transport Layer Security mode (default: True)
+# host: string for the SMTP server's hostname (default: SMTP_HOST)
+# port: int for the SMTP server's port (default: SMTP_PORT)
+# max_workers: int for the number of worker threads and SMTP connections (default: 3)
+# retries: int for the number of times a transient failure is retried (default: 3)
+# backoff: float for the seconds to wait before the first retry, doubled for each subsequent retry (default: 1)
+class MailPool:
+    def __init__(self,
+                 username,
+                 password,
+                 is_tls=True,
+                 host=SMTP_HOST,
+                 port=SMTP_PORT,
+                 max_workers=3,
+                 retries=3,
+                 backoff=1):
+        self.username = username
+        self.password = password
+        self.is_tls = is_tls
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._auth_error = None
+        self._sent = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    # Queue an email to be sent, see build_mail() for keyword arguments
+    # failed_as: value added to failed_recipients if the email can't be sent (default: the send_to address)
+    def send(self, failed_as=None, **mail_kwargs):
+        msg = build_mail(**mail_kwargs)
+        future = self._executor.submit(self._deliver, msg)
+        self._sent.append((future, msg['To'] if failed_as is None else failed_as))
+        return future
+
+    # Wait for queued emails to be sent and close the SMTP connections
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for smtp in self._connections:
+            smtp_quit(smtp)
+        self._connections.clear()
+
+    # List of failed_as values for emails that couldn't be sent, in the order they were queued
+    # Blocks until every queued email has been attempted
+    @property
+    def failed_recipients(self):
+        return [failed_as for future, failed_as in self._sent if future.exception() is not None]
+
+    def _connection(self):
+        smtp = getattr(self._local, 'smtp', None)
+        if smtp is None:
+            # Logins are serialized so a rejected password is only ever tried once
+            with self._login_lock:
+                if self._auth_error is not None:
+                    raise self._auth_error
+                try:
+                    smtp = smtp_connect(self.username, self.password,
+                                        is_tls=self.is_tls, host=self.host, port=self.port)
+                except smtplib.SMTPAuthenticationError as error:
+                    print("Authentication failed. Make sure to provide a valid username and password.")
+                    self._auth_error = error
+                    raise
+            self._local.smtp = smtp
+            with self._lock:
+                self._connections.add(smtp)
+        return smtp
+
+    def _drop_connection(self):
+        smtp = getattr(self._local, 'smtp', None)
+        self._local.smtp = None
+        if smtp is not None:
+            with self._lock:
+                self._connections.discard(smtp)
+            smtp.close()
+
+    def _deliver(self, msg):
+        for attempt in range(self.retries + 1):
+            try:
+                self._connection().sendmail(msg['From'], mail_recipients(msg), msg.as_string())
+                return
+            except smtplib.SMTPAuthenticationError:
+                raise
+            except OSError as error:  # smtplib.SMTPException is a subclass of OSError
+                self._drop_connection()
+                if attempt == self.retries or not is_transient_smtp_error(error):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+
+# Check whether an SMTP error is likely to succeed on retry
+# error: exception raised while sending an email
+def is_transient_smtp_error(error):
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # Socket errors, such as timeouts and reset connections
+    return not isinstance(error, smtplib.SMTPException)
 
 
 # Function to subset module corrections for a specific staff member
@@ -352,6 +1292,54 @@ def staff_corrections(df, former=True, staff_email='', former_staff=pd.DataFrame
         return df.loc[df['reported_by_email'] == staff_email].drop(columns=['reported_by', 'reported_by_email', 'unit'])
 
 
+# Generator of each staff member's corrections for every module
+# Each module's corrections are partitioned by reported_by_email in a single groupby pass,
+# rather than scanning every module's corrections once per staff member
+# corrections_dict: dict of module names to dataframes of module corrections
+# staff_emails: list of strings for the emails of staff members to yield corrections for, in order
+# Yields tuples of a staff member's email and a dict of module names to their corrections for that module,
+# equivalent to calling staff_corrections(df, former=False, staff_email=staff_email) for each module
+def staff_corrections_bundles(corrections_dict, staff_emails):
+    drop_cols = ['reported_by', 'reported_by_email', 'unit']
+    module_groups = {}
+    empty_corrections = {}
+    for module, df in corrections_dict.items():
+        module_corrections = df.drop(columns=drop_cols)
+        module_groups[module] = dict(tuple(module_corrections.groupby(df['reported_by_email'], sort=False)))
+        empty_corrections[module] = module_corrections.iloc[0:0]
+    for staff_email in staff_emails:
+        yield staff_email, {module: groups.get(staff_email, empty_corrections[module])
+                            for module, groups in module_groups.items()}
+
+
+# Resolve the names, response tag and cc of every notification recipient in one pass before emails are sent
+# Recipients in a unit with a Regional Educator are directed to contact them and have them cc'd,
+# unless they're FCS State Office or UIC staff, every other recipient gets the default response tag
+# recipients: dataframe of current staff with reported_by_email and unit columns
+# roster: StaffRoster of the staff list
+# notification_cc: list-like string of email addresses to cc on every notification
+# response_tag: string for the default response tag
+# re_response_tag: format string for the Regional Educator response tag, formatted with their name and email
+# returns a dataframe with the index of recipients and full_name, first_name, response_tag and cc columns
+def recipient_context(recipients, roster, notification_cc, response_tag, re_response_tag):
+    emails = recipients['reported_by_email']
+    re_lookup = roster.re_lookup.drop_duplicates(subset='UNIT #').set_index('UNIT #')
+    re_names = recipients['unit'].map(re_lookup['REGIONAL EDUCATOR'])
+    re_emails = recipients['unit'].map(re_lookup['RE E-MAIL'])
+    has_re = (re_names.notnull()
+              & ~emails.isin(roster.state_staff_emails)
+              & ~emails.str.contains('@uic.edu', regex=False))
+
+    context = pd.DataFrame({'full_name': emails.map(roster.full_names),
+                            'first_name': emails.map(roster.first_names),
+                            'response_tag': response_tag,
+                            'cc': notification_cc}, index=recipients.index)
+    context.loc[has_re, 'response_tag'] = [re_response_tag.format(re_name, re_email)
+                                           for re_name, re_email in zip(re_names[has_re], re_emails[has_re])]
+    context.loc[has_re, 'cc'] = notification_cc + ', ' + re_emails[has_re]
+    return context
+
+
 # Function to insert a staff member's corrections into a html email template
 # dfs: dicts of module names to staff members' corrections dataframes for that module
 # strs: list of strings that will be appended to the html email template string
@@ -0,0 +1,78 @@
+import timeit
+import numpy as np
+import pandas as pd
+
+import py_pears.utils as utils
+
+
+# Custom fields that require reformatting
+CUSTOM_FIELD_LABELS = ['fcs_program_team', 'snap_ed_grant_goals', 'fcs_grant_goals', 'fcs_special_projects',
+                       'snap_ed_special_projects']
+
+# Custom field value binary columns of a Program Activity export
+BINARY_COLS = ['fcs_program_team_custom_data_family_life',
+               'fcs_program_team_custom_data_nutrition_wellness',
+               'fcs_program_team_custom_data_consumer_economics',
+               'fcs_program_team_custom_data_snap_ed',
+               'fcs_program_team_custom_data_efnep',
+               'snap_ed_grant_goals_custom_data_improve_diet_quality',
+               'snap_ed_grant_goals_custom_data_increase_physical_activity_opportunities',
+               'snap_ed_grant_goals_custom_data_increase_food_access',
+               'fcs_grant_goals_custom_data_improve_diet_quality',
+               'fcs_grant_goals_custom_data_increase_food_access',
+               'fcs_special_projects_custom_data_none',
+               'fcs_special_projects_custom_data_abcs_of_school_nutrition',
+               'fcs_special_projects_custom_data_growing_together_illinois',
+               'snap_ed_special_projects_custom_data_none',
+               'snap_ed_special_projects_custom_data_heat',
+               'snap_ed_special_projects_custom_data_cphp_shape_up_chicago_youth_trainers',
+               'snap_ed_special_projects_custom_data_cphp_chicago_grows_groceries']
+
+
+# Create a synthetic export of custom field value binary columns
+# rows: int for the number of records
+# seed: int for the random number generator seed (default: 0)
+def synthetic_export(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.integers(0, 2, size=(rows, len(BINARY_COLS))), columns=BINARY_COLS)
+    df.insert(0, 'program_id', np.arange(rows))
+    return df
+
+
+# Row-wise reference implementation of utils.reformat()
+# df: dataframe of records to reformat
+# labels: list of custom labels to iterate through
+def rowwise_reformat(df, labels):
+    reformatted_df = df.copy()
+    reformatted_df.columns = reformatted_df.columns.str.replace(r'_custom_data', '')
+    for label in labels:
+        binary_cols = reformatted_df.columns[reformatted_df.columns.str.contains(label)]
+        for col in binary_cols:
+            reformatted_df.loc[reformatted_df[col] == 1, col] = utils.replace_all(col, label)
+            reformatted_df.loc[reformatted_df[col] == 0, col] = ''
+        reformatted_df[label] = reformatted_df[binary_cols].apply(
+            lambda row: ','.join(row.values.astype(str)), axis=1).str.strip(',').str.replace(r',+', ',', regex=True)
+        reformatted_df.loc[reformatted_df[label] == '', label] = np.nan
+        reformatted_df.drop(columns=binary_cols, inplace=True)
+    return reformatted_df
+
+
+# Time utils.reformat() against the row-wise reference on synthetic exports of increasing size
+# sizes: list of ints for the number of records in each synthetic export
+# rowwise_max: int for the largest export the row-wise reference is timed on (default: 10000)
+def main(sizes=(1000, 10000, 100000), rowwise_max=10000):
+    print('{:>8} {:>14} {:>14}'.format('rows', 'reformat (s)', 'row-wise (s)'))
+    for rows in sizes:
+        df = synthetic_export(rows)
+        vectorized = min(timeit.repeat(lambda: utils.reformat(df, CUSTOM_FIELD_LABELS), number=1, repeat=3))
+        rowwise = '-'
+        if rows <= rowwise_max:
+            pd.testing.assert_frame_equal(utils.reformat(df, CUSTOM_FIELD_LABELS),
+                                          rowwise_reformat(df, CUSTOM_FIELD_LABELS))
+            rowwise = '{:.3f}'.format(min(timeit.repeat(lambda: rowwise_reformat(df, CUSTOM_FIELD_LABELS),
+                                                        number=1, repeat=1)))
+        print('{:>8} {:>14.3f} {:>14}'.format(rows, vectorized, rowwise))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,9 @@ NAMES_LIST = TEST_INPUTS_DIR + 'BABY_NAMES_IL.TXT'
 UNIT_COUNTIES = TEST_INPUTS_DIR + 'Illinois Extension Unit Counties.xlsx'
 UPDATE_NOTIFICATIONS = TEST_INPUTS_DIR + 'Update Notifications.xlsx'
 
+# Fiscal year of the records in the test inputs
+TEST_INPUTS_FY = 2022
+
 
 def main(test_pears_dir=TEST_INPUTS_PEARS_DIR,
          expected_outputs_dir=EXPECTED_OUTPUTS_DIR,
@@ -65,7 +68,8 @@ def main(test_pears_dir=TEST_INPUTS_PEARS_DIR,
                                names_list=names_list,
                                unit_counties=unit_counties,
                                update_notifications=update_notifications,
-                               output_dir=expected_outputs_dir)
+                               output_dir=expected_outputs_dir,
+                               fy=TEST_INPUTS_FY)
 
     partnerships_entry.main(creds=creds,
                             users_export=test_pears_dir + "User_Export.xlsx",
@@ -91,7 +95,8 @@ def main(test_pears_dir=TEST_INPUTS_PEARS_DIR,
                                       partnerships_export=test_pears_dir + "Partnership_Export.xlsx",
                                       program_activities_export=test_pears_dir + "Program_Activities_Export.xlsx",
                                       pse_site_activities_export=test_pears_dir + "PSE_Site_Activity_Export.xlsx",
-                                      output_dir=expected_outputs_dir)
+                                      output_dir=expected_outputs_dir,
+                                      fy=TEST_INPUTS_FY)
 
 
 if __name__ == '__main__':
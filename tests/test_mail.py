@@ -0,0 +1,135 @@
+import pytest
+
+import socketserver
+import threading
+
+import py_pears.utils as utils
+
+
+# Minimal SMTP server standing in for the organization's mail server
+# Recipients containing 'refused' are permanently rejected,
+# and recipients containing 'flaky' have their first message deferred with a 451 reply
+# Every login is rejected
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        rcpts = []
+        self.reply('220 localhost stand-in')
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN')
+            elif command == 'AUTH':
+                with server.lock:
+                    server.logins += 1
+                self.reply('535 Authentication failed')
+            elif command == 'MAIL':
+                rcpts = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                rcpt = line[line.index('<') + 1:line.index('>')]
+                if 'refused' in rcpt:
+                    self.reply('550 Mailbox unavailable')
+                else:
+                    rcpts.append(rcpt)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline().decode().rstrip('\r\n') != '.':
+                    pass
+                with server.lock:
+                    deferred = [rcpt for rcpt in rcpts if 'flaky' in rcpt and rcpt not in server.deferred]
+                    server.deferred.update(deferred)
+                    if not deferred:
+                        server.delivered.append(rcpts)
+                self.reply('451 Try again later' if deferred else '250 OK')
+            elif command == 'RSET':
+                rcpts = []
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+@pytest.fixture()
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandInSMTPHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.logins = 0
+    server.deferred = set()
+    server.delivered = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Emails should be delivered over reused connections, retrying deferrals and collecting permanent failures
+def test_mail_pool(smtp_server):
+    host, port = smtp_server.server_address
+    send_to = ['staff' + str(i) + '@x.edu' for i in range(10)] + ['flaky@x.edu', 'refused@x.edu']
+    with utils.MailPool(username='', password='', is_tls=False, host=host, port=port,
+                        max_workers=2, retries=2, backoff=0) as mail_pool:
+        for recipient in send_to:
+            mail_pool.send(failed_as=[recipient],
+                           send_from='admin@x.edu',
+                           send_to=recipient,
+                           cc='' if 'refused' in recipient else 'cc@x.edu',
+                           subject='Test',
+                           html='<p>Test</p>')
+
+    # Emails are only failed if every address is refused, matching smtplib.SMTP.sendmail()
+    assert mail_pool.failed_recipients == [['refused@x.edu']]
+    assert sorted(rcpts[0] for rcpts in smtp_server.delivered) == sorted(send_to[:-1])
+    assert all(rcpts[1] == 'cc@x.edu' for rcpts in smtp_server.delivered)
+    # One connection per worker, plus reconnects after the deferral and the rejection
+    assert smtp_server.connections <= 4
+
+
+# A rejected login should fail every queued email without logging in again
+def test_mail_pool_authentication_failure(smtp_server, capsys):
+    host, port = smtp_server.server_address
+    send_to = ['staff' + str(i) + '@x.edu' for i in range(5)]
+    with utils.MailPool(username='admin@x.edu', password='wrong', is_tls=False, host=host, port=port,
+                        max_workers=2, retries=2, backoff=0) as mail_pool:
+        for recipient in send_to:
+            mail_pool.send(failed_as=recipient,
+                           send_from='admin@x.edu',
+                           send_to=recipient,
+                           cc='',
+                           subject='Test',
+                           html='<p>Test</p>')
+
+    assert mail_pool.failed_recipients == send_to
+    assert smtp_server.logins == 1
+    assert capsys.readouterr().out.count('Authentication failed') == 1
+
+
+# A single email should skip blank cc addresses
+def test_send_mail(smtp_server):
+    host, port = smtp_server.server_address
+    utils.send_mail(send_from='admin@x.edu',
+                    send_to='staff@x.edu',
+                    cc='',
+                    subject='Test',
+                    html='<p>Test</p>',
+                    username='',
+                    password='',
+                    is_tls=False,
+                    host=host,
+                    port=port)
+    assert smtp_server.delivered == [['staff@x.edu']]
@@ -28,6 +28,9 @@ names_list = TEST_INPUTS_DIR + 'BABY_NAMES_IL.TXT'
 unit_counties = TEST_INPUTS_DIR + 'Illinois Extension Unit Counties.xlsx'
 update_notifications = TEST_INPUTS_DIR + 'Update Notifications.xlsx'
 
+# Fiscal year of the records in the test inputs
+TEST_INPUTS_FY = 2022
+
 EXPECTED_OUTPUTS_DIR = ROOT_DIR + '/expected_outputs/'
 ACTUAL_OUTPUTS_DIR = ROOT_DIR + '/actual_outputs/'
 
@@ -156,6 +159,113 @@ def test_staff_report():
     assert os.path.isfile(diff_snap_ed) is False
 
 
+# Collaborators whose names are shared by multiple users should be resolved by the module's unit column
+def test_merge_collaborators(tmp_path):
+    export = str(tmp_path / 'Partnership_Export.xlsx')
+    pd.DataFrame({'partnership_id': [1, 2, 2], 'user': ['Ann Lee', 'Ann Lee', 'Bo Diaz']}).to_excel(
+        export, sheet_name='Collaborators', index=False)
+    partnerships = pd.DataFrame({'partnership_id': [1, 2],
+                                 'created': pd.to_datetime(['2022-09-01', '2022-09-02']),
+                                 'modified': pd.to_datetime(['2022-09-03', '2022-09-04']),
+                                 'partnership_unit': ['Unit 1', 'Unit 2']})
+    users = pd.DataFrame({'full_name': ['Ann Lee', 'Ann Lee', 'Bo Diaz'],
+                          'email': ['ann1@x.edu', 'ann2@x.edu', 'bo@x.edu'],
+                          'unit': ['Unit 1', 'Unit 2', 'Unit 3']})
+
+    collaborators, = staff_report.merge_collaborators(utils.UserIndex(users),
+                                                      [(partnerships, 'partnership_id', 'partnership_unit', export)])
+    assert collaborators.columns.tolist() == ['partnership_id', 'user', 'email', 'created', 'modified']
+    assert collaborators['email'].tolist() == ['ann1@x.edu', 'ann2@x.edu', 'bo@x.edu']
+
+
+# Staff report records of two modules, with overlapping windows, NaT dates, missing ids, and missing emails
+STAFF_REPORT_DATE_LB = pd.Timestamp('2022-09-01').date()
+STAFF_REPORT_DATE_UB = pd.Timestamp('2022-10-10').date()
+STAFF_REPORT_WINDOWS = staff_report.entry_count_windows(STAFF_REPORT_DATE_LB, STAFF_REPORT_DATE_UB)
+STAFF_REPORT_RECORDS = {
+    'Program Activities': (
+        pd.DataFrame({'program_id': [1, 2, 3, np.nan, 5, 6, 7],
+                      'reported_by_email': ['a@x.edu', 'a@x.edu', 'b@x.edu', 'b@x.edu', None, 'c@x.edu', 'c@x.edu'],
+                      'created': ['2022-09-01', '2022-10-10', '2022-08-31', '2022-09-05', '2022-09-02', None,
+                                  '2022-10-11'],
+                      'modified': ['2022-09-20', '2022-10-10', '2022-09-30', None, '2022-09-02', '2022-09-03',
+                                   '2022-10-11']}),
+        pd.DataFrame({'program_id': [1, 3, 3, np.nan],
+                      'email': ['b@x.edu', 'a@x.edu', 'c@x.edu', 'c@x.edu'],
+                      'created': ['2022-09-01', '2022-08-31', '2022-08-31', '2022-09-15'],
+                      'modified': ['2022-09-01', '2022-09-30', None, '2022-09-15']})),
+    'Partnerships': (
+        pd.DataFrame({'partnership_id': [10, 11],
+                      'reported_by_email': ['a@x.edu', 'a@x.edu'],
+                      'created': ['2022-09-10', '2022-01-01'],
+                      'modified': ['2022-09-10', '2022-09-11']}),
+        pd.DataFrame({'partnership_id': [10], 'email': ['b@x.edu'], 'created': ['2022-09-10'],
+                      'modified': ['2022-09-10']}))}
+STAFF_REPORT_MODULE_IDS = {'Program Activities': 'program_id', 'Partnerships': 'partnership_id'}
+
+
+# Previous staff report count of a window, counting the ids of each email's records in the window
+# date_field: column label of the dates bounded by the window, None counts every record
+def previous_window_counts(df, module_id, date_field):
+    if date_field is not None:
+        dates = pd.to_datetime(df[date_field]).dt.date
+        df = df.loc[(dates >= STAFF_REPORT_DATE_LB) & (dates <= STAFF_REPORT_DATE_UB)]
+    return df.groupby('email')[module_id].count()
+
+
+# Previous staff report counts of a module, merging each window's counts to the staff list
+def previous_staff_entries(df_created, df_collab, module_id, module, staff, date):
+    df_created = df_created.rename(columns={'reported_by_email': 'email'})
+    df_merged = staff
+    for metric, (date_field, start, end) in STAFF_REPORT_WINDOWS['created'].items():
+        counts = previous_window_counts(df_created, module_id, date_field if start else None)
+        label = module + ' ' + staff_report.ENTRY_COUNT_LABELS[metric].format(date=date)
+        df_merged = pd.merge(df_merged, counts.reset_index(name=label), how='left', on='email')
+    for metric, (date_field, start, end) in STAFF_REPORT_WINDOWS['collab'].items():
+        counts = previous_window_counts(df_collab, module_id, date_field if start else None)
+        label = module + ' ' + staff_report.ENTRY_COUNT_LABELS[metric].format(date=date)
+        df_merged = pd.merge(df_merged, counts.reset_index(name=label), how='left', on='email')
+    return df_merged.fillna(0)
+
+
+# Counts of every window should match counting each window's records by email, including overlapping windows
+def test_created_collab_counts():
+    for module, (df_created, df_collab) in STAFF_REPORT_RECORDS.items():
+        module_id = STAFF_REPORT_MODULE_IDS[module]
+        counts = staff_report.created_collab_counts(df_created, df_collab, module_id, module,
+                                                    windows=STAFF_REPORT_WINDOWS)
+        assert (counts['module'] == module).all()
+
+        expected = []
+        for kind, df in [('created', df_created.rename(columns={'reported_by_email': 'email'})),
+                         ('collab', df_collab)]:
+            for metric, (date_field, start, end) in STAFF_REPORT_WINDOWS[kind].items():
+                window = previous_window_counts(df, module_id, date_field if start else None)
+                expected.append(window.reset_index(name='value').assign(metric=metric))
+        expected = pd.concat(expected, ignore_index=True)
+        pd.testing.assert_frame_equal(counts.sort_values(['metric', 'email'], ignore_index=True)[
+                                          ['email', 'metric', 'value']],
+                                      expected.sort_values(['metric', 'email'], ignore_index=True)[
+                                          ['email', 'metric', 'value']])
+
+
+# Pivoted staff counts should match merging each window's counts to the staff list, including column dtypes
+@pytest.mark.parametrize('emails', [['a@x.edu', 'b@x.edu', 'c@x.edu'], ['a@x.edu', 'b@x.edu', 'c@x.edu', 'd@x.edu']])
+def test_module_staff_entries(emails):
+    staff = pd.DataFrame({'NAME': [email[0].upper() for email in emails], 'email': emails})
+    counts = pd.concat([staff_report.created_collab_counts(df_created, df_collab, STAFF_REPORT_MODULE_IDS[module],
+                                                           module, windows=STAFF_REPORT_WINDOWS)
+                        for module, (df_created, df_collab) in STAFF_REPORT_RECORDS.items()], ignore_index=True)
+    staff_entries = staff_report.module_staff_entries(counts, staff, list(STAFF_REPORT_RECORDS), date='Sep-2022')
+
+    expected = staff
+    for module, (df_created, df_collab) in STAFF_REPORT_RECORDS.items():
+        module_entries = previous_staff_entries(df_created, df_collab, STAFF_REPORT_MODULE_IDS[module], module,
+                                                staff, 'Sep-2022')
+        expected = pd.merge(expected, module_entries, how='outer', on=['NAME', 'email'])
+    pd.testing.assert_frame_equal(staff_entries, expected)
+
+
 def test_monthly_data_cleaning():
     monthly_data_cleaning.main(creds=creds,
                                coalitions_export=TEST_INPUTS_PEARS_DIR + "Coalition_Export.xlsx",
@@ -167,7 +277,8 @@ def test_monthly_data_cleaning():
                                names_list=names_list,
                                unit_counties=unit_counties,
                                update_notifications=update_notifications,
-                               output_dir=ACTUAL_OUTPUTS_DIR)
+                               output_dir=ACTUAL_OUTPUTS_DIR,
+                               fy=TEST_INPUTS_FY)
     report_filename = monthly_data_cleaning.report_filename(report='corrections')
     diff = ACTUAL_OUTPUTS_DIR + 'monthly_data_cleaning_diff.xlsx'
     result = compare_workbooks(xlsx1=ACTUAL_OUTPUTS_DIR + report_filename,
@@ -233,11 +344,85 @@ def test_quarterly_program_evaluation():
                                                                                         ".xlsx",
                                       pse_site_activities_export=TEST_INPUTS_PEARS_DIR + "PSE_Site_Activity_Export"
                                                                                          ".xlsx",
-                                      output_dir=ACTUAL_OUTPUTS_DIR)
-    report_filename = quarterly_program_evaluation.report_filename()
+                                      output_dir=ACTUAL_OUTPUTS_DIR,
+                                      fy=TEST_INPUTS_FY)
+    report_filename = quarterly_program_evaluation.report_filename(fy=TEST_INPUTS_FY)
     diff = ACTUAL_OUTPUTS_DIR + 'quarterly_program_evaluation_diff.xlsx'
     result = compare_workbooks(xlsx1=ACTUAL_OUTPUTS_DIR + report_filename,
                                xlsx2=EXPECTED_OUTPUTS_DIR + report_filename,
                                diff_filename=diff)
     assert result is True
     assert os.path.isfile(diff) is False
+
+
+# Records should be repeated for their quarter and each later quarter, matching the previous string-based explode
+def test_explode_quarters():
+    qtr_bounds = utils.fiscal_calendar().report_quarter_bounds(2022)
+    df = pd.DataFrame({'record_id': [1, 2, 3, 4, 5, 6],
+                       'created': ['2021-10-01', '2022-01-10', '2022-01-11', '2022-10-17', '2022-10-18', None]})
+
+    # Previous explode, which labeled each record with a string of its quarters and split it into rows
+    quarters = utils.fiscal_calendar().assign_quarter(pd.to_datetime(df['created']), bounds=qtr_bounds)
+    labels = np.array([''] + [', '.join(str(q) for q in range(i, 5)) for i in range(1, 5)])
+    expected = df.assign(created=pd.to_datetime(df['created']),
+                         report_quarter=labels[quarters.to_numpy()])
+    expected['report_quarter'] = expected['report_quarter'].str.split(', ').tolist()
+    expected = expected.explode('report_quarter')
+    expected = expected.loc[expected['report_quarter'] != ''].astype({'report_quarter': 'int8'})
+
+    exploded = quarterly_program_evaluation.explode_quarters(df, qtr_bounds)
+    pd.testing.assert_frame_equal(exploded, expected)
+    assert exploded['report_quarter'].tolist() == [1, 2, 3, 4, 1, 2, 3, 4, 2, 3, 4, 4]
+    # The input isn't modified
+    assert df['created'].dtype == object
+
+
+# Per-goal sums and counts should match exploding records by goal and grouping, as the report previously did
+def test_quarterly_goal_value():
+    df = pd.DataFrame({'report_quarter': [1, 1, 2, 2, 2, 3],
+                       'site_id': [10, 10, 11, np.nan, 12, 13],
+                       'participants_total': [5, 7, np.nan, 3, 4, 6],
+                       'snap_ed_grant_goals_custom_data_improve_diet_quality': [1, 1, 0, 1, 1, 0],
+                       'snap_ed_grant_goals_custom_data_increase_food_access': [1, 0, 1, 1, 0, 0]})
+    goals = utils.custom_field_indicators(df, 'snap_ed_grant_goals')
+
+    # Previous goal explode, which split each record's list-like string of goals into rows
+    exploded = utils.reformat(df, ['snap_ed_grant_goals'])
+    exploded['goal'] = exploded['snap_ed_grant_goals'].str.split(',').tolist()
+    exploded = exploded.explode('goal')
+
+    sums = quarterly_program_evaluation.quarterly_goal_value(df, goals, 'participants_total', 'sum',
+                                                             'PA_participants_sum', keys=['site_id'])
+    expected_sums = exploded.groupby(['report_quarter', 'goal', 'site_id'])['participants_total'].agg(
+        'sum').reset_index(name='PA_participants_sum').rename(columns={'goal': 'Goal'})
+    pd.testing.assert_frame_equal(sums, expected_sums)
+
+    counts = quarterly_program_evaluation.quarterly_goal_value(df, goals, 'site_id', 'count', 'Sites')
+    expected_counts = quarterly_program_evaluation.quarterly_value(exploded, 'site_id', 'count', 'Sites', goals=True)
+    pd.testing.assert_frame_equal(counts, expected_counts)
+
+
+# Records without goals should have a NaN last goal
+def test_last_goal():
+    goals = pd.DataFrame({'Improve diet quality': [True, True, False],
+                          'Increase food access': [True, False, False]})
+    last_goals = quarterly_program_evaluation.last_goal(goals)
+    assert last_goals[:2].tolist() == ['Increase food access', 'Improve diet quality']
+    assert pd.isnull(last_goals[2])
+    assert pd.isnull(quarterly_program_evaluation.last_goal(goals.iloc[:, :0])).all()
+
+
+# Batched quarterly metrics should be joined in quarter order, even if the first dataframe is missing quarters
+def test_join_quarterly_values():
+    pa_data = pd.DataFrame({'report_quarter': [2, 3, 4, 4], 'participants_total': [1, 2, 3, 4]})
+    ia_data = pd.DataFrame({'report_quarter': [1, 2, 3, 4], 'activity_id': [5, 6, 7, 8], 'reach': [10, 20, 30, 40]})
+    inputs = [quarterly_program_evaluation.QuarterlyValueInputs(pa_data, [('participants_total', 'sum', 'PA Reach')]),
+              quarterly_program_evaluation.QuarterlyValueInputs(ia_data, [('activity_id', 'count', 'IA Count'),
+                                                                           ('reach', 'sum', 'IA Reach')])]
+
+    joined = quarterly_program_evaluation.join_quarterly_values(inputs)
+    assert joined['report_quarter'].tolist() == [1, 2, 3, 4]
+    assert joined.columns.tolist() == ['report_quarter', 'PA Reach', 'IA Count', 'IA Reach']
+    assert joined['PA Reach'].fillna(0).tolist() == [0, 1, 2, 7]
+    assert joined['IA Count'].tolist() == [1, 1, 1, 1]
+    assert joined['IA Reach'].tolist() == [10, 20, 30, 40]
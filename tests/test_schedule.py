@@ -0,0 +1,58 @@
+import pytest
+
+import os
+import py_pears.schedule as schedule
+
+
+# Modules shared by multiple reports should only be downloaded once
+def test_required_modules():
+    reports = [schedule.ScheduledReport('a', True, ['User', 'Partnership'], print, {}),
+               schedule.ScheduledReport('b', True, ['Site', 'User'], print, {}),
+               schedule.ScheduledReport('c', True, [], print, {})]
+    assert schedule.required_modules(reports) == ['User', 'Partnership', 'Site']
+
+
+# A failing report should not stop the remaining reports from running
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_run_reports_isolates_failures(max_workers):
+    reports = [schedule.ScheduledReport('fails', True, [], int, {'base': 10}),
+               schedule.ScheduledReport('succeeds', True, [], dict, {'a': 1})]
+    results = schedule.run_reports(reports, max_workers=max_workers)
+    assert [name for name, seconds, error in results] == ['fails', 'succeeds']
+    assert 'TypeError' in results[0][2]
+    assert results[1][2] is None
+
+
+# Exit the worker process without raising an exception, as if it was killed
+def crash():
+    os._exit(1)
+
+
+# A report that kills its worker process should be recorded as failed rather than aborting the run
+def test_run_reports_broken_pool():
+    reports = [schedule.ScheduledReport('crashes', True, [], crash, {}),
+               schedule.ScheduledReport('succeeds', True, [], dict, {'a': 1})]
+    results = schedule.run_reports(reports, max_workers=2)
+    assert [name for name, seconds, error in results] == ['crashes', 'succeeds']
+    assert 'BrokenProcessPool' in results[0][2]
+
+
+# Report functions given by dotted path should only be imported when the report runs
+def test_scheduled_report_dotted_path():
+    report = schedule.ScheduledReport('json', True, [], 'json.dumps', {'obj': [1]})
+    assert report.run() == '[1]'
+
+
+# The schedule's snapshot directory should match the one used by utils
+def test_snapshot_dir():
+    import py_pears.utils as utils
+    assert schedule.SNAPSHOT_DIR == utils.SNAPSHOT_DIR
+
+
+# Quarterly reports are due on the given days of the first month of each fiscal quarter
+def test_compare_date_quarterly():
+    from datetime import date
+    assert schedule.compare_date_quarterly([12, 23], left_date=date(2023, 4, 23))
+    assert not schedule.compare_date_quarterly([12, 23], left_date=date(2023, 5, 12))
+    assert schedule.compare_date(left_date=date(2023, 10, 18), month=10, day=18)
+    assert not schedule.compare_date(left_date=date(2023, 10, 18), day=2)
@@ -0,0 +1,411 @@
+import pytest
+
+import os
+import json
+import hashlib
+import openpyxl
+import pandas as pd
+
+import py_pears.utils as utils
+
+
+# Calculate the path to the root directory of this package
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '.'))
+
+TEST_INPUTS_PEARS_DIR = ROOT_DIR + '/test_inputs/pears/'
+
+
+# Cached export sheets should match a direct parse of the workbook
+def test_read_export_cache(tmp_path):
+    export = TEST_INPUTS_PEARS_DIR + 'Partnership_Export.xlsx'
+    expected = pd.read_excel(export, sheet_name='Partnership Data')
+
+    first = utils.read_export(export, 'Partnership Data', cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 1
+    second = utils.read_export(export, 'Partnership Data', cache_dir=str(tmp_path))
+
+    pd.testing.assert_frame_equal(first, expected)
+    pd.testing.assert_frame_equal(second, expected)
+
+
+# Pruning should keep cached sheets that were read recently, even if they were written long ago
+def test_prune_export_cache(tmp_path):
+    export = TEST_INPUTS_PEARS_DIR + 'Partnership_Export.xlsx'
+    utils.read_export(export, 'Partnership Data', cache_dir=str(tmp_path))
+    cache_file = str(tmp_path / os.listdir(tmp_path)[0])
+    stale = pd.Timestamp.now().timestamp() - 30 * 24 * 60 * 60
+    os.utime(cache_file, (stale, stale))
+
+    utils.read_export(export, 'Partnership Data', cache_dir=str(tmp_path))
+    utils.prune_export_cache(cache_dir=str(tmp_path), max_age_days=7)
+    assert os.path.isfile(cache_file)
+
+    os.utime(cache_file, (stale, stale))
+    utils.prune_export_cache(cache_dir=str(tmp_path), max_age_days=7)
+    assert not os.path.isfile(cache_file)
+
+
+# Sheet names that only differ in punctuation should be cached separately
+def test_read_export_cache_sheet_names(tmp_path):
+    export = str(tmp_path / 'export.xlsx')
+    with pd.ExcelWriter(export) as writer:
+        pd.DataFrame({'value': [1]}).to_excel(writer, sheet_name='A B', index=False)
+        pd.DataFrame({'value': [2]}).to_excel(writer, sheet_name='A_B', index=False)
+    cache_dir = str(tmp_path / 'cache')
+
+    assert utils.read_export(export, 'A B', cache_dir=cache_dir)['value'].tolist() == [1]
+    assert utils.read_export(export, 'A_B', cache_dir=cache_dir)['value'].tolist() == [2]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+# Custom field binary columns should collapse into list-like strings of dropdown values
+def test_reformat():
+    df = pd.DataFrame({'program_id': [1, 2, 3],
+                       'snap_ed_grant_goals_custom_data_improve_diet_quality': [1, 0, 1],
+                       'snap_ed_grant_goals_custom_data_increase_food_access': [1, 0, 0]})
+    reformatted = utils.reformat(df, ['snap_ed_grant_goals'])
+    assert reformatted.columns.tolist() == ['program_id', 'snap_ed_grant_goals']
+    assert reformatted['snap_ed_grant_goals'].fillna('').tolist() == ['Improve diet quality,Increase food access',
+                                                                      '',
+                                                                      'Improve diet quality']
+
+
+# Values with one space whose first word ends in a name should be flagged, unless they contain an exclude term
+def test_flag_individual_names(tmp_path):
+    names_list = tmp_path / 'names.txt'
+    names_list.write_text('IL,F,1990,Mary,50\nIL,M,1990,Donald,40\n')
+    cache_dir = tmp_path / 'cache'
+    names = utils.load_names(str(names_list), cache_dir=str(cache_dir))
+    assert names == {'Mary', 'Donald'}
+    assert utils.load_names(str(names_list), cache_dir=str(cache_dir)) == names
+
+    values = pd.Series(['Mary Smith', 'McDonald Jones', 'Mary County', 'Mary Ann Smith', 'Smith Mary', None])
+    flags = utils.flag_individual_names(values, names, exclude_terms=['County'])
+    assert flags.tolist() == [True, True, False, False, False, False]
+
+
+# Per-staff correction bundles should match subsetting each module's corrections by staff email
+def test_staff_corrections_bundles():
+    corrections = {'Coalitions': pd.DataFrame({'coalition_id': [1, 2, 3],
+                                               'reported_by': ['A', 'B', 'A'],
+                                               'reported_by_email': ['a@x.edu', 'b@x.edu', 'a@x.edu'],
+                                               'unit': ['1', '2', '1']}),
+                   'Partnerships': pd.DataFrame({'partnership_id': [4],
+                                                 'reported_by': ['B'],
+                                                 'reported_by_email': ['b@x.edu'],
+                                                 'unit': ['2']})}
+    staff_emails = ['b@x.edu', 'a@x.edu', 'c@x.edu']
+    bundles = list(utils.staff_corrections_bundles(corrections, staff_emails))
+    assert [email for email, _ in bundles] == staff_emails
+    for staff_email, bundle in bundles:
+        for module, df in corrections.items():
+            expected = utils.staff_corrections(df, former=False, staff_email=staff_email)
+            pd.testing.assert_frame_equal(bundle[module], expected)
+
+
+# Streamed report sheets should read back as the dataframes that were written
+def test_write_report(tmp_path):
+    df = pd.DataFrame({'id': [1, 2, 3],
+                       'name': ['a', None, 'ccc'],
+                       'value': [1.5, float('nan'), 2.0],
+                       'date': pd.to_datetime(['2022-10-01', None, '2022-12-31'])})
+    file = str(tmp_path / 'report.xlsx')
+    utils.write_report(file, report_dict={'Sheet A': df, 'Sheet B': df.iloc[0:0]})
+
+    sheets = pd.read_excel(file, sheet_name=None)
+    assert list(sheets) == ['Sheet A', 'Sheet B']
+    pd.testing.assert_frame_equal(sheets['Sheet A'], df)
+    assert sheets['Sheet B'].columns.tolist() == df.columns.tolist()
+
+
+# Sheet specs should control freeze panes, conditional formats, autofilters and column widths
+def test_render_workbook(tmp_path):
+    df = pd.DataFrame({'Module': ['Coalitions', 'Coalitions'], 'Update': ['CM UPDATE1', 'Total'], 'Entries': [2, 2]})
+    file = str(tmp_path / 'report.xlsx')
+    utils.render_workbook(file,
+                          {'Summary': {'df': df,
+                                       'widths': [12, 14, 9],
+                                       'freeze_panes': (1, 1),
+                                       'conditional_formats': [{'first_col': 0,
+                                                                'last_col': 2,
+                                                                'type': 'formula',
+                                                                'criteria': '=$B1="Total"',
+                                                                'format': 'bold'}]},
+                           'Plain': {'df': df, 'autofilter': False}},
+                          formats={'bold': {'bold': True}})
+
+    wb = openpyxl.load_workbook(file)
+    summary = wb['Summary']
+    assert summary.freeze_panes == 'B2'
+    assert summary.auto_filter.ref == 'A1:C1'
+    assert [str(cf.sqref) for cf in summary.conditional_formatting] == ['A1:C3']
+    assert [round(summary.column_dimensions[col].width) for col in 'ABC'] == [13, 15, 10]
+    assert wb['Plain'].auto_filter.ref is None
+    pd.testing.assert_frame_equal(pd.read_excel(file, sheet_name='Plain'), df)
+
+
+# Incremental flags should match flagging every record after records and child records change
+def test_incremental_flags(tmp_path):
+    def flag(records, children):
+        flagged = pd.merge(records, children, how='left', on='record_id')
+        flagged['DUPLICATE'] = flagged['record_id'].isin(records.loc[records.duplicated('email', keep=False),
+                                                                     'record_id'])
+        flagged['PAST'] = flagged['start'] < ts
+        return flagged
+
+    records = pd.DataFrame({'record_id': [1, 2, 3, 4],
+                            'email': ['a', 'a', 'b', 'c'],
+                            'modified': pd.to_datetime(['2022-01-01'] * 4)})
+    children = pd.DataFrame({'record_id': [1, 3, 3, 4],
+                             'child_id': [10, 30, 31, 40],
+                             'start': pd.to_datetime(['2022-01-01', '2022-02-01', '2022-03-15', '2022-04-01'])})
+    snapshot_file = str(tmp_path / 'snapshot.pkl')
+    kwargs = dict(snapshot_file=snapshot_file, group_cols=[['email']], time_cols=['start'])
+
+    ts = pd.Timestamp('2022-03-01')
+    first = utils.incremental_flags(records, 'record_id', flag, children=[children], ts=ts, **kwargs)
+    pd.testing.assert_frame_equal(first, flag(records, children))
+
+    # Record 2 moves to email 'c', record 4's child changes without a new modified timestamp,
+    # record 1 is removed and record 3's second session passes
+    records = records.loc[records['record_id'] != 1].reset_index(drop=True)
+    records.loc[records['record_id'] == 2, ['email', 'modified']] = ['c', pd.Timestamp('2022-03-20')]
+    children.loc[children['child_id'] == 40, 'start'] = pd.Timestamp('2022-02-15')
+    ts = pd.Timestamp('2022-04-01')
+    second = utils.incremental_flags(records, 'record_id', flag, children=[children], ts=ts, **kwargs)
+    pd.testing.assert_frame_equal(second, flag(records, children))
+
+
+# Rules should set update notifications like per-update .loc assignments, with later rules taking precedence
+def test_evaluate_rules():
+    update_notes = pd.DataFrame({'Module': ['Coalitions', 'Coalitions'],
+                                 'Update': ['GI UPDATE1', 'GI UPDATE2'],
+                                 'Notification1': ['Missing plan', 'Not SNAP-Ed'],
+                                 'Notification2': [None, 'No program area']})
+    update_notes = utils.update_note_index(update_notes)
+    rules = [{'update': 'GI UPDATE2', 'when': lambda df, p: df['program_area'] != p['program_area']},
+             {'update': 'GI UPDATE1', 'when': lambda df, p: df['action_plan_name'].isnull()},
+             {'update': 'GI UPDATE2', 'notification': 'Notification2',
+              'when': lambda df, p: df['program_area'].isnull()}]
+    df = pd.DataFrame({'action_plan_name': ['a', None, 'c'],
+                       'program_area': ['SNAP-Ed', None, 'FCS'],
+                       'GI UPDATE1': None})
+    timings = {}
+    flagged = utils.evaluate_rules(df, 'Coalitions', rules, update_notes, params={'program_area': 'SNAP-Ed'},
+                                   timings=timings)
+    assert flagged.columns.tolist() == ['action_plan_name', 'program_area', 'GI UPDATE1', 'GI UPDATE2']
+    assert flagged['GI UPDATE1'].tolist()[1] == 'Missing plan'
+    assert flagged['GI UPDATE2'].tolist()[1:] == ['No program area', 'Not SNAP-Ed']
+    assert flagged[['GI UPDATE1', 'GI UPDATE2']].isnull().sum().tolist() == [2, 1]
+    assert 'GI UPDATE2' not in df.columns
+    assert set(timings) == {('Coalitions', 'GI UPDATE1', 'Notification1'),
+                            ('Coalitions', 'GI UPDATE2', 'Notification1'),
+                            ('Coalitions', 'GI UPDATE2', 'Notification2')}
+    assert utils.rule_timings_summary(timings)['Seconds'].is_monotonic_decreasing
+
+
+# Update notifications should be indexed once per workbook and validated against the notifications a report uses
+def test_load_update_notes(tmp_path):
+    update_notifications = str(tmp_path / 'Update Notifications.xlsx')
+    pd.DataFrame({'Module': ['Coalitions', 'Partnerships'],
+                  'Tab': ['General Information', 'Evaluation'],
+                  'Update': ['GI UPDATE1', 'EVALUATION TAB UPDATES'],
+                  'Notification1': ['Missing plan', 'Missing depth'],
+                  'Notification2': [None, 'Unknown depth']}).to_excel(update_notifications,
+                                                                      sheet_name='Monthly Data Cleaning', index=False)
+    cache_dir = str(tmp_path / 'cache')
+    update_notes = utils.load_update_notes(update_notifications, 'Monthly Data Cleaning', cache_dir=cache_dir)
+    assert update_notes == {('Coalitions', 'GI UPDATE1', 'Notification1'): 'Missing plan',
+                            ('Partnerships', 'EVALUATION TAB UPDATES', 'Notification1'): 'Missing depth',
+                            ('Partnerships', 'EVALUATION TAB UPDATES', 'Notification2'): 'Unknown depth'}
+    assert utils.load_update_notes(update_notifications, 'Monthly Data Cleaning', cache_dir=cache_dir) is update_notes
+    assert utils.get_update_note(update_notes, 'Coalitions', 'GI UPDATE1') == 'Missing plan'
+
+    with pytest.raises(ValueError, match='GI UPDATE1'):
+        utils.load_update_notes(update_notifications, 'Monthly Data Cleaning',
+                                required=[('Coalitions', 'GI UPDATE1', 'Notification2')], cache_dir=cache_dir)
+
+    summary = utils.merge_update_notes(pd.DataFrame({'Module': ['Partnerships', 'Coalitions'],
+                                                     'Update': ['EVALUATION TAB UPDATES', 'Total']}), update_notes)
+    assert summary['Notification2'].tolist()[0] == 'Unknown depth'
+    assert summary.loc[1, ['Notification1', 'Notification2']].isnull().all()
+
+    with pytest.raises(ValueError, match='Duplicate'):
+        utils.update_note_index(pd.DataFrame({'Module': ['Coalitions'] * 2,
+                                              'Update': ['GI UPDATE1'] * 2,
+                                              'Notification1': ['a', 'b']}))
+
+
+# The staff roster should match the staff frames reports used to build from the staff list
+def test_staff_roster(tmp_path):
+    staff_list = ROOT_DIR + '/test_inputs/FY23_INEP_Staff_List.xlsx'
+    roster = utils.load_staff_roster(staff_list, cache_dir=str(tmp_path))
+    assert utils.load_staff_roster(staff_list, cache_dir=str(tmp_path)) is roster
+
+    cphp_staff = pd.read_excel(staff_list, sheet_name='CPHP Staff List')
+    assert set(roster.staff['email']) >= set(cphp_staff['Email Address'].dropna())
+    for email, first_name, full_name in roster.staff[['email', 'first_name', 'full_name']].values[:5]:
+        assert roster.is_current(email)
+        assert roster.first_name(email) == first_name
+        assert roster.full_name(email) == full_name
+
+    re_lookup = pd.read_excel(staff_list, sheet_name="RE's and CD's")
+    unit, re_name, re_email = re_lookup[['UNIT #', 'REGIONAL EDUCATOR', 'RE E-MAIL']].values[0]
+    last_name, first_name = re_name.replace(', Interim', '').split(', ')
+    assert roster.regional_educator(str(unit)) == (first_name + ' ' + last_name, re_email)
+    assert roster.regional_educator('not a unit') is None
+
+    former_staff = pd.read_excel(staff_list, sheet_name='Former Staff')
+    assert roster.former_staff_emails == set(former_staff['NETID'].map(str) + '@illinois.edu')
+
+
+# Recipients in a Regional Educator's unit should be directed to them, unless they're state office or UIC staff
+def test_recipient_context(tmp_path):
+    roster = utils.load_staff_roster(ROOT_DIR + '/test_inputs/FY23_INEP_Staff_List.xlsx', cache_dir=str(tmp_path))
+    unit, (re_name, re_email) = next(iter(roster.regional_educators.items()))
+    staff_email = roster.snap_ed_staff['E-MAIL'].dropna().iloc[0]
+    state_email = next(iter(roster.state_staff_emails))
+    recipients = pd.DataFrame({'reported_by_email': [staff_email, state_email, 'staff@uic.edu', staff_email],
+                               'unit': [unit, unit, unit, 'not a unit']},
+                              index=[3, 5, 7, 9])
+    context = utils.recipient_context(recipients, roster, 'cc@x.edu', 'Reply to us', 'Contact {0} at {1}')
+    assert context.index.tolist() == [3, 5, 7, 9]
+    assert context['response_tag'].tolist() == ['Contact ' + re_name + ' at ' + re_email] + ['Reply to us'] * 3
+    assert context['cc'].tolist() == ['cc@x.edu, ' + re_email] + ['cc@x.edu'] * 3
+    assert context.loc[3, 'first_name'] == roster.first_name(staff_email)
+    assert context.loc[3, 'full_name'] == roster.full_name(staff_email)
+
+
+# Report periods should follow the report date, falling back to Q4 outside of quarter-end months
+def test_fiscal_calendar():
+    calendar = utils.FiscalCalendar('2023-01-13')
+    assert calendar.prev_month_str == '2022-12'
+    assert calendar.prev_month_lb == pd.Timestamp('2022-12-01').date()
+    assert calendar.prev_month_ub == pd.Timestamp('2023-01-10').date()
+    assert (calendar.fq, calendar.fq_int, calendar.survey_fq) == ('Q1', 1, 'Quarter 1 (October-December)')
+    assert utils.FiscalCalendar('2023-02-13').fq == 'Q4'
+    assert utils.fiscal_calendar('2023-01-13 08:00') is utils.fiscal_calendar('2023-01-13 17:00')
+    # Annual reports run in October report on the fiscal year that just ended
+    assert calendar.fy == 2023
+    assert utils.FiscalCalendar('2022-10-18').fy == 2022
+
+
+# Dates should be bucketed into fiscal years and quarters, with 0 for missing and out-of-range dates
+def test_fiscal_calendar_buckets():
+    calendar = utils.FiscalCalendar('2023-01-13')
+    dates = pd.Series(['2022-09-30 23:59', '2022-10-01', '2023-01-10', '2023-01-11', None, '2014-01-01'])
+    assert calendar.assign_fiscal_year(dates).tolist() == [2022, 2023, 2023, 2023, 0, 0]
+    assert calendar.assign_quarter(dates).tolist() == [4, 1, 2, 2, 0, 0]
+    report_quarters = calendar.assign_quarter(dates, bounds=calendar.report_quarter_bounds(2023))
+    assert report_quarters.tolist() == [0, 1, 1, 2, 0, 0]
+
+
+# Names shared by users should resolve to a single email, by unit if the users' emails differ
+def test_user_index():
+    users = pd.DataFrame({'full_name': ['Ann Lee', 'Ann Lee', 'Bo Diaz', 'Bo Diaz', 'Cy Ng'],
+                          'email': ['ann1@x.edu', 'ann2@x.edu', 'bo@x.edu', 'bo@x.edu', 'cy@x.edu'],
+                          'unit': ['Unit 1', 'Unit 2', 'Unit 1', 'Unit 2', 'Unit 3']})
+    user_index = utils.UserIndex(users)
+    assert user_index.shared_names == {'Ann Lee'}
+    names = pd.Series(['Ann Lee', 'Ann Lee', 'Bo Diaz', 'Cy Ng', 'Former User'])
+    units = pd.Series(['Unit 2', 'Unit 3', 'Unit 1', None, 'Unit 1'])
+    emails = user_index.resolve(names, units)
+    assert emails.fillna('').tolist() == ['ann2@x.edu', '', 'bo@x.edu', 'cy@x.edu', '']
+    assert emails.isnull().tolist() == [False, True, False, False, True]
+
+
+# Stand-in for a boto3 S3 client that serves exports from a dict of keys to bytes
+class FakeS3Client:
+    def __init__(self, objects, page_size=1, fail=()):
+        self.objects = objects
+        self.page_size = page_size
+        self.fail = fail
+        self.downloads = []
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        for i in range(0, len(keys), self.page_size):
+            yield {'Contents': [{'Key': key,
+                                 'ETag': '"' + hashlib.md5(self.objects[key]).hexdigest() + '"',
+                                 'Size': len(self.objects[key])} for key in keys[i:i + self.page_size]]}
+
+    def download_file(self, bucket, key, filename, Config=None):
+        self.downloads.append(key)
+        if key in self.fail:
+            raise OSError('Download failed: ' + key)
+        with open(filename, 'wb') as f:
+            f.write(self.objects[key])
+
+
+def fake_s3_session(monkeypatch, client):
+    class FakeSession:
+        def __init__(self, profile_name=None):
+            pass
+
+        def client(self, service):
+            return client
+
+    monkeypatch.setattr(utils.boto3, 'Session', FakeSession)
+
+
+# Exports should be listed across pages, and exports unchanged since the last download should be skipped
+def test_download_s3_exports(tmp_path, monkeypatch):
+    prefix = 'org/2022/10/03/'
+    client = FakeS3Client({prefix + 'Coalition_Export.xlsx': b'coalitions',
+                           prefix + 'Partnership_Export.xlsx': b'partnerships',
+                           prefix + 'Site_Export.xlsx': b'sites'})
+    fake_s3_session(monkeypatch, client)
+    dst = tmp_path / 'exports'
+    dst.mkdir()
+    manifest = str(tmp_path / 'manifest.json')
+
+    downloaded = utils.download_s3_exports('profile', 'org', date='2022/10/03', dst=str(dst),
+                                           modules=['Coalition', 'Partnership'], manifest=manifest)
+    assert sorted(downloaded) == ['Coalition_Export.xlsx', 'Partnership_Export.xlsx']
+    assert sorted(os.listdir(dst)) == ['Coalition_Export.xlsx', 'Partnership_Export.xlsx']
+
+    # Only the export that changed in S3 is downloaded again
+    client.objects[prefix + 'Partnership_Export.xlsx'] = b'partnerships, revised'
+    client.downloads = []
+    utils.download_s3_exports('profile', 'org', date='2022/10/03', dst=str(dst),
+                              modules=['Coalition', 'Partnership'], manifest=manifest)
+    assert client.downloads == [prefix + 'Partnership_Export.xlsx']
+    assert (dst / 'Partnership_Export.xlsx').read_bytes() == b'partnerships, revised'
+
+
+# Exports downloaded before a failure should be recorded in the manifest
+def test_download_s3_exports_failure(tmp_path, monkeypatch):
+    prefix = 'org/2022/10/03/'
+    client = FakeS3Client({prefix + 'Coalition_Export.xlsx': b'coalitions',
+                           prefix + 'Site_Export.xlsx': b'sites'},
+                          fail=[prefix + 'Site_Export.xlsx'])
+    fake_s3_session(monkeypatch, client)
+    manifest = str(tmp_path / 'manifest.json')
+
+    with pytest.raises(OSError):
+        utils.download_s3_exports('profile', 'org', date='2022/10/03', dst=str(tmp_path), manifest=manifest,
+                                  max_workers=1)
+    with open(manifest) as f:
+        assert list(json.load(f)) == ['Coalition_Export.xlsx']
+
+    client.fail = []
+    client.downloads = []
+    utils.download_s3_exports('profile', 'org', date='2022/10/03', dst=str(tmp_path), manifest=manifest)
+    assert client.downloads == [prefix + 'Site_Export.xlsx']
+
+
+# The default manifest should be kept out of the export directory
+def test_download_s3_exports_manifest_dir(tmp_path, monkeypatch):
+    client = FakeS3Client({'org/2022/10/03/Site_Export.xlsx': b'sites'})
+    fake_s3_session(monkeypatch, client)
+    monkeypatch.setattr(utils, 'EXPORT_CACHE_DIR', str(tmp_path / 'cache'))
+    dst = tmp_path / 'exports'
+    dst.mkdir()
+
+    utils.download_s3_exports('profile', 'org', date='2022/10/03', dst=str(dst))
+    assert os.listdir(dst) == ['Site_Export.xlsx']
+    assert len(os.listdir(tmp_path / 'cache')) == 1